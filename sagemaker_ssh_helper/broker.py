@@ -0,0 +1,323 @@
+"""
+Local connection broker for SSH connections to SageMaker, started with `sm-ssh broker`.
+
+The broker keeps one warm SSM port forwarding session per host, e.g. `ssh-training-job.training.sagemaker`,
+and listens on a Unix socket. The ProxyCommand `sm-ssh start-proxy --broker %h` is then only a tiny client
+that sends the host name to the broker and relays bytes between its stdin/stdout and the socket,
+so only the first connection to the host pays for the instance lookup, the key publication and the session start.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import subprocess
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Optional
+
+from sagemaker_ssh_helper.inventory_cache import JSONFileCache
+
+if TYPE_CHECKING:
+    # Imported in SSMSessionBroker only, the broker client must stay light, see BrokerClient
+    import boto3
+
+
+def get_default_broker_socket_path() -> str:
+    return os.environ.get('SM_SSH_BROKER_SOCKET') or os.path.join(JSONFileCache.get_cache_dir(), 'broker.sock')
+
+
+class BrokerTarget:
+    """
+    The warm SSM session to a single host, forwarding the local TCP port to the SSH port of the instance.
+    """
+
+    def __init__(self, proxy_command, instance_id: str, fingerprint: str, key_is_known: bool,
+                 local_port: int, session_id: str, process: subprocess.Popen) -> None:
+        """
+        :param proxy_command: the :class:`SSMProxyCommand` that has authorized the key and started the session
+        """
+        super().__init__()
+        self.proxy_command = proxy_command
+        self.instance_id = instance_id
+        self.fingerprint = fingerprint
+        self.key_is_known = key_is_known
+        self.local_port = local_port
+        self.session_id = session_id
+        self.process = process
+        self.active_connections = 0
+        self.connection_count = 0
+        self.last_used_time = time.monotonic()
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+
+class SSMSessionBroker:
+    logger = logging.getLogger('sagemaker-ssh-helper:SSMSessionBroker')
+
+    def __init__(self, socket_path: str = None, idle_timeout_in_sec: float = 600,
+                 boto_session: 'boto3.session.Session' = None,
+                 port_forwarding_timeout_in_sec: float = 60) -> None:
+        """
+        :param socket_path: the Unix socket to listen on, see :func:`get_default_broker_socket_path`
+        :param idle_timeout_in_sec: close the SSM session to a host that had no connections for that long
+        :param boto_session: the session to create the clients from, the default session if not passed
+        :param port_forwarding_timeout_in_sec: how long to wait for the new session to start accepting connections
+        """
+        super().__init__()
+        import boto3
+        self.socket_path = socket_path or get_default_broker_socket_path()
+        self.idle_timeout_in_sec = idle_timeout_in_sec
+        self.boto_session = boto_session or boto3.session.Session()
+        self.port_forwarding_timeout_in_sec = port_forwarding_timeout_in_sec
+        self.targets: Dict[str, BrokerTarget] = {}
+        self.lock = threading.Lock()
+        # Targets are started in parallel, but only one at a time for the same host
+        self.target_locks: Dict[str, threading.Lock] = {}
+        self.server: Optional[socketserver.ThreadingUnixStreamServer] = None
+        self.stopped = threading.Event()
+
+    def serve_forever(self):
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            if BrokerClient(self.socket_path).is_running():
+                raise ValueError(f"Broker is already running at {self.socket_path}")
+            os.remove(self.socket_path)
+
+        broker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                broker.handle_connection(self.request)
+
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self.server.daemon_threads = True
+        os.chmod(self.socket_path, 0o600)
+        reaper = threading.Thread(target=self._evict_idle_targets_periodically, daemon=True)
+        reaper.start()
+        self.logger.info(f"Listening on {self.socket_path}, idle timeout: {self.idle_timeout_in_sec} s")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopped.set()
+            self.server.server_close()
+            os.remove(self.socket_path)
+            for fqdn in list(self.targets.keys()):
+                self._close_target(fqdn)
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+
+    def handle_connection(self, client: socket.socket):
+        request = json.loads(_read_line(client))
+        if request.get('Command') == 'ping':
+            client.sendall(b"OK\n")
+            return
+        fqdn = request['Fqdn']
+        try:
+            target = self.get_target(fqdn, request.get('DomainId', ''), request.get('UserProfileName', ''))
+            upstream = socket.create_connection(('localhost', target.local_port))
+        except Exception as e:
+            self.logger.error(f"Failed to connect to {fqdn}: {e}")
+            client.sendall(f"ERROR {e}\n".encode('utf-8'))
+            return
+
+        with self.lock:
+            target.active_connections += 1
+            target.connection_count += 1
+        client.sendall(b"OK\n")
+        try:
+            relay_sockets(client, upstream)
+        finally:
+            upstream.close()
+            with self.lock:
+                target.active_connections -= 1
+                target.last_used_time = time.monotonic()
+
+    def get_target(self, fqdn: str, domain_id: str = '', user_profile_name: str = '') -> BrokerTarget:
+        with self.lock:
+            target_lock = self.target_locks.setdefault(fqdn, threading.Lock())
+        with target_lock:
+            with self.lock:
+                target = self.targets.get(fqdn)
+                if target and target.is_alive():
+                    # Protect from eviction until the connection is counted as active
+                    target.last_used_time = time.monotonic()
+                    return target
+            if target:
+                self.logger.info(f"Session to {fqdn} has ended, starting a new one")
+                self._close_target(fqdn, target)
+            target = self._start_target(fqdn, domain_id, user_profile_name)
+            with self.lock:
+                self.targets[fqdn] = target
+            return target
+
+    def _start_target(self, fqdn: str, domain_id: str, user_profile_name: str) -> BrokerTarget:
+        proxy_command = self._new_proxy_command(fqdn, domain_id, user_profile_name)
+        instance_id, fingerprint, key_is_known = proxy_command.authorize()
+        if key_is_known:
+            # The same as for the native proxy, see SSMProxyCommand.check_key()
+            threading.Thread(target=proxy_command.check_key, args=(instance_id, fingerprint), daemon=True).start()
+        from sagemaker_ssh_helper.proxy import SSMProxy
+        local_port = SSMProxy.find_free_port()
+        session_id, process = proxy_command.start_port_forwarding_session(instance_id, local_port)
+        target = BrokerTarget(proxy_command, instance_id, fingerprint, key_is_known, local_port, session_id, process)
+        deadline = time.monotonic() + self.port_forwarding_timeout_in_sec
+        while True:
+            if not target.is_alive():
+                raise ValueError(f"Session Manager plugin exited with code {process.returncode}")
+            try:
+                socket.create_connection(('localhost', local_port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    self._terminate(target)
+                    raise TimeoutError(f"Timed out waiting for port forwarding session to {instance_id}")
+                time.sleep(0.2)
+        self.logger.info(f"Session to {fqdn} ({instance_id}) is ready on local port {local_port}")
+        return target
+
+    def _new_proxy_command(self, fqdn: str, domain_id: str, user_profile_name: str):
+        from sagemaker_ssh_helper.proxy_command import SSMProxyCommand
+        # boto3 sessions are not thread-safe, so clients are created one at a time
+        with self.lock:
+            return SSMProxyCommand(fqdn, domain_id, user_profile_name, boto_session=self.boto_session)
+
+    def evict_idle_targets(self):
+        now = time.monotonic()
+        with self.lock:
+            idle_fqdns = [fqdn for fqdn, target in self.targets.items()
+                          if target.active_connections == 0
+                          and (now - target.last_used_time > self.idle_timeout_in_sec or not target.is_alive())]
+        for fqdn in idle_fqdns:
+            self.logger.info(f"Closing idle session to {fqdn}")
+            self._close_target(fqdn)
+
+    def _evict_idle_targets_periodically(self):
+        while not self.stopped.wait(min(self.idle_timeout_in_sec / 2, 30)):
+            self.evict_idle_targets()
+
+    def _close_target(self, fqdn: str, target: BrokerTarget = None):
+        with self.lock:
+            if target is None or self.targets.get(fqdn) is target:
+                target = self.targets.pop(fqdn, None)
+        if target:
+            self._terminate(target)
+
+    def _terminate(self, target: BrokerTarget):
+        if target.is_alive():
+            target.process.terminate()
+        try:
+            target.proxy_command.ssm.terminate_session(SessionId=target.session_id)
+        except Exception as e:
+            self.logger.warning(f"Failed to terminate session {target.session_id}: {e}")
+
+
+class BrokerClient:
+    """
+    The client side of the broker, used by `sm-ssh start-proxy --broker`.
+    Keep the imports of this class light, it runs on every SSH connection.
+    """
+
+    def __init__(self, socket_path: str = None) -> None:
+        super().__init__()
+        self.socket_path = socket_path or get_default_broker_socket_path()
+
+    def is_running(self) -> bool:
+        try:
+            sock = self._request({'Command': 'ping'})
+            sock.close()
+            return True
+        except OSError:
+            return False
+
+    def connect(self, fqdn: str, domain_id: str = '', user_profile_name: str = '') -> socket.socket:
+        """
+        :return: the socket connected to SSH port of the instance through the broker
+        :raises OSError: if the broker is not running
+        :raises ValueError: if the broker failed to connect to the host
+        """
+        return self._request({'Command': 'connect', 'Fqdn': fqdn,
+                              'DomainId': domain_id, 'UserProfileName': user_profile_name})
+
+    def _request(self, request: dict) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(request).encode('utf-8') + b"\n")
+            response = _read_line(sock)
+        except OSError:
+            sock.close()
+            raise
+        if response != 'OK':
+            sock.close()
+            raise ValueError(f"Broker failed to connect: {response}")
+        return sock
+
+    @staticmethod
+    def relay_stdio(sock: socket.socket, in_fd: int = 0, out_fd: int = 1):
+        """
+        Relay stdin to the socket and the socket to stdout until the socket is closed by the remote side.
+        """
+        def forward_input():
+            while True:
+                data = os.read(in_fd, 65536)
+                if not data:
+                    break
+                sock.sendall(data)
+            _shutdown_write(sock)
+
+        threading.Thread(target=forward_input, daemon=True).start()
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            while data:
+                written = os.write(out_fd, data)
+                data = data[written:]
+        sock.close()
+
+
+def relay_sockets(first: socket.socket, second: socket.socket):
+    """
+    Relay bytes in both directions until both sides close their ends.
+    """
+    def forward(source: socket.socket, destination: socket.socket):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                destination.sendall(data)
+        except OSError:
+            pass
+        _shutdown_write(destination)
+
+    other_direction = threading.Thread(target=forward, args=(second, first), daemon=True)
+    other_direction.start()
+    forward(first, second)
+    other_direction.join()
+
+
+def _shutdown_write(sock: socket.socket):
+    try:
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+def _read_line(sock: socket.socket) -> str:
+    # Read byte by byte, so nothing after the line is consumed from the socket
+    line = b""
+    while not line.endswith(b"\n"):
+        data = sock.recv(1)
+        if not data:
+            raise ConnectionError("Connection closed while reading the header")
+        line += data
+    return line.decode('utf-8').strip()
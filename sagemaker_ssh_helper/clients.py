@@ -0,0 +1,156 @@
+"""
+Process-wide registry of boto3 clients, shared by SSMManager, SSHLog, SageMaker, SSHIDE and the wrappers,
+and the cache of the caller identity, see :func:`get_caller_identity`.
+
+Creating a client loads the service model and resolves the credential chain, which is surprisingly expensive
+in polling loops and listings. boto3 clients are thread-safe, so one client per service, region and endpoint
+is enough for the whole process.
+
+The connection pool size and the retry mode of the clients can be changed with :func:`configure`.
+The pool size can also be set with the environment variable SM_SSH_MAX_POOL_CONNECTIONS, and the retry mode
+with AWS_RETRY_MODE or in the AWS config file, as for any boto3 client, e.g.:
+
+    SM_SSH_MAX_POOL_CONNECTIONS=50 AWS_RETRY_MODE=adaptive sm-ssh list
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+
+import logging
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import boto3
+from botocore.config import Config
+
+from sagemaker_ssh_helper import timings
+
+logger = logging.getLogger('sagemaker-ssh-helper:clients')
+
+
+class BotoClientRegistry:
+    def __init__(self, max_pool_connections: int = 10, retry_mode: Optional[str] = None,
+                 max_attempts: Optional[int] = None) -> None:
+        """
+        :param max_pool_connections: the size of the connection pool of each client,
+            should be at least the number of threads that call the same client concurrently
+        :param retry_mode: 'legacy', 'standard' or 'adaptive', see the botocore retries guide;
+            if not set, taken from AWS_RETRY_MODE or the AWS config file
+        :param max_attempts: the total number of attempts for a request, the retry mode's default if not set
+        """
+        super().__init__()
+        retries = {}
+        if retry_mode is not None:
+            retries['mode'] = retry_mode
+        if max_attempts is not None:
+            retries['total_max_attempts'] = max_attempts
+        self.config = Config(max_pool_connections=max_pool_connections, retries=retries or None)
+        self.lock = threading.Lock()
+        self.clients: Dict[Tuple[boto3.session.Session, str, Optional[str], Optional[str]], object] = {}
+
+    def get_client(self, service_name: str, region_name: Optional[str] = None, endpoint_url: Optional[str] = None):
+        """
+        The clients are created from the default boto3 session and keep its credentials. After
+        boto3.setup_default_session(), e.g., with another profile, new clients are created from the new session.
+        As for boto3.client(), changing AWS_PROFILE has no effect once the default session exists.
+
+        :param region_name: the region of the client, the default region of boto3 if not set
+        :return: the client created on the first call with the same arguments and the same default session
+        """
+        # Creating clients from the default boto3 session isn't thread-safe, so they're created under the lock
+        with self.lock:
+            if boto3.DEFAULT_SESSION is None:
+                boto3.setup_default_session()
+            key = (boto3.DEFAULT_SESSION, service_name, region_name, endpoint_url)
+            client = self.clients.get(key)
+            if client is None:
+                logger.debug(f"Creating {service_name} client for region {region_name}")
+                client = boto3.client(service_name, region_name=region_name, endpoint_url=endpoint_url,
+                                      config=self.config)
+                self.clients[key] = client
+        return client
+
+    def clear(self):
+        """
+        Drop all clients, e.g., after switching to another AWS profile, so that the next calls create new ones.
+        """
+        with self.lock:
+            self.clients.clear()
+
+
+_registry: Optional[BotoClientRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> BotoClientRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = BotoClientRegistry(int(os.environ.get('SM_SSH_MAX_POOL_CONNECTIONS', '10')))
+        return _registry
+
+
+def configure(max_pool_connections: int = 10, retry_mode: Optional[str] = None,
+              max_attempts: Optional[int] = None) -> BotoClientRegistry:
+    """
+    Replace the shared registry with the new settings. The clients created before are not reused.
+    """
+    global _registry
+    with _registry_lock:
+        _registry = BotoClientRegistry(max_pool_connections, retry_mode, max_attempts)
+        return _registry
+
+
+def get_client(service_name: str, region_name: Optional[str] = None, endpoint_url: Optional[str] = None):
+    """
+    See :meth:`BotoClientRegistry.get_client`.
+    """
+    return get_registry().get_client(service_name, region_name, endpoint_url)
+
+
+def clear():
+    """
+    Drop all clients of the shared registry, see :meth:`BotoClientRegistry.clear`, and the cached caller identities.
+    """
+    get_registry().clear()
+    with _caller_identities_lock:
+        _caller_identities.clear()
+
+
+_caller_identities: Dict[Tuple[str, Optional[str]], Dict[str, str]] = {}
+_caller_identities_lock = threading.Lock()
+
+
+def get_caller_identity(region_name: Optional[str] = None, endpoint_url: Optional[str] = None,
+                        boto_session: Optional[boto3.session.Session] = None) -> Dict[str, str]:
+    """
+    The result of STS GetCallerIdentity, i.e., 'UserId', 'Account' and 'Arn', cached for the whole process
+    by the credential source and region. Temporary credentials get a new access key when they are refreshed,
+    so the identity is looked up again after that.
+
+    :param boto_session: the session to take the credentials from, the default boto3 session if not passed
+    """
+    if boto_session is None:
+        sts = get_client('sts', region_name, endpoint_url)
+        # Shared clients are created from the default session, and it caches the resolved credentials
+        session = boto3.DEFAULT_SESSION or boto3.session.Session()
+    else:
+        sts = None
+        session = boto_session
+    credentials = session.get_credentials()
+    access_key = credentials.get_frozen_credentials().access_key if credentials else None
+    key = (access_key, region_name or session.region_name)
+    with _caller_identities_lock:
+        identity = _caller_identities.get(key)
+    if identity is not None:
+        return identity
+
+    if sts is None:
+        sts = boto_session.client('sts', region_name=region_name, endpoint_url=endpoint_url)
+    response = timings.count_api_calls_of(sts).get_caller_identity()
+    identity = {name: response[name] for name in ['UserId', 'Account', 'Arn'] if name in response}
+    if access_key:
+        with _caller_identities_lock:
+            _caller_identities[key] = identity
+    return identity
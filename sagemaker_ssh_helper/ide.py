@@ -4,6 +4,7 @@ import time
 import boto3
 from botocore.exceptions import ClientError, WaiterError
 
+from sagemaker_ssh_helper import clients
 from sagemaker_ssh_helper.log import SSHLog
 from sagemaker_ssh_helper.manager import SSMManager
 
@@ -50,8 +51,9 @@ class SSHIDE:
         self.user = user
         self.domain_id = domain_id
         self.current_region = region_name or boto3.session.Session().region_name
-        self.client = boto3.client('sagemaker', region_name=self.current_region)
+        self.client = clients.get_client('sagemaker', self.current_region)
         self.ssh_log = SSHLog(region_name=self.current_region)
+        self.ssm_manager = SSMManager(region_name=self.current_region)
 
     def create_ssh_kernel_app(self, app_name: str,
                               image_name_or_arn='sagemaker-datascience-38',
@@ -95,7 +97,7 @@ class SSHIDE:
         else:
             image_arn = self.resolve_sagemaker_kernel_image_arn(image_name_or_arn)
 
-        account_id = boto3.client('sts').get_caller_identity().get('Account')
+        account_id = clients.get_caller_identity(self.current_region).get('Account')
         lifecycle_arn = f"arn:aws:sagemaker:{self.current_region}:{account_id}:" \
                         f"studio-lifecycle-config/{ssh_lifecycle_config}"
 
@@ -214,18 +216,18 @@ class SSHIDE:
                          f"in domain '{self.domain_id}' for user '{self.user}'")
         self.log_urls(app_name)
         if self.domain_id and self.user:
-            result = SSMManager().get_studio_user_kgw_instance_ids(self.domain_id, self.user, app_name,
-                                                                   timeout_in_sec, not_earlier_than_timestamp)
+            result = self.ssm_manager.get_studio_user_kgw_instance_ids(self.domain_id, self.user, app_name,
+                                                                    timeout_in_sec, not_earlier_than_timestamp)
         elif self.user:
             self.logger.warning(f"Domain ID is not set. Will attempt to connect to the latest "
                                 f"active kernel gateway with the name {app_name} in the region {self.current_region} "
                                 f"for user profile {self.user}")
-            result = SSMManager().get_studio_user_kgw_instance_ids("", self.user, app_name,
-                                                                   timeout_in_sec, not_earlier_than_timestamp)
+            result = self.ssm_manager.get_studio_user_kgw_instance_ids("", self.user, app_name,
+                                                                    timeout_in_sec, not_earlier_than_timestamp)
         else:
             self.logger.warning(f"Domain ID or user profile name are not set. Will attempt to connect to the latest "
                                 f"active kernel gateway with the name {app_name} in the region {self.current_region}")
-            result = SSMManager().get_studio_kgw_instance_ids(app_name, timeout_in_sec, not_earlier_than_timestamp)
+            result = self.ssm_manager.get_studio_kgw_instance_ids(app_name, timeout_in_sec, not_earlier_than_timestamp)
         return result
 
     def log_urls(self, app_name):
@@ -265,7 +267,7 @@ class SSHIDE:
 
         self.wait_for_image_creation(image_name)
 
-        account_id = boto3.client('sts').get_caller_identity().get('Account')
+        account_id = clients.get_caller_identity(self.current_region).get('Account')
         sagemaker_image_version_dict = self.client.create_image_version(
             BaseImage=f"{account_id}.dkr.ecr.{self.current_region}.amazonaws.com/{ecr_image_name}",
             ImageName=image_name,
@@ -348,11 +350,12 @@ class NotebookInstance:
     def __init__(self, notebook_name, region_name: str = None):
         self.notebook_name = notebook_name
         self.current_region = region_name or boto3.session.Session().region_name
-        self.client = boto3.client('sagemaker', region_name=self.current_region)
+        self.client = clients.get_client('sagemaker', self.current_region)
         self.ssh_log = SSHLog(region_name=self.current_region)
+        self.ssm_manager = SSMManager(region_name=self.current_region)
 
     def get_instance_ids(self):
-        result = SSMManager().get_notebook_instance_ids(self.notebook_name)
+        result = self.ssm_manager.get_notebook_instance_ids(self.notebook_name)
         return result
 
     def get_cloudwatch_url(self):
@@ -2,12 +2,14 @@ import logging
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional
 
-import boto3
+from botocore.exceptions import ClientError
+
+from sagemaker_ssh_helper import clients
 from sagemaker_ssh_helper.sm_ssh import SageMakerSecureShellHelper
 
-from sagemaker_ssh_helper.ide import IDEAppStatus, SSHIDE
+from sagemaker_ssh_helper.ide import IDEAppStatus
 from sagemaker_ssh_helper.log import SSHLog
-from sagemaker_ssh_helper.manager import SSMManager
+from sagemaker_ssh_helper.manager import SSMManager, SSMInstanceIndex
 
 
 class SageMakerCoreApp:
@@ -54,10 +56,11 @@ class SageMakerStudioApp(SageMakerCoreApp):
 
 
 class SageMakerEndpoint(SageMakerCoreApp):
-    def __init__(self, name, endpoint_status):
+    def __init__(self, name, endpoint_status, creation_time: Optional[datetime] = None):
         super().__init__()
         self.endpoint_status = endpoint_status
         self.name = name
+        self.creation_time = creation_time
         self.resource_type = "inference"
 
     def __str__(self) -> str:
@@ -142,17 +145,27 @@ class SageMaker:
     def __init__(self, region: str = None) -> None:
         super().__init__()
         self.region = region
-        self.sagemaker_client = boto3.client('sagemaker', region_name=self.region)
-
-    def list_ide_apps(self) -> List[SageMakerStudioApp]:
+        self.sagemaker_client = clients.get_client('sagemaker', self.region)
+
+    def list_ide_apps(self, domain_id: Optional[str] = None,
+                      space_name: Optional[str] = None) -> List[SageMakerStudioApp]:
+        """
+        :param domain_id: if set, only apps in this domain are listed
+        :param space_name: if set, only apps in this space are listed
+        """
+        filters = {}
+        if domain_id:
+            filters['DomainIdEquals'] = domain_id
+        if space_name:
+            filters['SpaceNameEquals'] = space_name
         next_page_id = ""
         result = []
         while next_page_id is not None:
             # See https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sagemaker/client/list_apps.html  # noqa
             if next_page_id == "":
-                apps_response = self.sagemaker_client.list_apps()
+                apps_response = self.sagemaker_client.list_apps(**filters)
             else:
-                apps_response = self.sagemaker_client.list_apps(NextToken=next_page_id)
+                apps_response = self.sagemaker_client.list_apps(NextToken=next_page_id, **filters)
             next_page_id = apps_response.get('NextToken')
             apps_list = apps_response['Apps']
             for app_dict in apps_list:
@@ -166,14 +179,30 @@ class SageMaker:
                 else:
                     app_space_name = app_dict['SpaceName']
                     logging.info("Found app %s of type %s for app space %s" % (app_name, app_type, app_space_name))
-                    app_status = SSHIDE(domain_id, app_space_name, self.region).get_app_status(app_name, app_type)
                     result.append(SageMakerStudioApp(
                         domain_id, app_space_name,
                         app_dict['AppName'], app_dict['AppType'],
-                        app_status
+                        self._get_app_status(app_dict)
                     ))
         return result
 
+    def _get_app_status(self, app_dict) -> IDEAppStatus:
+        status = app_dict.get('Status')
+        if status != 'Failed':
+            return IDEAppStatus(status)
+        # Failure reason is not returned by ListApps
+        try:
+            response = self.sagemaker_client.describe_app(
+                DomainId=app_dict['DomainId'],
+                AppType=app_dict['AppType'],
+                SpaceName=app_dict['SpaceName'],
+                AppName=app_dict['AppName'],
+            )
+        except ClientError as e:
+            logging.warning("Failed to fetch the failure reason for app %s: %s" % (app_dict['AppName'], e))
+            return IDEAppStatus(status)
+        return IDEAppStatus(response['Status'], response.get('FailureReason'))
+
     def list_endpoints(self) -> List[SageMakerEndpoint]:
         next_page_id = ""
         result = []
@@ -188,7 +217,8 @@ class SageMaker:
             for endpoint in endpoints_list:
                 result.append(SageMakerEndpoint(
                     endpoint['EndpointName'],
-                    endpoint['EndpointStatus']
+                    endpoint['EndpointStatus'],
+                    endpoint.get('CreationTime')
                 ))
         return result
 
@@ -288,15 +318,18 @@ class InteractiveSageMaker:
         self.manager = manager
         self.log = log
 
-    def list_studio_ide_apps_for_user_and_domain(self, domain_id: Optional[str], user_profile_name: Optional[str]):
-        managed_instances = self.manager.list_all_instances_and_fetch_tags()
-        sagemaker_apps = self.sagemaker.list_ide_apps()
+    def list_studio_ide_apps_for_user_and_domain(self, domain_id: Optional[str], user_profile_name: Optional[str],
+                                                 managed_instances: Optional[Dict[str, Dict[str, str]]] = None):
+        if managed_instances is None:
+            managed_instances = self.manager.list_all_instances_and_fetch_tags()
+        sagemaker_apps = self.sagemaker.list_ide_apps(domain_id, user_profile_name)
+        index = SSMInstanceIndex(managed_instances)
         result = []
         for sagemaker_app in sagemaker_apps:
             if (sagemaker_app.domain_id == domain_id or domain_id is None or domain_id == "") \
                     and (sagemaker_app.user_profile_name == user_profile_name or user_profile_name is None
                          or user_profile_name == ""):
-                instance_id = self._find_latest_app_instance_id(managed_instances, sagemaker_app)
+                instance_id = self._find_latest_app_instance_id(index, sagemaker_app)
                 if instance_id:
                     tags = managed_instances[instance_id]
                     sagemaker_app.set_ssm_instance_id(instance_id)
@@ -317,35 +350,12 @@ class InteractiveSageMaker:
         return self.list_studio_ide_apps_for_user_and_domain(None, None)
 
     @staticmethod
-    def _find_latest_instance_id(managed_instances: Dict[str, Dict[str, str]],
-                                 arn_substring: str, arn_tail: str):
-        result = None
-        max_timestamp = -1
-        for managed_instance_id in managed_instances:
-            tags = managed_instances[managed_instance_id]
-            arn = tags['SSHResourceArn'] if 'SSHResourceArn' in tags else ''
-            timestamp = int(tags['SSHTimestamp']) if 'SSHTimestamp' in tags else 0
-            if (arn_substring in arn and arn.endswith(arn_tail)
-                    and timestamp > max_timestamp):
-                result = managed_instance_id
-                max_timestamp = timestamp
-        return result
+    def _find_latest_app_instance_id(index: SSMInstanceIndex, sagemaker_app: SageMakerStudioApp):
+        def matches_app(tags):
+            arn = tags['SSHResourceArn']
+            return f"/{sagemaker_app.user_profile_name}/" in arn and f"/{sagemaker_app.domain_id}/" in arn
 
-    @staticmethod
-    def _find_latest_app_instance_id(managed_instances: Dict[str, Dict[str, str]], sagemaker_app: SageMakerStudioApp):
-        result = None
-        max_timestamp = -1
-        for managed_instance_id in managed_instances:
-            tags = managed_instances[managed_instance_id]
-            arn = tags['SSHResourceArn'] if 'SSHResourceArn' in tags else ''
-            timestamp = int(tags['SSHTimestamp']) if 'SSHTimestamp' in tags else 0
-            if (':app/' in arn and arn.endswith(f"/{sagemaker_app.app_name}")
-                    and f"/{sagemaker_app.user_profile_name}/" in arn
-                    and f"/{sagemaker_app.domain_id}/" in arn
-                    and timestamp > max_timestamp):
-                result = managed_instance_id
-                max_timestamp = timestamp
-        return result
+        return index.find_latest_instance_id('app', sagemaker_app.app_name, matches_app)
 
     def print_endpoints(self):
         managed_instances = self.manager.list_all_instances_and_fetch_tags()
@@ -355,13 +365,17 @@ class InteractiveSageMaker:
 
     def list_endpoints(self, managed_instances: Dict[str, Dict[str, str]]) -> List[SageMakerEndpoint]:
         sagemaker_endpoints = self.sagemaker.list_endpoints()
+        creation_times = [sagemaker_endpoint.creation_time for sagemaker_endpoint in sagemaker_endpoints]
+        # The query scans the logs since the creation of the oldest endpoint
+        not_earlier_than_timestamp = int(min(creation_times).timestamp()) \
+            if creation_times and all(creation_times) else 0
+        endpoints_instance_ids = self.log.get_endpoints_ssm_instance_ids(
+            [sagemaker_endpoint.name for sagemaker_endpoint in sagemaker_endpoints], not_earlier_than_timestamp
+        )
         result = []
         for sagemaker_endpoint in sagemaker_endpoints:
-            instance_ids = self.log.get_endpoint_ssm_instance_ids(
-                sagemaker_endpoint.name,
-                timeout_in_sec=0
-            )
-            if instance_ids:
+            instance_ids = endpoints_instance_ids[sagemaker_endpoint.name]
+            if instance_ids and instance_ids[0] in managed_instances:
                 instance_id = instance_ids[0]
                 tags = managed_instances[instance_id]
                 sagemaker_endpoint.set_ssm_instance_id(instance_id)
@@ -378,11 +392,10 @@ class InteractiveSageMaker:
 
     def list_training_jobs(self, managed_instances: Dict[str, Dict[str, str]]) -> List[SageMakerTrainingJob]:
         sagemaker_training_jobs = self.sagemaker.list_training_jobs()
+        index = SSMInstanceIndex(managed_instances)
         result = []
         for job in sagemaker_training_jobs:
-            instance_id = self._find_latest_instance_id(
-                managed_instances, ":training-job/", f"/{job.training_job_name}"
-            )
+            instance_id = index.find_latest_instance_id('training-job', job.training_job_name)
             if instance_id:
                 tags = managed_instances[instance_id]
                 job.set_ssm_instance_id(instance_id)
@@ -405,11 +418,10 @@ class InteractiveSageMaker:
 
     def list_processing_jobs(self, managed_instances: Dict[str, Dict[str, str]]) -> List[SageMakerProcessingJob]:
         sagemaker_processing_jobs = self.sagemaker.list_processing_jobs()
+        index = SSMInstanceIndex(managed_instances)
         result = []
         for job in sagemaker_processing_jobs:
-            instance_id = self._find_latest_instance_id(
-                managed_instances, ":processing-job/", f"/{job.processing_job_name}"
-            )
+            instance_id = index.find_latest_instance_id('processing-job', job.processing_job_name)
             if instance_id:
                 tags = managed_instances[instance_id]
                 job.set_ssm_instance_id(instance_id)
@@ -426,11 +438,10 @@ class InteractiveSageMaker:
 
     def list_transform_jobs(self, managed_instances: Dict[str, Dict[str, str]]) -> List[SageMakerTransformJob]:
         sagemaker_transform_jobs = self.sagemaker.list_transform_jobs()
+        index = SSMInstanceIndex(managed_instances)
         result = []
         for job in sagemaker_transform_jobs:
-            instance_id = self._find_latest_instance_id(
-                managed_instances, ":transform-job/", f"/{job.transform_job_name}"
-            )
+            instance_id = index.find_latest_instance_id('transform-job', job.transform_job_name)
             if instance_id:
                 tags = managed_instances[instance_id]
                 job.set_ssm_instance_id(instance_id)
@@ -441,11 +452,10 @@ class InteractiveSageMaker:
 
     def list_notebook_instances(self, managed_instances):
         sagemaker_notebook_instances = self.sagemaker.list_notebook_instances()
+        index = SSMInstanceIndex(managed_instances)
         result = []
         for instance in sagemaker_notebook_instances:
-            instance_id = self._find_latest_instance_id(
-                managed_instances, ":notebook-instance/", f"/{instance.name}"
-            )
+            instance_id = index.find_latest_instance_id('notebook-instance', instance.name)
             if instance_id:
                 tags = managed_instances[instance_id]
                 instance.set_ssm_instance_id(instance_id)
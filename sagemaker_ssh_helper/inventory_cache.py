@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+
+class JSONFileCache:
+    """
+    Base class for the small local caches of SageMaker SSH Helper, each stored as a single JSON dictionary.
+    """
+    logger = logging.getLogger('sagemaker-ssh-helper:JSONFileCache')
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: the JSON file to store the cache in
+        """
+        super().__init__()
+        self.path = path
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_cache_dir() -> str:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(cache_home, 'sagemaker-ssh-helper')
+
+    @staticmethod
+    def get_credentials_key(profile_name: Optional[str], region_name: str) -> str:
+        """
+        :return: the key of the credentials from the static keys in the environment,
+            if present, or from the profile, which is how boto3 and AWS CLI pick them up, and the region
+        """
+        access_key_id = os.environ.get('AWS_ACCESS_KEY_ID')
+        source = f"key/{access_key_id}" if access_key_id else f"profile/{profile_name or 'default'}"
+        return f"{source}/{region_name}"
+
+    def clear(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _load(self) -> Dict[str, Dict]:
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+            if not isinstance(entries, dict):
+                raise ValueError(f"Unexpected cache format in {self.path}")
+            return entries
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Ignoring unreadable cache {self.path}: {e}")
+            return {}
+
+    def _save(self, entries: Dict[str, Dict]):
+        # Write to a temp file and rename, so that concurrent readers never see a partial file
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self.logger.warning(f"Failed to save cache {self.path}: {e}")
+
+
+class SSMInventoryCache(JSONFileCache):
+    """
+    Local on-disk cache of SSM managed instance tags.
+
+    The tags are set by sm-init-ssm when the instance is registered and rarely change afterwards,
+    so they are kept for a few minutes, which covers the repeated polls of the waiters and the CLI commands.
+    Only volatile attributes like ping status are queried from SSM every time.
+    """
+    logger = logging.getLogger('sagemaker-ssh-helper:SSMInventoryCache')
+
+    def __init__(self, path: str, ttl_in_seconds: Optional[int] = 10 * 60) -> None:
+        """
+        :param path: the JSON file to store the cache in
+        :param ttl_in_seconds: how long to trust the cached tags before fetching them again, None for forever
+        """
+        super().__init__(path)
+        self.ttl_in_seconds = ttl_in_seconds
+
+    @classmethod
+    def for_region(cls, region_name: str, profile_name: Optional[str] = None) -> 'SSMInventoryCache':
+        """
+        :param profile_name: the AWS profile, so that different accounts in the same region don't share the cache,
+            see :meth:`get_credentials_key`
+        """
+        file_name = re.sub(r'[^\w.-]', '_', cls.get_credentials_key(profile_name, region_name))
+        return cls(os.path.join(cls.get_cache_dir(), f"ssm-inventory-{file_name}.json"))
+
+    def get_tags(self) -> Dict[str, Dict[str, str]]:
+        """
+        :return: a mapping of instance ID to the dictionary of tags for entries that are not expired
+        """
+        with self.lock:
+            entries = self._load()
+        now = time.time()
+        return {instance_id: entry['Tags'] for instance_id, entry in entries.items()
+                if self.ttl_in_seconds is None or now - entry['FetchedAt'] < self.ttl_in_seconds}
+
+    def update(self, fetched_tags: Dict[str, Dict[str, str]],
+               existing_instance_ids: Optional[Iterable[str]] = None):
+        """
+        :param fetched_tags: a mapping of instance ID to the dictionary of freshly fetched tags
+        :param existing_instance_ids: if passed, the full list of instances currently in the SSM inventory,
+            all other entries are removed from the cache
+        """
+        if not fetched_tags and existing_instance_ids is None:
+            return
+        with self.lock:
+            entries = self._load()
+            if existing_instance_ids is not None:
+                existing_instance_ids = set(existing_instance_ids)
+                if not fetched_tags and existing_instance_ids.issuperset(entries.keys()):
+                    # Nothing changed, e.g., a waiter poll with all tags still cached
+                    return
+                entries = {instance_id: entry for instance_id, entry in entries.items()
+                           if instance_id in existing_instance_ids}
+            now = time.time()
+            for instance_id, tags in fetched_tags.items():
+                entries[instance_id] = {'Tags': tags, 'FetchedAt': now}
+            self._save(entries)
+
+
+class AuthorizedKeysCache(JSONFileCache):
+    """
+    Local record of the SSH public key fingerprints that were already copied into the authorized keys
+    of SSM managed instances, so that reconnects with the same key don't need to publish it again.
+
+    A new container always registers as a new managed instance with a new ID,
+    so the record of a particular instance ID only becomes stale if the key is removed on the instance manually.
+    """
+    logger = logging.getLogger('sagemaker-ssh-helper:AuthorizedKeysCache')
+
+    def __init__(self, path: str, ttl_in_seconds: Optional[int] = 30 * 24 * 3600) -> None:
+        """
+        :param path: the JSON file to store the cache in
+        :param ttl_in_seconds: how long to keep the record of an instance, None for forever
+        """
+        super().__init__(path)
+        self.ttl_in_seconds = ttl_in_seconds
+
+    @classmethod
+    def for_region(cls, region_name: str) -> 'AuthorizedKeysCache':
+        return cls(os.path.join(cls.get_cache_dir(), f"authorized-keys-{region_name}.json"))
+
+    def is_authorized(self, instance_id: str, fingerprint: str) -> bool:
+        with self.lock:
+            entry = self._load().get(instance_id)
+        if not entry or self._is_expired(entry, time.time()):
+            return False
+        return fingerprint in entry['Fingerprints']
+
+    def add(self, instance_id: str, fingerprint: str):
+        with self.lock:
+            now = time.time()
+            entries = {key: entry for key, entry in self._load().items() if not self._is_expired(entry, now)}
+            fingerprints: List[str] = entries.get(instance_id, {}).get('Fingerprints', [])
+            if fingerprint not in fingerprints:
+                fingerprints.append(fingerprint)
+            entries[instance_id] = {'Fingerprints': fingerprints, 'AuthorizedAt': now}
+            self._save(entries)
+
+    def remove(self, instance_id: str, fingerprint: str):
+        with self.lock:
+            entries = self._load()
+            entry = entries.get(instance_id)
+            if not entry or fingerprint not in entry['Fingerprints']:
+                return
+            entry['Fingerprints'].remove(fingerprint)
+            if not entry['Fingerprints']:
+                del entries[instance_id]
+            self._save(entries)
+
+    def _is_expired(self, entry: Dict, now: float) -> bool:
+        return self.ttl_in_seconds is not None and now - entry['AuthorizedAt'] >= self.ttl_in_seconds
+
+
+class DefaultBucketCache(JSONFileCache):
+    """
+    Local record of the SageMaker default bucket resolved for each credential source and region,
+    so that connections don't need to import SageMaker Python SDK and call STS and S3 to find it.
+
+    The bucket doesn't change for the same credentials and region, so the entries don't expire.
+    They are only resolved again when the upload to the cached bucket fails, see
+    :meth:`SSMProxyCommand.refresh_default_bucket()`.
+    """
+    logger = logging.getLogger('sagemaker-ssh-helper:DefaultBucketCache')
+
+    @classmethod
+    def default(cls) -> 'DefaultBucketCache':
+        return cls(os.path.join(cls.get_cache_dir(), "default-bucket.json"))
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self._load().get(key)
+        return entry['Bucket'] if entry else None
+
+    def put(self, key: str, bucket: str):
+        with self.lock:
+            entries = self._load()
+            entries[key] = {'Bucket': bucket, 'ResolvedAt': time.time()}
+            self._save(entries)
+
+    def invalidate(self, key: str):
+        with self.lock:
+            entries = self._load()
+            if entries.pop(key, None) is not None:
+                self._save(entries)
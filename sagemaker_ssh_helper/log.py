@@ -1,34 +1,52 @@
 import logging
 import re
 import time
+from collections import deque
 from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional
 
 import boto3
 from botocore.exceptions import ClientError
 
+from sagemaker_ssh_helper import clients, timings
 from sagemaker_ssh_helper.aws import AWS
 from sagemaker_ssh_helper.manager import SSMManagerBase
 
 
 class SSHLog(SSMManagerBase):
+    MAX_LOG_GROUPS_PER_QUERY = 50
+    # Stream names in these log groups don't start with the resource name, so they can't be filtered by prefix
+    NO_STREAM_PREFIX_LOG_GROUPS = ['/aws/sagemaker/studio']
+
     logger = logging.getLogger('sagemaker-ssh-helper:SSHLog')
 
-    def __init__(self, region_name=None, sleep_between_retries_in_seconds=10, redo_attempts=5) -> None:
+    def __init__(self, region_name=None, sleep_between_retries_in_seconds=10, redo_attempts=5,
+                 query_timeout_in_sec: int = 60,
+                 use_filter_log_events: bool = False) -> None:
+        """
+        :param query_timeout_in_sec: how long to wait for a Logs Insights query before cancelling it
+        :param use_filter_log_events: scan the log streams of the resource with FilterLogEvents
+            instead of Logs Insights queries, which is faster for resources that just started
+        """
         super().__init__(region_name, sleep_between_retries_in_seconds, redo_attempts)
         self.aws_console = AWS(self.region_name)
+        self.query_timeout_in_sec = query_timeout_in_sec
+        self.use_filter_log_events = use_filter_log_events
 
-    def get_ip_addresses(self, training_job_name, retry=0):
+    def get_ip_addresses(self, training_job_name, retry=0, not_earlier_than_timestamp: int = 0):
+        """
+        :param not_earlier_than_timestamp: e.g., the job creation time, to scan only the logs since then
+        """
         self.logger.info(f"Querying SSH IP addresses for job {training_job_name}")
-        query = "fields @timestamp, @logStream, @message" \
-                f"| filter @logStream like '{training_job_name}'" \
-                "| filter @message like /SSH Helper Log IP: [0-9]+/" \
-                "| sort @timestamp desc" \
-                "| limit 20"
         log_group = '/aws/sagemaker/TrainingJobs'
-        lines = self._query_log_group(log_group, query)
+        if self.use_filter_log_events:
+            messages = self._filter_latest_log_events(log_group, f"{training_job_name}/", '"SSH Helper Log IP"',
+                                                      self._to_start_time(not_earlier_than_timestamp), 20)
+        else:
+            messages = self._query_log_group_messages(log_group, training_job_name, "SSH Helper Log IP: [0-9]+",
+                                                      self._to_start_time(not_earlier_than_timestamp))
         ip_addresses = []
-        for line in lines:
-            message = line[2]['value']
+        for message in messages:
             search = re.search('(\\d+\\.\\d+\\.\\d+\\.\\d+.*)', message)
             if search is None:
                 raise AssertionError(f"Cannot find ip address in log message: {message}")
@@ -37,30 +55,91 @@ class SSHLog(SSMManagerBase):
 
         while not ip_addresses and retry > 0:
             self.logger.info(f"SSH Helper not yet started? Retrying. Attempts left: {retry}")
-            ip_addresses = self.get_ip_addresses(training_job_name, 0)
+            ip_addresses = self.get_ip_addresses(training_job_name, 0, not_earlier_than_timestamp)
             time.sleep(10)
             retry -= 1
 
         return ip_addresses
 
-    def get_training_ssm_instance_ids(self, training_job_name, timeout_in_sec=0, expected_count=1):
+    def get_training_ssm_instance_ids(self, training_job_name, timeout_in_sec=0, expected_count=1,
+                                      not_earlier_than_timestamp: int = 0):
         self.logger.warning("SSMManager#get_training_instance_ids() is faster and more stable")
         self.logger.info(f"Querying SSM instance IDs for training job {training_job_name}, "
                          f"expected instance count = {expected_count}")
         return self.get_ssm_instance_ids('/aws/sagemaker/TrainingJobs', training_job_name,
                                          timeout_in_sec=timeout_in_sec,
-                                         expected_count=expected_count)
+                                         expected_count=expected_count,
+                                         not_earlier_than_timestamp=not_earlier_than_timestamp)
 
-    def get_processing_ssm_instance_ids(self, processing_job_name, timeout_in_sec=0):
+    def get_processing_ssm_instance_ids(self, processing_job_name, timeout_in_sec=0,
+                                        not_earlier_than_timestamp: int = 0):
         self.logger.warning("SSMManager#get_processing_instance_ids() is faster and more stable")
         self.logger.info(f"Querying SSM instance IDs for processing job {processing_job_name}")
         return self.get_ssm_instance_ids('/aws/sagemaker/ProcessingJobs', processing_job_name,
-                                         timeout_in_sec=timeout_in_sec)
+                                         timeout_in_sec=timeout_in_sec,
+                                         not_earlier_than_timestamp=not_earlier_than_timestamp)
 
-    def get_endpoint_ssm_instance_ids(self, endpoint_name, timeout_in_sec=0):
+    def get_endpoint_ssm_instance_ids(self, endpoint_name, timeout_in_sec=0, not_earlier_than_timestamp: int = None):
+        """
+        :param not_earlier_than_timestamp: the endpoint creation time, to scan only the logs since then;
+            if not passed, it's taken from DescribeEndpoint
+        """
         self.logger.info(f"Querying SSM instance IDs for endpoint {endpoint_name}")
+        if not_earlier_than_timestamp is None:
+            not_earlier_than_timestamp = self.get_endpoint_creation_timestamp(endpoint_name)
         return self.get_ssm_instance_ids(f'/aws/sagemaker/Endpoints/{endpoint_name}', "AllTraffic/",
-                                         timeout_in_sec=timeout_in_sec)
+                                         timeout_in_sec=timeout_in_sec,
+                                         not_earlier_than_timestamp=not_earlier_than_timestamp)
+
+    def get_endpoint_creation_timestamp(self, endpoint_name) -> int:
+        """
+        :return: the creation time of the endpoint as UNIX timestamp, or 0 if it can't be described
+        """
+        boto_client = timings.count_api_calls_of(clients.get_client('sagemaker', self.region_name))
+        try:
+            return int(boto_client.describe_endpoint(EndpointName=endpoint_name)['CreationTime'].timestamp())
+        except ClientError as e:
+            self.logger.info(f"Failed to describe endpoint {endpoint_name}, scanning the logs for two weeks: {e}")
+            return 0
+
+    def get_endpoints_ssm_instance_ids(self, endpoint_names: List[str],
+                                       not_earlier_than_timestamp: int = 0) -> Dict[str, List[str]]:
+        """
+        Batched version of :meth:`get_endpoint_ssm_instance_ids` that resolves many endpoints with one query
+        per up to 50 log groups instead of one query per endpoint.
+
+        :param not_earlier_than_timestamp: e.g., the creation time of the oldest endpoint,
+            to scan only the logs since then
+        :return: a mapping of endpoint name to the list of its SSM instance IDs, the latest first
+        """
+        self.logger.debug(f"Querying SSM instance IDs for {len(endpoint_names)} endpoints")
+        result: Dict[str, List[str]] = {endpoint_name: [] for endpoint_name in endpoint_names}
+        if not endpoint_names:
+            return result
+        log_group_prefix = '/aws/sagemaker/Endpoints/'
+        # The whole query fails if any of the log groups doesn't exist, so only query the existing ones
+        existing_log_groups = set(self._list_log_group_names(log_group_prefix))
+        log_groups = [f'{log_group_prefix}{endpoint_name}' for endpoint_name in endpoint_names
+                      if f'{log_group_prefix}{endpoint_name}' in existing_log_groups]
+
+        query = "fields @timestamp, @log, @logStream, @message" \
+                "| filter @logStream like 'AllTraffic/'" \
+                "| filter @message like /Successfully registered the instance with AWS SSM using Managed instance-id/" \
+                "| parse @message \"instance-id: *\" as instance_id" \
+                "| stats max(@timestamp) as latest by @log, instance_id" \
+                "| sort latest desc" \
+                "| limit 10000"
+        for i in range(0, len(log_groups), self.MAX_LOG_GROUPS_PER_QUERY):
+            lines = self._query_log_groups(log_groups[i:i + self.MAX_LOG_GROUPS_PER_QUERY], query,
+                                           self._to_start_time(not_earlier_than_timestamp))
+            for line in lines:
+                fields = {field['field']: field['value'] for field in line}
+                # The @log field has the format 'account-id:log-group-name'
+                log_group = fields['@log'].split(':', 1)[-1]
+                endpoint_name = log_group[len(log_group_prefix):]
+                if endpoint_name in result:
+                    result[endpoint_name].append(fields['instance_id'].strip())
+        return result
 
     def get_transformer_ssm_instance_ids(self, transform_job_name, timeout_in_sec=0):
         self.logger.warning("SSMManager#get_transformer_instance_ids() is faster and more stable")
@@ -75,25 +154,32 @@ class SSHLog(SSMManagerBase):
                                          timeout_in_sec=timeout_in_sec)
 
     def get_instance_ids_once(self, arn_resource_type, arn_resource_name, arn_filter_regex: str = None,
-                              not_earlier_than_timestamp: int = 0):
+                              not_earlier_than_timestamp: int = 0, expected_count: int = None):
         if arn_filter_regex:
             raise ValueError("Not supported for SSHLog")
         return self.get_ssm_instance_ids_once(log_group=arn_resource_type, stream_name=arn_resource_name,
-                                              not_earlier_than_timestamp=not_earlier_than_timestamp)
+                                              not_earlier_than_timestamp=not_earlier_than_timestamp,
+                                              expected_count=expected_count)
 
     def get_ssm_instance_ids_once(self, log_group, stream_name,
-                                  not_earlier_than_timestamp: int = 0):
-        if not_earlier_than_timestamp > 0:
-            raise ValueError("Not implemented for SSHLog yet")
-        query = "fields @timestamp, @logStream, @message" \
-                f"| filter @logStream like '{stream_name}'" \
-                "| filter @message like /Successfully registered the instance with AWS SSM using Managed instance-id/" \
-                "| sort @timestamp desc" \
-                "| limit 20"
-        lines = self._query_log_group(log_group, query)
+                                  not_earlier_than_timestamp: int = 0, expected_count: int = None):
+        """
+        :param expected_count: with FilterLogEvents, how many of the latest IDs to return, 20 if not set
+        """
+        start_time = self._to_start_time(not_earlier_than_timestamp)
+        if self.use_filter_log_events and log_group not in self.NO_STREAM_PREFIX_LOG_GROUPS:
+            stream_name_prefix = stream_name if stream_name.endswith('/') else f"{stream_name}/"
+            messages = self._filter_latest_log_events(
+                log_group, stream_name_prefix, '"Successfully registered the instance with AWS SSM"', start_time,
+                expected_count or 20
+            )
+        else:
+            messages = self._query_log_group_messages(
+                log_group, stream_name,
+                "Successfully registered the instance with AWS SSM using Managed instance-id", start_time
+            )
         mi_ids = []
-        for line in lines:
-            message = line[2]['value']
+        for message in messages:
             search = re.search('instance-id: (mi-.+)', message)
             if search is None:
                 raise AssertionError(f"Cannot find instance id in message: {message}")
@@ -104,7 +190,8 @@ class SSHLog(SSMManagerBase):
     def get_ssm_instance_ids(self, log_group, stream_name,
                              retry: int = None, sleep_between_retries_seconds: int = None,
                              timeout_in_sec: int = 900,
-                             expected_count=1):
+                             expected_count=1,
+                             not_earlier_than_timestamp: int = 0):
         if sleep_between_retries_seconds:
             self.logger.warning("Parameter sleep_between_retries_seconds is deprecated, "
                                 "pass it to the constructor instead")
@@ -113,14 +200,109 @@ class SSHLog(SSMManagerBase):
             self.logger.warning("Parameter retry is deprecated, "
                                 "use timeout_in_sec instead")
             timeout_in_sec = retry * self.sleep_between_retries_in_seconds
-        return self.get_instance_ids(log_group, stream_name, timeout_in_sec, expected_count)
+        return self.get_instance_ids(log_group, stream_name, timeout_in_sec, expected_count,
+                                     not_earlier_than_timestamp=not_earlier_than_timestamp)
 
-    def _query_log_group(self, log_group, query):
-        boto_client = boto3.client('logs', region_name=self.region_name)
+    def _query_log_group_messages(self, log_group, stream_name, message_regex,
+                                  start_time: Optional[datetime] = None) -> List[str]:
+        query = "fields @timestamp, @logStream, @message" \
+                f"| filter @logStream like '{stream_name}'" \
+                f"| filter @message like /{message_regex}/" \
+                "| sort @timestamp desc" \
+                "| limit 20"
+        lines = self._query_log_group(log_group, query, start_time)
+        return [line[2]['value'] for line in lines]
+
+    def _filter_latest_log_events(self, log_group, stream_name_prefix, filter_pattern,
+                                  start_time: Optional[datetime], max_count: int) -> List[str]:
+        """
+        The latest matching message of each log stream, the newest streams first, e.g., the latest registration
+        of each instance. FilterLogEvents returns the events the oldest first, so the streams are read one by one,
+        and the older ones, e.g., of the instances before restarts, are not read at all after max_count messages.
+        """
+        start_time = self._limit_start_time(start_time)
+        start_time_ms = int(start_time.timestamp() * 1000)
+        boto_client = timings.count_api_calls_of(clients.get_client('logs', self.region_name))
+        paginator = boto_client.get_paginator('describe_log_streams')
+        try:
+            # Can't be ordered by time on the server side together with the prefix
+            log_streams = [log_stream
+                           for page in paginator.paginate(logGroupName=log_group,
+                                                          logStreamNamePrefix=stream_name_prefix)
+                           for log_stream in page['logStreams']
+                           if log_stream.get('lastIngestionTime', start_time_ms) >= start_time_ms]
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ResourceNotFoundException":
+                return []
+            raise
+        log_streams.sort(key=lambda log_stream: log_stream['creationTime'], reverse=True)
+        messages = []
+        for log_stream in log_streams:
+            if len(messages) >= max_count:
+                break
+            messages.extend(deque(self._filter_log_events(log_group, log_stream['logStreamName'], filter_pattern,
+                                                          start_time), maxlen=1))
+        return messages
+
+    def _filter_log_events(self, log_group, log_stream_name, filter_pattern,
+                           start_time: Optional[datetime] = None) -> Iterator[str]:
+        """
+        Lazily yields messages of matching log events in the stream, the oldest first,
+        fetching the next page only when needed.
+        """
+        start_time = self._limit_start_time(start_time)
+        boto_client = timings.count_api_calls_of(clients.get_client('logs', self.region_name))
+        paginator = boto_client.get_paginator('filter_log_events')
+        try:
+            for page in paginator.paginate(logGroupName=log_group,
+                                           logStreamNames=[log_stream_name],
+                                           filterPattern=filter_pattern,
+                                           startTime=int(start_time.timestamp() * 1000)):
+                for event in page['events']:
+                    yield event['message']
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ResourceNotFoundException":
+                return
+            raise
+
+    def _list_log_group_names(self, log_group_prefix) -> List[str]:
+        boto_client = timings.count_api_calls_of(clients.get_client('logs', self.region_name))
+        paginator = boto_client.get_paginator('describe_log_groups')
+        return [log_group['logGroupName']
+                for page in paginator.paginate(logGroupNamePrefix=log_group_prefix)
+                for log_group in page['logGroups']]
+
+    @staticmethod
+    def _limit_start_time(start_time: Optional[datetime]) -> datetime:
+        # CloudWatch Logs are scanned for at most two weeks back
+        two_weeks_ago = datetime.now() - timedelta(weeks=2)
+        if start_time is None or start_time < two_weeks_ago:
+            return two_weeks_ago
+        return start_time
+
+    @staticmethod
+    def _to_start_time(not_earlier_than_timestamp: int) -> Optional[datetime]:
+        if not not_earlier_than_timestamp:
+            return None
+        # Tolerate the clock skew between the local machine and the remote instance
+        return datetime.fromtimestamp(not_earlier_than_timestamp) - timedelta(minutes=5)
+
+    def _query_log_group(self, log_group, query, start_time: Optional[datetime] = None):
+        return self._query_log_groups([log_group], query, start_time)
+
+    def _query_log_groups(self, log_groups: List[str], query, start_time: Optional[datetime] = None):
+        """
+        :param start_time: the beginning of the time window to scan, e.g., the resource creation time;
+            if not set, scans the last two weeks
+        """
+        if not log_groups:
+            return []
+        start_time = self._limit_start_time(start_time)
+        boto_client = timings.count_api_calls_of(clients.get_client('logs', self.region_name))
         try:
             start_query_response = boto_client.start_query(
-                logGroupName=log_group,
-                startTime=int((datetime.now() - timedelta(weeks=2)).timestamp()),
+                logGroupNames=log_groups,
+                startTime=int(start_time.timestamp()),
                 endTime=int(datetime.now().timestamp()),
                 queryString=query
             )
@@ -135,13 +317,25 @@ class SSHLog(SSMManagerBase):
                 raise
 
         query_id = start_query_response['queryId']
+        deadline = time.monotonic() + self.query_timeout_in_sec
+        poll_interval = 0.25
         response = None
-        while response is None or response['status'] == 'Running':
-            time.sleep(1)
+        while response is None or response['status'] in ['Scheduled', 'Running']:
+            if time.monotonic() >= deadline:
+                self.logger.warning(f"Query {query_id} didn't complete in {self.query_timeout_in_sec} seconds, "
+                                    f"cancelling it and returning partial results")
+                try:
+                    boto_client.stop_query(queryId=query_id)
+                except ClientError as e:
+                    # The query could complete in the meantime
+                    self.logger.info(f"Failed to stop query {query_id}: {e}")
+                break
+            time.sleep(min(poll_interval, max(0.0, deadline - time.monotonic())))
+            poll_interval = min(poll_interval * 1.5, 2.0)
             response = boto_client.get_query_results(
                 queryId=query_id
             )
-        lines = response['results']
+        lines = response['results'] if response else []
         return lines
 
     def get_training_cloudwatch_url(self, training_job_name):
@@ -1,23 +1,104 @@
 import logging
+import random
+import threading
 import time
 from abc import abstractmethod, ABC
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
-from typing import Dict
+from botocore.exceptions import ClientError
+from typing import Callable, Dict, List, Optional, Tuple
 
 import re
 
+from sagemaker_ssh_helper import clients, timings
+from sagemaker_ssh_helper.inventory_cache import SSMInventoryCache
+
+
+class InstanceIdsWaiter:
+    """
+    Polls a readiness source, e.g., the SSM inventory or the logs, with exponential backoff
+    until the expected number of instances is visible or the deadline is reached.
+    An external notification, e.g., from an EventBridge or SNS listener, wakes up the waiter immediately.
+    """
+    logger = logging.getLogger('sagemaker-ssh-helper:InstanceIdsWaiter')
+
+    def __init__(self, fetch_instance_ids: Callable[[], List[str]],
+                 initial_interval_in_seconds: float = 1.0,
+                 max_interval_in_seconds: float = 10.0,
+                 backoff_multiplier: float = 2.0,
+                 notification: threading.Event = None) -> None:
+        super().__init__()
+        self.fetch_instance_ids = fetch_instance_ids
+        self.initial_interval_in_seconds = initial_interval_in_seconds
+        self.max_interval_in_seconds = max_interval_in_seconds
+        self.backoff_multiplier = backoff_multiplier
+        self.notification = notification or threading.Event()
+
+    def notify(self):
+        self.notification.set()
+
+    def wait(self, timeout_in_sec: float, expected_count: int = 1,
+             redo_attempts: Optional[int] = None) -> List[str]:
+        """
+        :param timeout_in_sec: the total deadline, 0 to fetch only once
+        :param redo_attempts: if set, how long to keep waiting after some, but not all, instances are found,
+            in the number of max intervals
+        :return: the instance IDs found by the last attempt
+        """
+        deadline = time.monotonic() + timeout_in_sec
+        redo_deadline = None
+        interval = self.initial_interval_in_seconds
+        mi_ids = self.fetch_instance_ids()
+        while len(mi_ids) < expected_count:
+            time_left = deadline - time.monotonic()
+            if time_left <= 0:
+                break
+            if mi_ids:
+                if redo_attempts is not None:
+                    if redo_deadline is None:
+                        # Measured in time, so that the fast polls in the beginning of the backoff don't use it up
+                        redo_deadline = time.monotonic() + redo_attempts * self.max_interval_in_seconds
+                    time_left = min(time_left, redo_deadline - time.monotonic())
+                    if time_left <= 0:
+                        break
+                self.logger.info(f"Got {len(mi_ids)} of {expected_count} instance IDs, waiting for others to catchup. "
+                                 f"Seconds left: {int(time_left)}")
+            else:
+                self.logger.info(f"No instance IDs found. Seconds left before time out: {int(time_left)}")
+            if self.notification.wait(min(interval, time_left)):
+                self.notification.clear()
+            interval = min(interval * self.backoff_multiplier, self.max_interval_in_seconds)
+            mi_ids = self.fetch_instance_ids()
+        return mi_ids
+
 
 class SSMManagerBase(ABC):
     logger = logging.getLogger('sagemaker-ssh-helper:SSMManagerBase')
 
     def __init__(self, region_name: str = None,
                  sleep_between_retries_in_seconds: int = 10,
-                 redo_attempts: int = 5) -> None:
+                 redo_attempts: int = 5,
+                 initial_sleep_between_retries_in_seconds: float = 1) -> None:
+        """
+        :param sleep_between_retries_in_seconds: the max interval between the attempts to fetch instance IDs
+        :param initial_sleep_between_retries_in_seconds: the first interval, doubled after every attempt
+        :param redo_attempts: how many more attempts to make when fewer than expected instances are found
+        """
         super().__init__()
         self.region_name = region_name or boto3.session.Session().region_name
         self.sleep_between_retries_in_seconds = sleep_between_retries_in_seconds
+        self.initial_sleep_between_retries_in_seconds = initial_sleep_between_retries_in_seconds
         self.redo_attempts = redo_attempts
+        self.instances_notification = threading.Event()
+
+    def notify_instances_changed(self):
+        """
+        Wakes up :meth:`get_instance_ids` to check for instances without waiting for the next attempt,
+        e.g., when a notification about a new SSM registration is pushed from outside.
+        """
+        self.instances_notification.set()
 
     def get_instance_ids(self, arn_resource_type, arn_resource_name,
                          timeout_in_sec=0,
@@ -28,74 +109,228 @@ class SSMManagerBase(ABC):
             self.logger.warning("SageMaker resource name usually doesn't not start with 'mi-', "
                                 "did you pass the SSM instance ID by mistake?")
         self.logger.info("Using AWS Region: %s", self.region_name)
-        mi_ids = self.get_instance_ids_once(arn_resource_type, arn_resource_name, arn_filter_regex,
-                                            not_earlier_than_timestamp)
-
-        while not mi_ids and timeout_in_sec > 0:
-            self.logger.info(f"No instance IDs found. Seconds left before time out: {timeout_in_sec}")
-            time.sleep(self.sleep_between_retries_in_seconds)
-            mi_ids = self.get_instance_ids_once(arn_resource_type, arn_resource_name, arn_filter_regex,
-                                                not_earlier_than_timestamp)
-            timeout_in_sec -= self.sleep_between_retries_in_seconds
-
-        self.logger.info(f"Got preliminary SSM instance IDs: {mi_ids}")
-
-        redo_attempts = self.redo_attempts
-        while len(mi_ids) < expected_count and redo_attempts > 0 and timeout_in_sec > 0:
-            self.logger.info(f"Re-fetch results for other instances to catchup. Attempts left: {redo_attempts}")
-            time.sleep(30)
-            mi_ids = self.get_instance_ids_once(arn_resource_type, arn_resource_name, arn_filter_regex,
-                                                not_earlier_than_timestamp)
-            redo_attempts -= 1
+
+        with timings.span('resolve-instance-ids', resource_type=arn_resource_type,
+                          resource_name=arn_resource_name) as timing_span:
+            def fetch_instance_ids():
+                timing_span.add_attempt()
+                return self.get_instance_ids_once(arn_resource_type, arn_resource_name, arn_filter_regex,
+                                                  not_earlier_than_timestamp, expected_count)
+
+            waiter = InstanceIdsWaiter(
+                fetch_instance_ids,
+                initial_interval_in_seconds=min(self.initial_sleep_between_retries_in_seconds,
+                                                self.sleep_between_retries_in_seconds),
+                max_interval_in_seconds=self.sleep_between_retries_in_seconds,
+                notification=self.instances_notification
+            )
+            mi_ids = waiter.wait(timeout_in_sec, expected_count, self.redo_attempts)
 
         self.logger.info(f"Got final SSM instance IDs: {mi_ids}")
         return mi_ids
 
     @abstractmethod
     def get_instance_ids_once(self, arn_resource_type, arn_resource_name, arn_filter_regex: str = None,
-                              not_earlier_than_timestamp: int = 0):
+                              not_earlier_than_timestamp: int = 0, expected_count: int = None):
+        """
+        :param expected_count: a hint that the lookup can stop once this many instances are found
+        """
         raise NotImplementedError("Abstract method")
 
 
+class SSMInstanceIndex:
+    """
+    Index of SSM managed instances by the SageMaker resource type and name parsed from the SSHResourceArn tag,
+    e.g., ('training-job', 'ssh-job') or ('app', 'default'). Instances of each resource are sorted
+    by SSHTimestamp, the latest first.
+    """
+
+    def __init__(self, managed_instances: Dict[str, Dict[str, str]]) -> None:
+        super().__init__()
+        self.managed_instances = managed_instances
+        self.index: Dict[Tuple[str, str], List[Tuple[int, str]]] = defaultdict(list)
+        for mi_id, tags in managed_instances.items():
+            resource = self.parse_arn(tags.get('SSHResourceArn', ''))
+            if resource:
+                self.index[resource].append((self.get_timestamp(tags), mi_id))
+        for instances in self.index.values():
+            # Stable sort keeps the inventory order for the same timestamps
+            instances.sort(key=lambda i: i[0], reverse=True)
+
+    @staticmethod
+    def parse_arn(arn: str) -> Optional[Tuple[str, str]]:
+        """
+        :param arn: e.g., arn:aws:sagemaker:eu-west-1:555555555555:app/d-0123456789ab/user/JupyterServer/default
+        :return: resource type and resource name, e.g., ('app', 'default'), or None if not a resource ARN
+        """
+        parts = arn.split(':', 5)
+        if len(parts) < 6 or '/' not in parts[5]:
+            return None
+        resource = parts[5]
+        return resource.split('/', 1)[0], resource.rsplit('/', 1)[1]
+
+    @staticmethod
+    def get_timestamp(tags: Dict[str, str]) -> int:
+        return int(tags['SSHTimestamp']) if 'SSHTimestamp' in tags else 0
+
+    def find_instance_ids(self, resource_type: str, resource_name: str,
+                          tags_filter: Callable[[Dict[str, str]], bool] = None,
+                          not_earlier_than_timestamp: int = 0) -> List[str]:
+        """
+        :return: instance IDs of the resource, the latest first
+        """
+        return [mi_id for timestamp, mi_id in self.index.get((resource_type, resource_name), [])
+                if timestamp >= not_earlier_than_timestamp
+                and (tags_filter is None or tags_filter(self.managed_instances[mi_id]))]
+
+    def find_latest_instance_id(self, resource_type: str, resource_name: str,
+                                tags_filter: Callable[[Dict[str, str]], bool] = None) -> Optional[str]:
+        instance_ids = self.find_instance_ids(resource_type, resource_name, tags_filter)
+        return instance_ids[0] if instance_ids else None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket to keep the rate of API calls under the service limits.
+    """
+
+    def __init__(self, rate_per_second: float, capacity: int = None) -> None:
+        super().__init__()
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity or max(1, int(rate_per_second))
+        self.tokens = float(self.capacity)
+        self.last_refill_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last_refill_time) * self.rate_per_second)
+                self.last_refill_time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate_per_second
+            time.sleep(wait_time)
+
+
 class SSMManager(SSMManagerBase):
     PING_STATUS = '$__SSMManager__.PingStatus'
+    THROTTLING_ERROR_CODES = ['ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded']
 
     logger = logging.getLogger('sagemaker-ssh-helper:SSMManager')
 
     def __init__(self, region_name=None, sleep_between_retries_in_seconds=10, redo_attempts=5,
-                 clock_timestamp_override=None) -> None:
+                 clock_timestamp_override=None, use_tag_filters=True,
+                 tag_fetch_concurrency: int = 10,
+                 tag_fetch_rate_per_second: float = 20,
+                 tag_fetch_throttling_retries: int = 5,
+                 inventory_cache: bool = True) -> None:
+        """
+        :param inventory_cache: keep the immutable instance tags in a local cache for the current credentials
+            and region, see :class:`SSMInventoryCache`, to fetch tags only for the new instances
+        :param tag_fetch_concurrency: number of threads fetching instance tags in parallel, 1 to fetch serially
+        :param tag_fetch_rate_per_second: upper bound for the rate of ListTagsForResource calls
+        :param tag_fetch_throttling_retries: how many times to retry a throttled call with jittered backoff
+        """
         super().__init__(region_name, sleep_between_retries_in_seconds, redo_attempts)
         self.clock_timestamp_override = clock_timestamp_override
-
-    def list_all_instances_and_fetch_tags(self) -> Dict[str, Dict[str, str]]:
+        self.use_tag_filters = use_tag_filters
+        self.tag_fetch_concurrency = tag_fetch_concurrency
+        self.tag_fetch_throttling_retries = tag_fetch_throttling_retries
+        self.tag_fetch_rate_limiter = TokenBucket(tag_fetch_rate_per_second)
+        self.inventory_cache = None
+        if inventory_cache and self.region_name:
+            # The shared clients are created from the default session, see clients.py
+            profile_name = (boto3.DEFAULT_SESSION or boto3.session.Session()).profile_name
+            self.inventory_cache = SSMInventoryCache.for_region(self.region_name, profile_name)
+
+    def list_all_instances_and_fetch_tags(self,
+                                          tag_filters: Optional[Dict[str, List[str]]] = None
+                                          ) -> Dict[str, Dict[str, str]]:
         """
+        :param tag_filters: an optional mapping of tag key to the list of accepted values,
+            applied on the SSM side to narrow down the inventory before fetching the tags;
+            if SSM rejects the filters, falls back to the full scan
         :return: a mapping of instance ID to the dictionary of tags
         """
-        ssm = boto3.client('ssm', region_name=self.region_name)
+        ssm = timings.count_api_calls_of(clients.get_client('ssm', self.region_name))
+
+        filters = [{'Key': 'ResourceType', 'Values': ['ManagedInstance']}]
+        if tag_filters:
+            filters += [{'Key': f"tag:{key}", 'Values': values} for key, values in tag_filters.items()]
+
+        cached_tags = self.inventory_cache.get_tags() if self.inventory_cache else {}
+
+        # Tags are fetched in the background while the next pages are being retrieved
+        tags_futures = {}
+        ping_statuses = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.tag_fetch_concurrency)) as executor:
+            next_page_id = ""
+            while next_page_id is not None:
+                try:
+                    response = ssm.describe_instance_information(
+                        Filters=filters,
+                        NextToken=next_page_id,
+                        MaxResults=50,
+                    )
+                except ClientError as e:
+                    if tag_filters and e.response["Error"]["Code"] in ['InvalidFilterKey',
+                                                                        'InvalidInstanceInformationFilterValue']:
+                        self.logger.warning("SSM rejected tag filters, falling back to the full scan: "
+                                            + e.response["Error"]["Message"])
+                        return self.list_all_instances_and_fetch_tags()
+                    raise
+                next_page_id = response.get('NextToken')
+                info_list = response['InstanceInformationList']
+                if info_list:
+                    for info in info_list:
+                        instance_id = info['InstanceId']
+                        if instance_id not in cached_tags:
+                            tags_futures[instance_id] = executor.submit(self._fetch_instance_tags, ssm, instance_id)
+                        ping_statuses[instance_id] = info['PingStatus']
+
+            fetched_tags = {instance_id: tags_future.result() for instance_id, tags_future in tags_futures.items()}
+
+        self.logger.info(f"Fetched tags for {len(fetched_tags)} of {len(ping_statuses)} instances, "
+                         f"the rest are cached")
+        if self.inventory_cache:
+            # A filtered listing doesn't contain all instances, so it cannot tell which ones are gone
+            self.inventory_cache.update(fetched_tags, None if tag_filters else ping_statuses.keys())
 
         result = {}
-        next_page_id = ""
-        while next_page_id is not None:
-            response = ssm.describe_instance_information(
-                Filters=[{'Key': 'ResourceType', 'Values': ['ManagedInstance']}],
-                NextToken=next_page_id,
-                MaxResults=50,
-            )
-            next_page_id = response.get('NextToken')
-            info_list = response['InstanceInformationList']
-            if info_list:
-                for info in info_list:
-                    instance_id = info['InstanceId']
-                    tags = ssm.list_tags_for_resource(ResourceType='ManagedInstance', ResourceId=instance_id)
-                    tags_dict = {}
-                    if 'TagList' in tags:
-                        for tag in tags['TagList']:
-                            tags_dict[tag['Key']] = tag['Value']
-                    tags_dict[SSMManager.PING_STATUS] = info['PingStatus']
-                    result[instance_id] = tags_dict
+        for instance_id, ping_status in ping_statuses.items():
+            tags_dict = dict(fetched_tags[instance_id] if instance_id in fetched_tags else cached_tags[instance_id])
+            tags_dict[SSMManager.PING_STATUS] = ping_status
+            result[instance_id] = tags_dict
 
         return result
 
+    def _fetch_instance_tags(self, ssm, instance_id) -> Dict[str, str]:
+        attempt = 0
+        while True:
+            self.tag_fetch_rate_limiter.acquire()
+            try:
+                tags = ssm.list_tags_for_resource(ResourceType='ManagedInstance', ResourceId=instance_id)
+                break
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in SSMManager.THROTTLING_ERROR_CODES \
+                        or attempt >= self.tag_fetch_throttling_retries:
+                    raise
+                # Full jitter backoff, see https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+                backoff = random.uniform(0, min(10.0, 0.2 * 2 ** attempt))  # nosec B311  # not for crypto
+                self.logger.info(f"Throttled while fetching tags for {instance_id}, retrying in {backoff:.2f} s")
+                time.sleep(backoff)
+                attempt += 1
+
+        tags_dict = {}
+        if 'TagList' in tags:
+            for tag in tags['TagList']:
+                tags_dict[tag['Key']] = tag['Value']
+        return tags_dict
+
     def get_training_instance_ids(self, training_job_name, timeout_in_sec=0, expected_count=1):
         self.logger.info(f"Querying SSM instance IDs for training job {training_job_name}, "
                          f"expected instance count = {expected_count}")
@@ -136,29 +371,21 @@ class SSMManager(SSMManagerBase):
 
     def get_instance_ids_once(self, arn_resource_type, arn_resource_name,
                               arn_filter_regex: str = None,
-                              not_earlier_than_timestamp: int = 0):
-        # TODO: use tag filter instead, for faster performance
-        all_instances = self.list_all_instances_and_fetch_tags()
-        result_pairs = []
-        for mi_id in all_instances:
-            tags = all_instances[mi_id]
-            if "SSHResourceName" not in tags or "SSHResourceArn" not in tags:
-                continue
-            if f"/{arn_resource_name}" in tags["SSHResourceArn"] and \
-                    arn_resource_name == tags["SSHResourceName"] and \
-                    f":{arn_resource_type}/" in tags["SSHResourceArn"] and \
-                    (not arn_filter_regex or re.search(arn_filter_regex, tags["SSHResourceArn"]) is not None):
-                if "SSHTimestamp" in tags:
-                    timestamp = int(tags["SSHTimestamp"])
-                else:
-                    timestamp = 0
-                if timestamp < not_earlier_than_timestamp:
-                    continue
-                result_pairs.append((mi_id, timestamp))
-
-        result_pairs.sort(key=lambda i: i[1], reverse=True)
-        result = [i[0] for i in result_pairs]
-        return result
+                              not_earlier_than_timestamp: int = 0, expected_count: int = None):
+        if self.use_tag_filters:
+            all_instances = self.list_all_instances_and_fetch_tags(
+                tag_filters={'SSHResourceName': [arn_resource_name]}
+            )
+        else:
+            all_instances = self.list_all_instances_and_fetch_tags()
+
+        def matches_tags(tags):
+            return tags.get("SSHResourceName") == arn_resource_name and \
+                (not arn_filter_regex or re.search(arn_filter_regex, tags["SSHResourceArn"]) is not None)
+
+        return SSMInstanceIndex(all_instances).find_instance_ids(
+            arn_resource_type, arn_resource_name, matches_tags, not_earlier_than_timestamp
+        )
 
     def list_expired_ssh_instances(self, expiration_days=0):
         all_instances = self.list_all_instances_and_fetch_tags()
@@ -190,7 +417,7 @@ class SSMManager(SSMManagerBase):
         return expired_instances
 
     def get_ssh_instance_timestamp(self, instance_id):
-        ssm = boto3.client('ssm', region_name=self.region_name)
+        ssm = clients.get_client('ssm', self.region_name)
         tags = ssm.list_tags_for_resource(ResourceType='ManagedInstance', ResourceId=instance_id)
         tag_list = tags['TagList']
 
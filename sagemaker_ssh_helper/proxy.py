@@ -1,22 +1,35 @@
+import atexit
 import logging
 import os
+import shutil
 import socket
 import subprocess
 import sys
+import tempfile
 import time
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue, Empty
-from threading import Thread
-from typing import Optional
+from threading import Thread, Lock
+from typing import List, Optional, TextIO
 
 import psutil
 
+from sagemaker_ssh_helper import timings
+
 
 class SSMProxy(ABC):
     logger = logging.getLogger('sagemaker-ssh-helper')
 
     def __init__(self, ssh_listen_port: int, extra_args: str = "", region_name: str = None,
-                 cloudwatch_url: str = None) -> None:
+                 cloudwatch_url: str = None, use_control_master: bool = True,
+                 reuse_ssh_key: bool = False) -> None:
+        """
+        :param use_control_master: after connecting, keep one OpenSSH master connection
+            and run all subsequent commands and port forwards through it, instead of a new SSH handshake each time
+        :param reuse_ssh_key: don't generate a new ~/.ssh/sagemaker-ssh-gw key if it exists,
+            e.g., when opening several sessions to the same instance at once
+        """
         super().__init__()
         self.cloudwatch_url = cloudwatch_url
         self.p: Optional[subprocess.Popen] = None
@@ -26,6 +39,12 @@ class SSMProxy(ABC):
         self.extra_args = extra_args
         self.ssh_listen_port = ssh_listen_port
         self.connected = False
+        self.use_control_master = use_control_master and not sys.platform.startswith('win')
+        self.control_dir: Optional[str] = None
+        self.control_keepalive: Optional[subprocess.Popen] = None
+        self.host_key_fetched = False
+        self.forward_processes: List[subprocess.Popen] = []
+        self.reuse_ssh_key = reuse_ssh_key
 
     def connect_to_ssm_instance(self, instance_id) -> None:
         if self.connected:
@@ -45,6 +64,11 @@ class SSMProxy(ABC):
 
         env["LC_ALL"] = "C"
 
+        ssh_key = os.path.expanduser("~/.ssh/sagemaker-ssh-gw")
+        if self.reuse_ssh_key and os.path.exists(ssh_key):
+            # sm-connect-ssh-proxy generates a new key only when SSH_KEY is not set
+            env["SSH_KEY"] = ssh_key
+
         # The script will create a new SSH key in ~/.ssh/sagemaker-ssh-gw
         #   and transfer the public key ~/.ssh/sagemaker-ssh-gw.pub to the instance via S3
         self.p = subprocess.Popen(
@@ -73,7 +97,7 @@ class SSMProxy(ABC):
 
         self.logger.info(f"Getting remote system information as a health check")
 
-        output = self.run_command_with_output("uname -a 2>&1")
+        output = self._run_command_with_output("uname -a 2>&1", timing_phase='health-check')
         output_str = output.decode("latin1")
 
         self.logger.info("Got output from the remote: " + output_str.replace("\n", " "))
@@ -84,6 +108,92 @@ class SSMProxy(ABC):
         self.connected = True
         self.logger.info(f"Connected to remote instance {instance_id}")
 
+        if self.use_control_master:
+            self._start_control_master()
+
+    def get_control_path(self) -> Optional[str]:
+        if not self.control_dir:
+            return None
+        return os.path.join(self.control_dir, 'master')
+
+    def _start_control_master(self):
+        # Unix socket paths are limited to ~100 chars, so the socket is created in a short private temp dir
+        self.control_dir = tempfile.mkdtemp(prefix='sm-ssh-')
+        self.logger.info(f"Starting SSH master connection with control path {self.get_control_path()}")
+        with timings.span('ssh-control-master'):
+            # The master exits after 10 minutes without sessions, in case this process dies without disconnect()
+            retval = subprocess.call(
+                self._ssh_args(control_master="yes") + ["-f", "-N", "-o", "ControlPersist=10m"] +
+                "-o PasswordAuthentication=no -o ConnectTimeout=120 -o ServerAliveInterval=15 -o ServerAliveCountMax=8"
+                .split(' '),
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+        if retval != 0:
+            self.logger.warning(f"Failed to start SSH master connection, return value: {retval}. "
+                                f"Commands will use separate connections.")
+            self._remove_control_dir()
+            return
+        # Port forwards don't count as sessions, so a remote `cat` keeps the master alive while this process runs,
+        #   and ends with EOF when the pipe is closed, even if the process is killed
+        self.control_keepalive = subprocess.Popen(
+            self._ssh_args() + ["cat"],
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        atexit.register(self._stop_control_master)
+
+    def _stop_control_master(self):
+        if not self.get_control_path():
+            return
+        self.logger.info("Stopping SSH master connection")
+        atexit.unregister(self._stop_control_master)
+        keepalive, self.control_keepalive = self.control_keepalive, None
+        if keepalive is not None:
+            keepalive.stdin.close()
+        subprocess.call(self._ssh_args() + ["-O", "exit"],
+                        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if keepalive is not None:
+            try:
+                keepalive.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                keepalive.kill()
+        self._remove_control_dir()
+
+    def _remove_control_dir(self):
+        if self.control_dir:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+
+    def _ssh_args(self, control_master: Optional[str] = "auto"):
+        args = f"ssh -4 root@localhost -p {self.ssh_listen_port} -i ~/.ssh/sagemaker-ssh-gw".split(' ')
+        control_path = self.get_control_path()
+        if control_path and control_master:
+            # ControlMaster=auto makes ssh fall back to a new connection, if the master has died
+            args += ["-o", f"ControlMaster={control_master}", "-o", f"ControlPath={control_path}"]
+        return args
+
+    def forward_port(self, local_port: int, remote_port: int, remote: bool = False):
+        """
+        Forward the local port to the remote port, or with `remote=True` the remote port to the local port,
+        akin to -L and -R options of SSH, through the master connection when it's available.
+        """
+        option = "-R" if remote else "-L"
+        if remote:
+            spec = f"localhost:{remote_port}:localhost:{local_port}"
+        else:
+            spec = f"localhost:{local_port}:localhost:{remote_port}"
+        if self.get_control_path():
+            retval = subprocess.call(self._ssh_args() + ["-O", "forward", option, spec])
+            if retval == 0:
+                return
+            self.logger.warning(f"Failed to forward port through the master connection, return value: {retval}")
+        self.forward_processes.append(subprocess.Popen(
+            self._ssh_args(control_master=None) + ["-N", "-o", "ExitOnForwardFailure=yes",
+                                                   "-o", "StrictHostKeyChecking=no",
+                                                   "-o", "UserKnownHostsFile=/dev/null",
+                                                   option, spec],
+            stdin=subprocess.DEVNULL
+        ))
+
     def terminate_waiting_loop(self):
         self.logger.info("Terminating the remote waiting loop / sleep process")
         retval = self.run_command("sm-wait stop")
@@ -97,38 +207,62 @@ class SSMProxy(ABC):
 
     def run_command(self, command):
         retval = subprocess.call(
-            f"ssh -4 root@localhost -p {self.ssh_listen_port}"
-            " -i ~/.ssh/sagemaker-ssh-gw"
-            " -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null"
+            self._ssh_args() +
+            "-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null"
             f" {command}"
             .split(' '))
         return retval
 
+    def start_command(self, command, **kwargs) -> subprocess.Popen:
+        """
+        Start the remote command without waiting for it to finish, e.g., to stream its output.
+
+        :param kwargs: passed to subprocess.Popen()
+        """
+        env = os.environ.copy()
+        env["LC_ALL"] = "C"
+        return subprocess.Popen(
+            self._ssh_args() +
+            "-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null"
+            f" {command}"
+            .split(' '),
+            env=env,
+            **kwargs
+        )
+
     def run_command_with_output(self, command):
+        return self._run_command_with_output(command, timing_phase='ssh-command')
+
+    def _run_command_with_output(self, command, timing_phase):
         self.logger.info(f"Running command and capturing output: '{command}'")
-        self._wait_for_tcp_port(timeout=120)
+        if not self.get_control_path():
+            self._wait_for_tcp_port(timeout=120)
 
         try:
-            # Pre-fetching the key to avoid the 'Warning: Permanently added ... to the list of known hosts' in output
-            retval = os.system(f"ssh-keyscan -4 -H -T 120 -p {self.ssh_listen_port} localhost >>~/.ssh/known_hosts")  # nosec start_process_with_a_shell
-            if retval != 0:
-                self.logger.error(f"Failed to fetch host key. Return value is not zero: {retval}.")
-                # No exception here, need to try the command anyway
+            if not self.host_key_fetched:
+                # Pre-fetching the key to avoid the 'Warning: Permanently added ... to the list of known hosts' in output
+                with timings.span('ssh-keyscan'):
+                    retval = os.system(f"ssh-keyscan -4 -H -T 120 -p {self.ssh_listen_port} localhost >>~/.ssh/known_hosts")  # nosec start_process_with_a_shell
+                if retval != 0:
+                    self.logger.error(f"Failed to fetch host key. Return value is not zero: {retval}.")
+                    # No exception here, need to try the command anyway
+                else:
+                    self.host_key_fetched = True
 
             env = os.environ.copy()
             env["LC_ALL"] = "C"
 
-            return subprocess.check_output(
-                f"ssh -4 root@localhost -p {self.ssh_listen_port}"
-                " -i ~/.ssh/sagemaker-ssh-gw"
-                " -o PasswordAuthentication=no"
-                " -o ConnectTimeout=120"
-                " -o ServerAliveInterval=15 -o ServerAliveCountMax=8"
-                f" {command}"
-                .split(' '),
-                stderr=subprocess.STDOUT,
-                env=env
-            )
+            with timings.span(timing_phase):
+                return subprocess.check_output(
+                    self._ssh_args() +
+                    "-o PasswordAuthentication=no"
+                    " -o ConnectTimeout=120"
+                    " -o ServerAliveInterval=15 -o ServerAliveCountMax=8"
+                    f" {command}"
+                    .split(' '),
+                    stderr=subprocess.STDOUT,
+                    env=env
+                )
         except subprocess.CalledProcessError as e:
             out = e.output.decode('latin1')
             proxy_out = self.fetch_proxy_output()
@@ -159,20 +293,26 @@ class SSMProxy(ABC):
         # Use 127.0.0.1 here to avoid AF_INET6 resolution that can give errors
         self.logger.info(f"Waiting for connection to become available on 127.0.0.1:{self.ssh_listen_port}")
         is_timeout = True
-        for i in range(0, timeout):
-            try:
-                with socket.create_connection(("127.0.0.1", self.ssh_listen_port), 2):
-                    is_timeout = False
-                    self.logger.info(f"Connection to 127.0.0.1:{self.ssh_listen_port} is successful")
-                    break
-            except ConnectionRefusedError:
-                time.sleep(1)
+        with timings.span('wait-for-tcp-port', port=self.ssh_listen_port) as timing_span:
+            for i in range(0, timeout):
+                timing_span.add_attempt()
+                try:
+                    with socket.create_connection(("127.0.0.1", self.ssh_listen_port), 2):
+                        is_timeout = False
+                        self.logger.info(f"Connection to 127.0.0.1:{self.ssh_listen_port} is successful")
+                        break
+                except ConnectionRefusedError:
+                    time.sleep(1)
         if is_timeout:
             self.logger.warning(f"Timeout waiting for connection on 127.0.0.1:{self.ssh_listen_port}")
 
     def disconnect(self):
         self.logger.info(f"Disconnecting proxy and stopping SSH port forwarding")
         self.connected = False
+        for process in self.forward_processes:
+            process.terminate()
+        self.forward_processes = []
+        self._stop_control_master()
         parent = psutil.Process(self.p.pid)
         try:
             for child in parent.children(recursive=True):
@@ -194,3 +334,108 @@ class SSMProxy(ABC):
 
     def __exit__(self, *args):
         self.disconnect()
+
+    @staticmethod
+    def find_free_port() -> int:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('localhost', 0))
+            return sock.getsockname()[1]
+
+
+class MultiNodeSSMProxy:
+    """
+    Connects to all nodes of a multi-node job at once and runs commands on every node in parallel.
+    The node rank is the index of the instance ID in the list.
+
+    Usage:
+
+    with MultiNodeSSMProxy(instance_ids) as multi_node_proxy:
+        multi_node_proxy.connect()
+        multi_node_proxy.run_command("nvidia-smi")
+
+    """
+    logger = logging.getLogger('sagemaker-ssh-helper')
+
+    def __init__(self, instance_ids: List[str], extra_args: str = "", region_name: str = None,
+                 cloudwatch_url: str = None, ssh_listen_ports: List[int] = None, max_workers: int = 32) -> None:
+        """
+        :param instance_ids: SSM instance IDs of the nodes, in the order of their ranks
+        :param ssh_listen_ports: local ports to forward SSH of each node to, free ports are picked if not passed
+        :param max_workers: max number of nodes to connect to and to run commands on at the same time
+        """
+        super().__init__()
+        if ssh_listen_ports is None:
+            ssh_listen_ports = [SSMProxy.find_free_port() for _ in instance_ids]
+        if len(ssh_listen_ports) != len(instance_ids):
+            raise ValueError(f"Got {len(ssh_listen_ports)} ports for {len(instance_ids)} instances")
+        self.instance_ids = instance_ids
+        # The key is generated once in connect() and all nodes reuse it
+        self.proxies = [SSMProxy(port, extra_args, region_name, cloudwatch_url, reuse_ssh_key=True)
+                        for port in ssh_listen_ports]
+        self.max_workers = max(1, min(max_workers, len(instance_ids)))
+        self.output_lock = Lock()
+
+    def connect(self):
+        self.logger.info(f"Connecting to {len(self.instance_ids)} nodes: {self.instance_ids}")
+        try:
+            # Otherwise every node would generate its own key and overwrite the keys of the others
+            self._generate_ssh_key()
+            self._map(lambda proxy, instance_id: proxy.connect_to_ssm_instance(instance_id), self.instance_ids)
+        except Exception:
+            self.disconnect()
+            raise
+
+    @staticmethod
+    def _generate_ssh_key():
+        # Same as sm-connect-ssh-proxy does for a single node
+        ssh_key = os.path.expanduser("~/.ssh/sagemaker-ssh-gw")
+        os.makedirs(os.path.dirname(ssh_key), mode=0o700, exist_ok=True)
+        with timings.span('generate-key'):
+            subprocess.run(["ssh-keygen", "-t", "ecdsa", "-q", "-f", ssh_key, "-N", ""],
+                           input=b"yes\n", stdout=subprocess.DEVNULL, check=True)
+
+    def run_command(self, command, output: TextIO = None) -> List[int]:
+        """
+        Run the command on all nodes in parallel and print their output as it arrives,
+        every line prefixed with the node rank, e.g. `[0] ...`.
+
+        :param output: where to print the output, stdout by default
+        :return: the exit codes of the command on each node, in the order of ranks
+        """
+        output = output or sys.stdout
+
+        def run(proxy: SSMProxy, rank: int) -> int:
+            process = proxy.start_command(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                          stdin=subprocess.DEVNULL)
+            for line in iter(process.stdout.readline, b''):
+                with self.output_lock:
+                    output.write(f"[{rank}] {line.decode('latin1').rstrip()}\n")
+                    output.flush()
+            process.stdout.close()
+            return process.wait()
+
+        return self._map(run, range(len(self.proxies)))
+
+    def run_command_with_output(self, command) -> List[bytes]:
+        """
+        :return: the output of the command on each node, in the order of ranks
+        """
+        return self._map(lambda proxy, _: proxy.run_command_with_output(command), self.instance_ids)
+
+    def terminate_waiting_loop(self):
+        self._map(lambda proxy, _: proxy.terminate_waiting_loop(), self.instance_ids)
+
+    def disconnect(self):
+        for proxy in self.proxies:
+            if proxy.p is not None:
+                proxy.disconnect()
+
+    def _map(self, fn, args) -> list:
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(fn, self.proxies, args))
+
+    def __enter__(self, *args):
+        return self
+
+    def __exit__(self, *args):
+        self.disconnect()
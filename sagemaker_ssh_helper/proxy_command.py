@@ -0,0 +1,430 @@
+"""
+In-process implementation of the SSH ProxyCommand, i.e. `sm-ssh start-proxy --native <fqdn>`.
+
+It does the same as `sm-local-ssh-<type> proxy-host` -> `sm-local-start-ssh --proxy-setup-only` ->
+`sm-connect-ssh-proxy --silent-setup-only` -> `aws ssm start-session`, but in a single Python interpreter
+with one set of boto3 clients, without spawning bash, AWS CLI and extra interpreters for each step.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import boto3
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError
+
+from sagemaker_ssh_helper import timings
+from sagemaker_ssh_helper.inventory_cache import AuthorizedKeysCache, DefaultBucketCache
+from sagemaker_ssh_helper.log import SSHLog
+from sagemaker_ssh_helper.manager import SSMManager
+from sagemaker_ssh_helper.sm_ssh import SageMakerSecureShellHelper
+
+
+class SSMProxyCommand:
+    logger = logging.getLogger('sagemaker-ssh-helper:SSMProxyCommand')
+
+    AUTHORIZED_KEYS_DIR = '/etc/ssh/authorized_keys.d/'
+
+    def __init__(self, fqdn: str, domain_id: str = '', user_profile_name: str = '',
+                 boto_session: boto3.session.Session = None,
+                 command_timeout_in_sec: int = 30,
+                 authorized_keys_cache: bool = True):
+        """
+        :param fqdn: the SSH host name, e.g. ssh-training-job.training.sagemaker
+        :param domain_id: SageMaker Studio domain ID, only for the `ide` resource type
+        :param user_profile_name: SageMaker Studio user profile name, only for the `ide` resource type
+        :param boto_session: the session to create the clients from, the default session if not passed
+        :param command_timeout_in_sec: how long to wait for the SSM command that installs the public key
+        :param authorized_keys_cache: remember the keys already published to each instance,
+            see :class:`AuthorizedKeysCache`, and don't publish them again on reconnect
+        """
+        super().__init__()
+        self.fqdn = fqdn
+        self.resource_type = SageMakerSecureShellHelper.fqdn_to_type(fqdn)
+        self.resource_name = SageMakerSecureShellHelper.fqdn_to_name(fqdn)
+        self.domain_id = domain_id
+        self.user_profile_name = user_profile_name
+        self.command_timeout_in_sec = command_timeout_in_sec
+
+        self.boto_session = boto_session or boto3.session.Session()
+        self.region_name = self.boto_session.region_name
+        self.ssm = timings.count_api_calls_of(self.boto_session.client('ssm'))
+        self.s3 = timings.count_api_calls_of(self.boto_session.client('s3'))
+        self.authorized_keys_cache = AuthorizedKeysCache.for_region(self.region_name) \
+            if authorized_keys_cache else None
+
+    def run(self) -> int:
+        """
+        Resolve the instance, authorize the key and start the SSH session over SSM.
+        Stdin and stdout of the current process are connected to the session.
+
+        :return: the exit code of the session
+        """
+        instance_id, fingerprint, key_is_known = self.authorize()
+        key_check = None
+        if key_is_known:
+            # Checked while the session starts, so that the remembered key doesn't delay the connection
+            key_check = threading.Thread(target=self.check_key, args=(instance_id, fingerprint), daemon=True)
+            key_check.start()
+        try:
+            with self._exit_on_hangup():
+                return self.start_session(instance_id)
+        finally:
+            if key_check is not None:
+                key_check.join()
+
+    def authorize(self) -> Tuple[str, str, bool]:
+        """
+        Resolve the instance and make sure that the SSH key is in its authorized keys.
+
+        :return: the instance ID, the key fingerprint and whether the key was already known to be authorized
+        """
+        if self.resource_type == 'all' or not self.resource_name:
+            raise ValueError(f"Host name must be in the form '<name>.<type>.sagemaker', got '{self.fqdn}'")
+        ssh_key = self.generate_key()
+        instance_id = self.resolve_instance_id()
+        self.logger.info(f"Resolved {self.fqdn} to {instance_id} in {self.region_name}")
+
+        fingerprint = self.get_key_fingerprint(ssh_key)
+        key_is_known = self.authorized_keys_cache is not None \
+            and self.authorized_keys_cache.is_authorized(instance_id, fingerprint)
+        if key_is_known:
+            self.logger.info(f"Key {fingerprint} is already authorized on {instance_id}, skipping publication")
+        else:
+            self.check_instance_is_online(instance_id)
+            self.publish_key(instance_id, ssh_key)
+            if self.authorized_keys_cache is not None:
+                self.authorized_keys_cache.add(instance_id, fingerprint)
+        return instance_id, fingerprint, key_is_known
+
+    def check_key(self, instance_id: str, fingerprint: str):
+        """
+        Check that the remembered key is still in the authorized keys of the instance and publish it again,
+        if it's not, e.g., when the key with the same name from another machine has replaced it.
+        The SSH client doesn't tell its proxy whether the authentication succeeded, so the connection
+        that found the key missing fails, but the next one succeeds without clearing the cache manually.
+        """
+        ssh_key = self.get_ssh_key_path()
+        with open(f"{ssh_key}.pub", 'r') as f:
+            key_blob = f.read().split()[1]
+        try:
+            with timings.span('check-key', instance_id=instance_id):
+                response = self.ssm.send_command(
+                    InstanceIds=[instance_id],
+                    DocumentName='AWS-RunShellScript',
+                    Comment='Check public key for SSH helper',
+                    TimeoutSeconds=self.command_timeout_in_sec,
+                    Parameters={'commands': [
+                        f"grep -qF '{key_blob}' /etc/ssh/authorized_keys && echo 'Key found' || echo 'Key not found'",
+                    ]},
+                )
+            invocation = self.wait_for_invocation(instance_id, response['Command']['CommandId'])
+            if invocation is None or invocation['Status'] != 'Success':
+                self.logger.warning(f"Failed to check key {fingerprint} on {instance_id}, keeping it authorized")
+                return
+            if 'Key not found' not in invocation.get('StandardOutputContent', ''):
+                return
+            self.logger.warning(f"Key {fingerprint} is no longer authorized on {instance_id}, publishing it again")
+            self.forget_key(instance_id, fingerprint)
+            self.publish_key(instance_id, ssh_key)
+            if self.authorized_keys_cache is not None:
+                self.authorized_keys_cache.add(instance_id, fingerprint)
+        except Exception as e:
+            self.logger.warning(f"Failed to check key {fingerprint} on {instance_id}: {e}")
+
+    def forget_key(self, instance_id: str, fingerprint: str):
+        """
+        Called when the remembered key turns out to be missing on the instance, see :meth:`check_key()`,
+        so that the next connect publishes it again.
+        """
+        self.logger.info(f"Forgetting that {fingerprint} is authorized on {instance_id}")
+        if self.authorized_keys_cache is not None:
+            self.authorized_keys_cache.remove(instance_id, fingerprint)
+
+    def get_ssh_key_path(self) -> str:
+        return os.path.join(os.path.expanduser('~'), '.ssh', self.fqdn)
+
+    def generate_key(self) -> str:
+        ssh_key = self.get_ssh_key_path()
+        with timings.span('generate-key'):
+            if os.path.exists(ssh_key):
+                # Don't generate again, or it will confuse SSH
+                # Only touch the file so it can be easily identified when you sort by last access timestamp
+                os.utime(ssh_key)
+            else:
+                self.logger.info(f"Generating {ssh_key} keypair with ECDSA")
+                os.makedirs(os.path.dirname(ssh_key), mode=0o700, exist_ok=True)
+                subprocess.check_call(['ssh-keygen', '-t', 'ecdsa', '-q', '-f', ssh_key, '-N', ''],
+                                      stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        return ssh_key
+
+    @staticmethod
+    def get_key_fingerprint(ssh_key: str) -> str:
+        """
+        :return: the SHA256 fingerprint of the public key, the same as `ssh-keygen -l -f <ssh_key>.pub` prints
+        """
+        with open(f"{ssh_key}.pub", 'r') as f:
+            key_blob = base64.b64decode(f.read().split()[1])
+        digest = base64.b64encode(hashlib.sha256(key_blob).digest()).decode('ascii').rstrip('=')
+        return f"SHA256:{digest}"
+
+    def resolve_instance_id(self) -> str:
+        instance_ids = self._resolve_instance_ids()
+        if not instance_ids:
+            raise ValueError(f"No SSM instances found for {self.fqdn}")
+        return instance_ids[0]
+
+    def _resolve_instance_ids(self) -> List[str]:
+        manager = SSMManager(region_name=self.region_name)
+        if self.resource_type == 'training':
+            return manager.get_training_instance_ids(self.resource_name)
+        elif self.resource_type == 'processing':
+            return manager.get_processing_instance_ids(self.resource_name)
+        elif self.resource_type == 'transform':
+            return manager.get_transformer_instance_ids(self.resource_name)
+        elif self.resource_type == 'notebook':
+            return manager.get_notebook_instance_ids(self.resource_name)
+        elif self.resource_type == 'inference':
+            return SSHLog(region_name=self.region_name).get_endpoint_ssm_instance_ids(self.resource_name)
+        elif self.resource_type == 'ide':
+            domain_id, user_profile_name = self._get_studio_domain_and_user()
+            if user_profile_name:
+                return manager.get_studio_user_kgw_instance_ids(domain_id, user_profile_name, self.resource_name)
+            return manager.get_studio_kgw_instance_ids(self.resource_name)
+        else:
+            raise ValueError(f"Don't know how to handle this resource type: {self.resource_type}")
+
+    def _get_studio_domain_and_user(self) -> Tuple[str, str]:
+        # Same defaults as in sm-local-ssh-ide, set with `sm-local-ssh-ide set-domain-id` and `set-user-profile-name`
+        domain_id, user_profile_name = self.domain_id, self.user_profile_name
+        if not domain_id and not user_profile_name:
+            domain_id = self._read_home_file('.sm-studio-domain-id')
+            user_profile_name = self._read_home_file('.sm-studio-user-profile-name')
+        return domain_id, user_profile_name
+
+    @staticmethod
+    def _read_home_file(file_name) -> str:
+        try:
+            with open(os.path.join(os.path.expanduser('~'), file_name), 'r') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return ''
+
+    def check_instance_is_online(self, instance_id: str):
+        with timings.span('check-instance-online', instance_id=instance_id):
+            response = self.ssm.describe_instance_information(
+                Filters=[{'Key': 'InstanceIds', 'Values': [instance_id]}]
+            )
+        instances = response['InstanceInformationList']
+        status = instances[0]['PingStatus'] if instances else None
+        if status != 'Online':
+            raise ValueError(f"Instance {instance_id} is offline, status: {status}")
+
+    def get_authorized_keys_path(self) -> str:
+        path = os.environ.get('SSH_AUTHORIZED_KEYS_PATH')
+        if not path:
+            path = f"s3://{self.get_default_bucket(self.boto_session)}/ssh-authorized-keys/"
+        if not path.endswith('/'):
+            path += '/'
+        return path
+
+    @staticmethod
+    def get_default_bucket(boto_session: boto3.session.Session, use_cache: bool = True) -> str:
+        """
+        :param use_cache: take the bucket from :class:`DefaultBucketCache`, if it was resolved before
+        :return: the bucket of sagemaker.Session().default_bucket(), which honors the DefaultS3Bucket override
+            in the SageMaker config file; SageMaker Python SDK is imported only when the bucket isn't cached yet
+        """
+        cache = DefaultBucketCache.default()
+        key = DefaultBucketCache.get_credentials_key(boto_session.profile_name, boto_session.region_name)
+        bucket = cache.get(key) if use_cache else None
+        if not bucket:
+            bucket = SSMProxyCommand.refresh_default_bucket(boto_session)
+        return bucket
+
+    @staticmethod
+    def refresh_default_bucket(boto_session: boto3.session.Session) -> str:
+        """
+        Resolve the default bucket again with SageMaker Python SDK, which also creates it, if it doesn't exist,
+        and update :class:`DefaultBucketCache`. Called on a cache miss and when the upload to the cached bucket fails.
+        """
+        import sagemaker
+        cache = DefaultBucketCache.default()
+        key = DefaultBucketCache.get_credentials_key(boto_session.profile_name, boto_session.region_name)
+        cache.invalidate(key)
+        bucket = sagemaker.Session(boto_session=boto_session).default_bucket()
+        cache.put(key, bucket)
+        return bucket
+
+    def publish_key(self, instance_id: str, ssh_key: str):
+        """
+        Upload the public key to S3 and make the instance copy it into its authorized keys with an SSM command.
+        """
+        with timings.span('get-authorized-keys-path'):
+            key_s3_path = self.get_authorized_keys_path() + os.path.basename(ssh_key) + '.pub'
+        bucket, key = self._split_s3_path(key_s3_path)
+        self.logger.info(f"Uploading {ssh_key}.pub to {key_s3_path}")
+        with timings.span('upload-key'):
+            try:
+                self.s3.upload_file(f"{ssh_key}.pub", bucket, key)
+            except S3UploadFailedError as e:
+                if os.environ.get('SSH_AUTHORIZED_KEYS_PATH'):
+                    raise
+                # The cached bucket could be gone or belong to other credentials by now
+                self.logger.warning(f"Failed to upload the key to the default bucket {bucket}, "
+                                    f"resolving it again: {e}")
+                bucket = self.refresh_default_bucket(self.boto_session)
+                key_s3_path = f"s3://{bucket}/{key}"
+                self.s3.upload_file(f"{ssh_key}.pub", bucket, key)
+
+        self.logger.info(f"Running SSM command to copy the public key to {instance_id}")
+        with timings.span('send-command', instance_id=instance_id):
+            response = self.ssm.send_command(
+                InstanceIds=[instance_id],
+                DocumentName='AWS-RunShellScript',
+                Comment='Copy public key for SSH helper',
+                TimeoutSeconds=self.command_timeout_in_sec,
+                Parameters={'commands': [
+                    f"mkdir -p {self.AUTHORIZED_KEYS_DIR}",
+                    f"aws s3 cp \"{key_s3_path}\" {self.AUTHORIZED_KEYS_DIR}",
+                    f"ls -la {self.AUTHORIZED_KEYS_DIR}",
+                    f"cat {self.AUTHORIZED_KEYS_DIR}* > /etc/ssh/authorized_keys",
+                    "ls -la /etc/ssh/authorized_keys",
+                ]},
+            )
+        command_id = response['Command']['CommandId']
+        status = self.wait_for_command(instance_id, command_id)
+        if status != 'Success':
+            raise ValueError(f"Command didn't finish successfully in time. Check SSM logs and Command history "
+                             f"for more details. Command status: {status}. Command ID: {command_id}. "
+                             f"Region: {self.region_name}")
+
+    def wait_for_command(self, instance_id: str, command_id: str) -> Optional[str]:
+        """
+        :return: the final status of the command, or the last seen status on timeout
+        """
+        invocation = self.wait_for_invocation(instance_id, command_id)
+        return invocation['Status'] if invocation else None
+
+    def wait_for_invocation(self, instance_id: str, command_id: str) -> Optional[Dict]:
+        """
+        Poll the command invocation until it finishes, with short intervals in the beginning,
+        because the key copy usually takes less than a second.
+
+        :return: the final invocation of the command, or the last seen one on timeout
+        """
+        with timings.span('wait-for-command', instance_id=instance_id) as timing_span:
+            deadline = time.monotonic() + self.command_timeout_in_sec
+            interval = 0.2
+            invocation = None
+            while True:
+                timing_span.add_attempt()
+                try:
+                    invocation = self.ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
+                    if invocation['Status'] not in ('Pending', 'InProgress', 'Delayed'):
+                        self.logger.info(f"Command output: {invocation.get('StandardOutputContent', '')}")
+                        if invocation.get('StandardErrorContent'):
+                            self.logger.info(f"Command error: {invocation['StandardErrorContent']}")
+                        return invocation
+                except ClientError as e:
+                    # The invocation is not visible for a short time right after send_command()
+                    if e.response['Error']['Code'] != 'InvocationDoesNotExist':
+                        raise
+                if time.monotonic() + interval > deadline:
+                    return invocation
+                time.sleep(interval)
+                interval = min(interval * 1.5, 2.0)
+
+    def start_session(self, instance_id: str) -> int:
+        """
+        Start the SSM session and hand it over to session-manager-plugin, the same way as `aws ssm start-session`.
+        """
+        parameters = {
+            'Target': instance_id,
+            'DocumentName': 'AWS-StartSSHSession',
+            'Parameters': {'portNumber': ['22']},
+            'Reason': 'Local user started SSH with SageMaker SSH Helper proxy',
+        }
+        with timings.span('start-session', instance_id=instance_id):
+            response = self.ssm.start_session(**parameters)
+        self.logger.info(f"Started SSM session {response['SessionId']}")
+        try:
+            return subprocess.call(self._session_manager_plugin_args(response, parameters))
+        except (OSError, SystemExit):
+            # subprocess.call() has already killed the plugin on SystemExit, see _exit_on_hangup()
+            self.ssm.terminate_session(SessionId=response['SessionId'])
+            raise
+
+    @staticmethod
+    @contextmanager
+    def _exit_on_hangup() -> Iterator[None]:
+        """
+        The SSH client sends SIGHUP to its ProxyCommand when it exits, e.g., after a failed authentication.
+        Turn it into SystemExit, so that the session is terminated and the key check finishes before the exit.
+        """
+        if not hasattr(signal, 'SIGHUP') or threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        def hang_up(signum, _):
+            raise SystemExit(128 + signum)
+
+        previous_handler = signal.signal(signal.SIGHUP, hang_up)
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGHUP, previous_handler)
+
+    def start_port_forwarding_session(self, instance_id: str, local_port: int) -> Tuple[str, subprocess.Popen]:
+        """
+        Start the SSM session that forwards the local port to SSH port of the instance in the background.
+        Session Manager plugin multiplexes all TCP connections to the local port over the same session.
+
+        :return: the session ID and the session-manager-plugin process
+        """
+        parameters = {
+            'Target': instance_id,
+            'DocumentName': 'AWS-StartPortForwardingSession',
+            'Parameters': {'portNumber': ['22'], 'localPortNumber': [str(local_port)]},
+            'Reason': 'Local user started SSH with SageMaker SSH Helper broker',
+        }
+        with timings.span('start-session', instance_id=instance_id):
+            response = self.ssm.start_session(**parameters)
+        self.logger.info(f"Started SSM port forwarding session {response['SessionId']} on local port {local_port}")
+        try:
+            process = subprocess.Popen(self._session_manager_plugin_args(response, parameters),
+                                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        except OSError:
+            self.ssm.terminate_session(SessionId=response['SessionId'])
+            raise
+        return response['SessionId'], process
+
+    def _session_manager_plugin_args(self, response: dict, parameters: dict) -> List[str]:
+        return [
+            'session-manager-plugin',
+            json.dumps(response),
+            self.region_name,
+            'StartSession',
+            os.environ.get('AWS_PROFILE', ''),
+            json.dumps(parameters),
+            self.ssm.meta.endpoint_url,
+        ]
+
+    @staticmethod
+    def _split_s3_path(s3_path: str) -> Tuple[str, str]:
+        if not s3_path.startswith('s3://'):
+            raise ValueError(f"Not an S3 path: {s3_path}")
+        bucket, _, key = s3_path[len('s3://'):].partition('/')
+        return bucket, key
@@ -10,8 +10,11 @@ import argparse
 import os
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-from boto3 import Session
+# Keep the imports light: `sm-ssh start-proxy` runs on every SSH connection, import boto3 and other
+# heavy dependencies only inside the commands that need them
 
 
 class SageMakerSecureShellHelper:
@@ -119,6 +122,7 @@ class SageMakerSecureShellHelper:
         self.print_version()
         print(f"Listing SageMaker instances for {fqdn}")
         resource_type = SageMakerSecureShellHelper.fqdn_to_type(fqdn)
+        from boto3 import Session
         region = Session().region_name
         print(f"  Region: {region}")
         print(f"  Type: {resource_type}")
@@ -134,32 +138,44 @@ class SageMakerSecureShellHelper:
         sagemaker = SageMaker()
         interactive_sagemaker = InteractiveSageMaker(sagemaker, manager, log)
 
+        # The SSM inventory is fetched once and shared by all resource types
+        managed_instances = manager.list_all_instances_and_fetch_tags()
+
+        listings = []
         for resource in self.resources:
             if resource_type == resource or resource_type == "all":
                 # if-then-else branch for every resource type:
                 if resource == "ide":
                     domain_id = SageMakerSecureShellHelper.fqdn_to_studio_domain_id(fqdn)
                     user_profile_name = SageMakerSecureShellHelper.fqdn_to_studio_user_name(fqdn)
-                    interactive_sagemaker.print_studio_ide_apps_for_user_and_domain(domain_id, user_profile_name)
+                    listings.append(partial(interactive_sagemaker.list_studio_ide_apps_for_user_and_domain,
+                                            domain_id, user_profile_name, managed_instances))
                 elif resource == "notebook":
-                    interactive_sagemaker.print_notebook_instances()
+                    listings.append(partial(interactive_sagemaker.list_notebook_instances, managed_instances))
                 elif resource == "training":
-                    interactive_sagemaker.print_training_jobs()
+                    listings.append(partial(interactive_sagemaker.list_training_jobs, managed_instances))
                 elif resource == "processing":
-                    interactive_sagemaker.print_processing_jobs()
+                    listings.append(partial(interactive_sagemaker.list_processing_jobs, managed_instances))
                 elif resource == "transform":
-                    interactive_sagemaker.print_transform_jobs()
+                    listings.append(partial(interactive_sagemaker.list_transform_jobs, managed_instances))
                 elif resource == "inference":
-                    interactive_sagemaker.print_endpoints()
+                    listings.append(partial(interactive_sagemaker.list_endpoints, managed_instances))
                 else:
                     raise ValueError(f"ERROR: unknown resource type: {resource}")
 
+        # Listings run concurrently, but are printed in the stable order as soon as each of them is ready
+        with ThreadPoolExecutor(max_workers=max(1, len(listings))) as executor:
+            futures = [executor.submit(listing) for listing in listings]
+            for future in futures:
+                for app in future.result():
+                    print(app, flush=True)
+
     @staticmethod
     def print_version():
         print(f"SageMaker SSH Helper v{read_version()}")
 
     @staticmethod
-    def start_proxy(fqdn):
+    def start_proxy(fqdn, native=False, broker=False):
         resource_type = SageMakerSecureShellHelper.fqdn_to_type(fqdn)
         if resource_type == "all":
             print("ERROR: resource type 'all' is only valid for 'list' command")
@@ -168,11 +184,109 @@ class SageMakerSecureShellHelper:
         if resource_name == "":
             print("ERROR: empty resource type is only valid for 'list' command")
             return
+        if broker and SageMakerSecureShellHelper._start_broker_proxy(fqdn, resource_type):
+            return
+        if native or broker:
+            SageMakerSecureShellHelper._start_native_proxy(fqdn, resource_type)
+            return
         arguments = SageMakerSecureShellHelper._get_arguments(fqdn, resource_type, "start-proxy")
         arguments.append(fqdn)
         subprocess.check_call(arguments, env=os.environ, bufsize=0)
 
-    def connect_ports(self, fqdn, extra_args):
+    @staticmethod
+    def _start_native_proxy(fqdn, resource_type):
+        import logging
+        # Stdout is the SSH data channel, so logging must go to stderr or to the debug log
+        if os.environ.get("SM_SSH_DEBUG") == "true":
+            logging.basicConfig(level=logging.INFO, filename="/tmp/sm-ssh-debug.log",  # nosec B108
+                                format="%(asctime)s %(name)s: %(message)s")
+        else:
+            logging.basicConfig(level=logging.ERROR)
+        from sagemaker_ssh_helper.proxy_command import SSMProxyCommand
+        domain_id = ""
+        user_profile_name = ""
+        if resource_type == "ide":
+            domain_id = SageMakerSecureShellHelper.fqdn_to_studio_domain_id(fqdn)
+            user_profile_name = SageMakerSecureShellHelper.fqdn_to_studio_user_name(fqdn)
+        exit_code = SSMProxyCommand(fqdn, domain_id, user_profile_name).run()
+        if exit_code != 0:
+            sys.exit(exit_code)
+
+    @staticmethod
+    def _start_broker_proxy(fqdn, resource_type):
+        from sagemaker_ssh_helper.broker import BrokerClient
+        domain_id = ""
+        user_profile_name = ""
+        if resource_type == "ide":
+            domain_id = SageMakerSecureShellHelper.fqdn_to_studio_domain_id(fqdn)
+            user_profile_name = SageMakerSecureShellHelper.fqdn_to_studio_user_name(fqdn)
+        client = BrokerClient()
+        try:
+            sock = client.connect(fqdn, domain_id, user_profile_name)
+        except OSError:
+            print(f"WARNING: SSH Helper broker is not running at {client.socket_path}, start it with 'sm-ssh broker'. "
+                  f"Connecting without broker.", file=sys.stderr)
+            return False
+        except ValueError as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            sys.exit(1)
+        client.relay_stdio(sock)
+        return True
+
+    @staticmethod
+    def broker(idle_timeout_in_sec):
+        import logging
+        logging.basicConfig(level=logging.INFO)
+        from sagemaker_ssh_helper.broker import SSMSessionBroker
+        SSMSessionBroker(idle_timeout_in_sec=idle_timeout_in_sec).serve_forever()
+
+    @staticmethod
+    def transfer(command, fqdn, extra_args):
+        import logging
+        logging.basicConfig(level=logging.INFO)
+        resource_type = SageMakerSecureShellHelper.fqdn_to_type(fqdn)
+        if resource_type == "all" or SageMakerSecureShellHelper.fqdn_to_name(fqdn) == "":
+            print(f"ERROR: '{command}' needs the full name of the resource, e.g., ssh-job.training.sagemaker")
+            return
+        parser = argparse.ArgumentParser(prog=f"sm-ssh {command} {fqdn}")
+        if command == 'pull':
+            parser.add_argument('source', help='the remote file or directory')
+            parser.add_argument('destination', help='the local path')
+        else:
+            parser.add_argument('source', help='the local file or directory')
+            parser.add_argument('destination', help='the remote path')
+        parser.add_argument('--parallel', type=int, default=4,
+                            help='number of SSM sessions to transfer the data over (default: 4)')
+        parser.add_argument('--compress', action='store_true',
+                            help='compress the data with gzip on the fly')
+        parser.add_argument('--chunk-size', type=int, default=64,
+                            help='split large files into chunks of that many MiB (default: 64)')
+        parser.add_argument('--s3-threshold', type=int, default=None,
+                            help='stage the transfer through S3 if the total size is larger '
+                                 'than that many MiB (default: never)')
+        parser.add_argument('--s3-path', default=None,
+                            help='where to stage the transfer in S3 (default: the SageMaker default bucket)')
+        args = parser.parse_args(extra_args)
+
+        from sagemaker_ssh_helper.proxy_command import SSMProxyCommand
+        from sagemaker_ssh_helper.transfer import SSMFileTransfer, MIB
+        domain_id = ""
+        user_profile_name = ""
+        if resource_type == "ide":
+            domain_id = SageMakerSecureShellHelper.fqdn_to_studio_domain_id(fqdn)
+            user_profile_name = SageMakerSecureShellHelper.fqdn_to_studio_user_name(fqdn)
+        instance_id = SSMProxyCommand(fqdn, domain_id, user_profile_name).resolve_instance_id()
+        s3_threshold = args.s3_threshold * MIB if args.s3_threshold is not None else None
+        with SSMFileTransfer(instance_id, parallel_sessions=args.parallel, compress=args.compress,
+                             chunk_size=args.chunk_size * MIB, s3_threshold=s3_threshold,
+                             s3_path=args.s3_path) as file_transfer:
+            file_transfer.connect()
+            if command == 'pull':
+                file_transfer.pull(args.source, args.destination)
+            else:
+                file_transfer.push(args.source, args.destination)
+
+    def connect_ports(self, fqdn, extra_args, timings=False):
         self.print_version()
         print(f"Connecting to SageMaker containers for {fqdn} using SSH")
         resource_type = SageMakerSecureShellHelper.fqdn_to_type(fqdn)
@@ -192,7 +306,28 @@ class SageMakerSecureShellHelper:
 
         arguments = self._get_arguments(fqdn, resource_type, "connect")
         arguments.append(resource_name)
-        subprocess.check_call(arguments + extra_args, env=os.environ, bufsize=0)
+        if not timings:
+            subprocess.check_call(arguments + extra_args, env=os.environ, bufsize=0)
+            return
+
+        import uuid
+        from sagemaker_ssh_helper.inventory_cache import JSONFileCache
+        timings_path = os.environ.get("SM_SSH_TIMINGS_FILE") or os.path.join(JSONFileCache.get_cache_dir(),
+                                                                              "timings.jsonl")
+        os.makedirs(os.path.dirname(os.path.abspath(timings_path)), exist_ok=True)
+        connection_id = str(uuid.uuid4())
+        env = dict(os.environ, SM_SSH_TIMINGS_FILE=timings_path, SM_SSH_CONNECTION_ID=connection_id)
+        print(f"  Timings: {timings_path} (connection {connection_id})")
+        try:
+            subprocess.check_call(arguments + extra_args, env=env, bufsize=0)
+        finally:
+            SageMakerSecureShellHelper.print_timings(timings_path, connection_id)
+
+    @staticmethod
+    def print_timings(timings_path, connection_id):
+        from sagemaker_ssh_helper import timings
+        print(f"Connection timings of {connection_id}:", file=sys.stderr)
+        print(timings.format_summary(timings.read_spans(timings_path, connection_id)), file=sys.stderr)
 
 
 def read_version():
@@ -209,20 +344,42 @@ def main():
                     'remote debugging, and advanced troubleshooting'
     )
     parser.add_argument('-v', '--version', action='version', version=f'%(prog)s v{read_version()}')
-    parser.add_argument('command', choices=['list', 'start-proxy', 'connect'])
+    parser.add_argument('command', choices=['list', 'start-proxy', 'connect', 'broker', 'pull', 'push'])
     parser.add_argument('fqdn', nargs='?', default='sagemaker',
                         help='fully qualified domain name, e.g., ssh-training-job.training.sagemaker, '
                              'studio.sagemaker, etc. (default: sagemaker)')
-    args, extra_args = parser.parse_known_args()
+    parser.add_argument('--native', action='store_true',
+                        default=os.environ.get('SM_SSH_NATIVE_PROXY') == 'true',
+                        help='start-proxy only: set up the proxy in the current Python process instead of '
+                             'the helper shell scripts and AWS CLI, which is much faster '
+                             '(default: true if SM_SSH_NATIVE_PROXY=true)')
+    parser.add_argument('--broker', action='store_true',
+                        default=os.environ.get('SM_SSH_BROKER') == 'true',
+                        help='start-proxy only: connect through the local broker started with `sm-ssh broker`, '
+                             'falls back to --native if the broker is not running '
+                             '(default: true if SM_SSH_BROKER=true)')
+    parser.add_argument('--idle-timeout', type=int, default=600,
+                        help='broker only: close SSM sessions that had no SSH connections '
+                             'for that many seconds (default: 600)')
+    parser.add_argument('--timings', action='store_true',
+                        help='connect only: record the duration of every connection phase '
+                             'to SM_SSH_TIMINGS_FILE (default: ~/.cache/sagemaker-ssh-helper/timings.jsonl) '
+                             'and print the summary')
+    # Intermixed, so that the options can go before the fqdn, e.g., `sm-ssh start-proxy --native %h`
+    args, extra_args = parser.parse_known_intermixed_args()
 
     os.environ["SM_SSH_PYTHON"] = sys.executable
 
     if args.command == 'list':
         SageMakerSecureShellHelper().list(args.fqdn)
     elif args.command == 'start-proxy':
-        SageMakerSecureShellHelper.start_proxy(args.fqdn)
+        SageMakerSecureShellHelper.start_proxy(args.fqdn, args.native, args.broker)
     elif args.command == 'connect':
-        SageMakerSecureShellHelper().connect_ports(args.fqdn, extra_args)
+        SageMakerSecureShellHelper().connect_ports(args.fqdn, extra_args, args.timings)
+    elif args.command == 'broker':
+        SageMakerSecureShellHelper.broker(args.idle_timeout)
+    elif args.command in ('pull', 'push'):
+        SageMakerSecureShellHelper.transfer(args.command, args.fqdn, extra_args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,163 @@
+"""
+Per-phase timings of the connection pipeline, to find out where the time to shell goes.
+
+When the environment variable SM_SSH_TIMINGS_FILE is set, every phase appends one JSON line to that file,
+both from Python and from the helper shell scripts (see `_timing_span` in sm-helper-functions), e.g.:
+
+    {"Connection": "...", "Source": "python", "Phase": "resolve-instance-ids", "Start": 1700000000.1,
+     "End": 1700000001.3, "DurationInSec": 1.2, "Attempts": 2, "ApiCalls": 3, "Status": "ok"}
+
+All phases of one `sm-ssh connect` share the same SM_SSH_CONNECTION_ID. Run `sm-ssh connect --timings`
+to record the timings and print the summary.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger('sagemaker-ssh-helper:timings')
+
+_open_spans: List['TimingSpan'] = []
+_open_spans_lock = threading.Lock()
+
+
+def get_timings_path() -> Optional[str]:
+    return os.environ.get('SM_SSH_TIMINGS_FILE') or None
+
+
+def get_connection_id() -> str:
+    return os.environ.get('SM_SSH_CONNECTION_ID', '')
+
+
+class TimingSpan:
+    def __init__(self, phase: str, attributes: Dict) -> None:
+        super().__init__()
+        self.phase = phase
+        self.attributes = attributes
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self.attempts = 0
+        self.api_calls = 0
+        self.status = 'ok'
+        self.thread_id = threading.get_ident()
+
+    def add_attempt(self):
+        self.attempts += 1
+
+    def to_dict(self) -> Dict:
+        record = {'Connection': get_connection_id(), 'Source': 'python', 'Pid': os.getpid(),
+                  'Phase': self.phase, 'Start': round(self.start, 6), 'End': round(self.end, 6),
+                  'DurationInSec': round(self.end - self.start, 6),
+                  'Attempts': self.attempts, 'ApiCalls': self.api_calls, 'Status': self.status}
+        record.update(self.attributes)
+        return record
+
+
+@contextmanager
+def span(phase: str, **attributes) -> Iterator[TimingSpan]:
+    """
+    Time the phase of the connection. The span is recorded only if SM_SSH_TIMINGS_FILE is set,
+    but it's always safe to use, e.g.:
+
+        with timings.span('check-instance-online', instance_id=instance_id) as s:
+            s.add_attempt()
+            ...
+    """
+    timing_span = TimingSpan(phase, attributes)
+    with _open_spans_lock:
+        _open_spans.append(timing_span)
+    try:
+        yield timing_span
+    except BaseException:
+        timing_span.status = 'error'
+        raise
+    finally:
+        timing_span.end = time.time()
+        with _open_spans_lock:
+            _open_spans.remove(timing_span)
+        _write(timing_span.to_dict())
+
+
+def count_api_call(count: int = 1):
+    """
+    Count AWS API calls for the innermost open span of the current thread,
+    or of any thread, if called from a worker thread without its own spans.
+    """
+    thread_id = threading.get_ident()
+    with _open_spans_lock:
+        if not _open_spans:
+            return
+        own_spans = [timing_span for timing_span in _open_spans if timing_span.thread_id == thread_id]
+        (own_spans or _open_spans)[-1].api_calls += count
+
+
+def count_api_calls_of(client):
+    """
+    Count every call of the boto3 client, including the pages of paginators, see :func:`count_api_call`.
+    Safe to call many times for the same client, e.g., for the shared clients from :mod:`clients`.
+
+    :return: the same client
+    """
+    client.meta.events.register('before-parameter-build', _on_api_call,
+                                unique_id='sagemaker-ssh-helper:count-api-calls')
+    return client
+
+
+def _on_api_call(**kwargs):
+    count_api_call()
+
+
+def _write(record: Dict):
+    path = get_timings_path()
+    if not path:
+        return
+    try:
+        # A single append of a short line is atomic, so the Python and shell writers don't interleave
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, (json.dumps(record) + "\n").encode('utf-8'))
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.warning(f"Failed to write timings to {path}: {e}")
+
+
+def read_spans(path: str, connection_id: str = None) -> List[Dict]:
+    spans = []
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if connection_id is None or record.get('Connection') == connection_id:
+                    spans.append(record)
+    except FileNotFoundError:
+        pass
+    return sorted(spans, key=lambda record: record['Start'])
+
+
+def format_summary(spans: List[Dict]) -> str:
+    """
+    :return: a table of phases in the order they started, with the total time from the first to the last phase
+    """
+    if not spans:
+        return "No timings recorded"
+    lines = [f"{'Phase':<28} {'Source':<22} {'Start, s':>9} {'Duration, s':>12} {'Attempts':>9} "
+             f"{'API calls':>10}  Status"]
+    first_start = spans[0]['Start']
+    for record in spans:
+        lines.append(f"{record['Phase']:<28} {record.get('Source', ''):<22} "
+                     f"{record['Start'] - first_start:>9.3f} {record['DurationInSec']:>12.3f} "
+                     f"{record.get('Attempts', 0):>9} {record.get('ApiCalls', 0):>10}  {record.get('Status', '')}")
+    total = max(record['End'] for record in spans) - first_start
+    lines.append(f"Total: {total:.3f} s, API calls: {sum(record.get('ApiCalls', 0) for record in spans)}")
+    return "\n".join(lines)
@@ -0,0 +1,499 @@
+"""
+Bulk file transfer to and from SageMaker containers over SSM, see `sm-ssh pull` and `sm-ssh push`.
+
+Files are split into chunks that are transferred over several SSM sessions to the same instance in parallel.
+Small files are grouped and streamed as tar archives, large files are transferred in ranges with `dd`.
+Every transferred chunk is recorded with its checksum, so an interrupted transfer resumes where it stopped.
+Very large payloads can be staged through S3 instead, with multipart parallel upload and download.
+
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+
+import hashlib
+import logging
+import os
+import shlex
+import subprocess
+import tarfile
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import boto3
+
+from sagemaker_ssh_helper.inventory_cache import JSONFileCache
+from sagemaker_ssh_helper.proxy import SSMProxy
+
+MIB = 1024 * 1024
+
+
+class TransferChunk:
+    """
+    A range of a single file. Files smaller than the chunk size are always transferred whole.
+    """
+
+    def __init__(self, rel_path: str, offset: int, length: int, size: int, mtime: float) -> None:
+        super().__init__()
+        self.rel_path = rel_path
+        self.offset = offset
+        self.length = length
+        self.size = size
+        self.mtime = mtime
+
+    @property
+    def key(self) -> str:
+        return f"{self.rel_path}:{self.offset}"
+
+    def is_whole_file(self) -> bool:
+        return self.offset == 0 and self.length == self.size
+
+
+class TransferState(JSONFileCache):
+    """
+    Checksums of the chunks that were already transferred, to resume an interrupted transfer.
+    """
+    logger = logging.getLogger('sagemaker-ssh-helper:TransferState')
+
+    @classmethod
+    def for_transfer(cls, direction: str, instance_id: str, remote_path: str, local_path: str) -> 'TransferState':
+        transfer_id = hashlib.sha1(  # nosec B324  # not for security, only for the file name
+            f"{direction}:{instance_id}:{remote_path}:{os.path.abspath(local_path)}".encode('utf-8')
+        ).hexdigest()
+        return cls(os.path.join(cls.get_cache_dir(), 'transfers', f"{transfer_id}.json"))
+
+    def get_checksum(self, chunk: TransferChunk) -> Optional[str]:
+        """
+        :return: the checksum of the chunk if it was transferred before and the source file hasn't changed since
+        """
+        with self.lock:
+            entry = self._load().get(chunk.key)
+        if not entry or entry['Size'] != chunk.size or entry['MTime'] != chunk.mtime \
+                or entry['Length'] != chunk.length:
+            return None
+        return entry['SHA256']
+
+    def mark_done(self, chunks_with_checksums: List[Tuple[TransferChunk, str]]):
+        with self.lock:
+            entries = self._load()
+            for chunk, checksum in chunks_with_checksums:
+                entries[chunk.key] = {'Size': chunk.size, 'MTime': chunk.mtime, 'Length': chunk.length,
+                                      'SHA256': checksum}
+            self._save(entries)
+
+
+class SSMFileTransfer:
+    logger = logging.getLogger('sagemaker-ssh-helper:SSMFileTransfer')
+
+    MAX_FILES_PER_ARCHIVE = 1000
+
+    def __init__(self, instance_id: str, parallel_sessions: int = 4, compress: bool = False,
+                 chunk_size: int = 64 * MIB, region_name: str = None,
+                 s3_threshold: Optional[int] = None, s3_path: str = None,
+                 boto_session: boto3.session.Session = None) -> None:
+        """
+        :param instance_id: the SSM instance ID, e.g., mi-1234567890abcdef0
+        :param parallel_sessions: how many SSM sessions to open to the instance
+        :param compress: compress the data with gzip on the fly, good for logs and other text, but not for checkpoints
+        :param chunk_size: the size of chunks large files are split into, rounded up to whole megabytes
+        :param s3_threshold: stage the transfer through S3, if the total size is larger than that, None to never do it
+        :param s3_path: where to stage the files in S3, the default SageMaker bucket if not passed
+        """
+        super().__init__()
+        self.instance_id = instance_id
+        self.parallel_sessions = max(1, parallel_sessions)
+        self.compress = compress
+        self.chunk_size = max(1, -(-chunk_size // MIB)) * MIB
+        self.boto_session = boto_session or boto3.session.Session(region_name=region_name)
+        self.region_name = self.boto_session.region_name
+        self.s3_threshold = s3_threshold
+        self.s3_path = s3_path
+        self.proxies: List[SSMProxy] = []
+
+    def connect(self):
+        self.proxies = [SSMProxy(SSMProxy.find_free_port(), region_name=self.region_name, reuse_ssh_key=True)
+                        for _ in range(self.parallel_sessions)]
+        try:
+            # The first session publishes the key, the others reuse it
+            self.proxies[0].connect_to_ssm_instance(self.instance_id)
+            if len(self.proxies) > 1:
+                with ThreadPoolExecutor(max_workers=len(self.proxies) - 1) as executor:
+                    list(executor.map(lambda proxy: proxy.connect_to_ssm_instance(self.instance_id),
+                                      self.proxies[1:]))
+        except Exception:
+            self.disconnect()
+            raise
+
+    def disconnect(self):
+        for proxy in self.proxies:
+            if proxy.p is not None:
+                proxy.disconnect()
+        self.proxies = []
+
+    def __enter__(self, *args):
+        return self
+
+    def __exit__(self, *args):
+        self.disconnect()
+
+    def pull(self, remote_path: str, local_path: str) -> int:
+        """
+        Copy the remote file or directory to the local path, like `cp -r`.
+
+        :return: the number of bytes transferred, not counting the resumed chunks
+        """
+        remote_root, files = self._list_remote(remote_path)
+        if not files:
+            raise ValueError(f"No files found at {remote_path} on {self.instance_id}")
+        is_single_file = len(files) == 1 and files[0][0] == ''
+        if is_single_file:
+            remote_root, name = os.path.split(remote_path.rstrip('/'))
+            files = [(name, files[0][1], files[0][2])]
+            if os.path.isdir(local_path):
+                local_path = os.path.join(local_path, name)
+
+        def local_file(rel_path: str) -> str:
+            return local_path if is_single_file else os.path.join(local_path, rel_path)
+
+        total_size = sum(size for _, size, _ in files)
+        if self._use_s3(total_size):
+            return self._pull_through_s3(remote_path, files, local_file, is_single_file)
+
+        state = TransferState.for_transfer('pull', self.instance_id, remote_path, local_path)
+        tasks = self._plan(files)
+        self.logger.info(f"Pulling {len(files)} files, {total_size} bytes in {len(tasks)} parts "
+                         f"from {self.instance_id}:{remote_path} to {local_path}")
+
+        def pull_task(proxy: SSMProxy, task: List[TransferChunk]) -> int:
+            task = [chunk for chunk in task if not self._is_pulled(state, chunk, local_file(chunk.rel_path))]
+            if not task:
+                return 0
+            if task[0].is_whole_file():
+                done = self._pull_archive(proxy, remote_root, task, local_file)
+            else:
+                done = [self._pull_range(proxy, remote_root, task[0], local_file(task[0].rel_path))]
+            state.mark_done(done)
+            return sum(chunk.length for chunk, _ in done)
+
+        for rel_path, size, _ in files:
+            if size > self.chunk_size:
+                # Create large files upfront, so that the parallel chunk writers don't truncate each other
+                path = local_file(rel_path)
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                open(path, 'ab').close()
+
+        transferred = self._run_tasks(tasks, pull_task)
+        for rel_path, size, _ in files:
+            # Large files could be larger locally from the previous transfer
+            with open(local_file(rel_path), 'r+b') as f:
+                f.truncate(size)
+        return transferred
+
+    def push(self, local_path: str, remote_path: str) -> int:
+        """
+        Copy the local file or directory to the remote path, like `cp -r`.
+
+        :return: the number of bytes transferred, not counting the resumed chunks
+        """
+        files, local_files = self._list_local(local_path)
+        if not files:
+            raise ValueError(f"No files found at {local_path}")
+        if os.path.isfile(local_path):
+            remote_root, name = os.path.split(remote_path.rstrip('/'))
+            files = [(name, files[0][1], files[0][2])]
+            local_files = {name: local_path}
+        else:
+            remote_root = remote_path
+
+        total_size = sum(size for _, size, _ in files)
+        if self._use_s3(total_size):
+            return self._push_through_s3(remote_path, files, local_files, os.path.isfile(local_path))
+
+        state = TransferState.for_transfer('push', self.instance_id, remote_path, local_path)
+        tasks = self._plan(files)
+        self.logger.info(f"Pushing {len(files)} files, {total_size} bytes in {len(tasks)} parts "
+                         f"from {local_path} to {self.instance_id}:{remote_path}")
+        remote_dirs = sorted({os.path.dirname(os.path.join(remote_root, rel_path)) for rel_path, _, _ in files})
+        self._check_output(self.proxies[0], "mkdir -p " + " ".join(shlex.quote(d) for d in remote_dirs))
+
+        def push_task(proxy: SSMProxy, task: List[TransferChunk]) -> int:
+            checksums = [_sha256_of_range(local_files[chunk.rel_path], chunk.offset, chunk.length) for chunk in task]
+            pending = [(chunk, checksum) for chunk, checksum in zip(task, checksums)
+                       if state.get_checksum(chunk) != checksum]
+            if not pending:
+                return 0
+            if pending[0][0].is_whole_file():
+                self._push_archive(proxy, remote_root, [chunk for chunk, _ in pending], local_files)
+            else:
+                self._push_range(proxy, remote_root, pending[0][0], local_files[pending[0][0].rel_path])
+            state.mark_done(pending)
+            return sum(chunk.length for chunk, _ in pending)
+
+        transferred = self._run_tasks(tasks, push_task)
+        truncate_commands = [f"truncate -s {size} {shlex.quote(os.path.join(remote_root, rel_path))}"
+                             for rel_path, size, _ in files if size > self.chunk_size]
+        if truncate_commands:
+            self._check_output(self.proxies[0], " && ".join(truncate_commands))
+        return transferred
+
+    def _plan(self, files: List[Tuple[str, int, float]]) -> List[List[TransferChunk]]:
+        """
+        Split large files into ranges and group small files into archives of about the chunk size.
+        """
+        tasks: List[List[TransferChunk]] = []
+        archive: List[TransferChunk] = []
+        archive_size = 0
+        for rel_path, size, mtime in files:
+            if size > self.chunk_size:
+                for offset in range(0, size, self.chunk_size):
+                    tasks.append([TransferChunk(rel_path, offset, min(self.chunk_size, size - offset), size, mtime)])
+                continue
+            archive.append(TransferChunk(rel_path, 0, size, size, mtime))
+            archive_size += size
+            if archive_size >= self.chunk_size or len(archive) >= self.MAX_FILES_PER_ARCHIVE:
+                tasks.append(archive)
+                archive, archive_size = [], 0
+        if archive:
+            tasks.append(archive)
+        # Large tasks first, so that the sessions are evenly loaded in the end
+        tasks.sort(key=lambda t: -sum(chunk.length for chunk in t))
+        return tasks
+
+    def _run_tasks(self, tasks: List[List[TransferChunk]], fn: Callable[[SSMProxy, List[TransferChunk]], int]) -> int:
+        # Every session takes the next task from the shared list when it's done with the previous one
+        pending = list(reversed(tasks))
+        start_time = time.monotonic()
+
+        def worker(proxy: SSMProxy) -> int:
+            transferred = 0
+            while True:
+                try:
+                    task = pending.pop()
+                except IndexError:
+                    return transferred
+                transferred += fn(proxy, task)
+
+        with ThreadPoolExecutor(max_workers=len(self.proxies)) as executor:
+            transferred = sum(executor.map(worker, self.proxies))
+        duration = time.monotonic() - start_time
+        self.logger.info(f"Transferred {transferred} bytes in {duration:.1f} s "
+                         f"({transferred / MIB / max(duration, 0.001):.1f} MiB/s)")
+        return transferred
+
+    def _list_remote(self, remote_path: str) -> Tuple[str, List[Tuple[str, int, float]]]:
+        output = self._check_output(self.proxies[0],
+                                    f"find {shlex.quote(remote_path)} -type f -printf '%s %T@ %P\\n'")
+        files = []
+        for line in output.decode('utf-8').splitlines():
+            size, mtime, rel_path = line.split(' ', 2) if line.count(' ') >= 2 else line.split(' ') + ['']
+            files.append((rel_path, int(size), float(mtime)))
+        return remote_path, files
+
+    @staticmethod
+    def _list_local(local_path: str) -> Tuple[List[Tuple[str, int, float]], Dict[str, str]]:
+        paths = [local_path] if os.path.isfile(local_path) else [
+            os.path.join(directory, name) for directory, _, names in os.walk(local_path) for name in names
+        ]
+        files = []
+        local_files = {}
+        for path in paths:
+            rel_path = os.path.relpath(path, local_path).replace(os.sep, '/')
+            stat = os.stat(path)
+            files.append((rel_path, stat.st_size, stat.st_mtime))
+            local_files[rel_path] = path
+        return files, local_files
+
+    def _is_pulled(self, state: TransferState, chunk: TransferChunk, local_file: str) -> bool:
+        checksum = state.get_checksum(chunk)
+        return checksum is not None and checksum == _sha256_of_range(local_file, chunk.offset, chunk.length)
+
+    def _pull_range(self, proxy: SSMProxy, remote_root: str, chunk: TransferChunk,
+                    local_file: str) -> Tuple[TransferChunk, str]:
+        remote_file = shlex.quote(os.path.join(remote_root, chunk.rel_path))
+        command = f"dd if={remote_file} bs={MIB} skip={chunk.offset // MIB} count={self.chunk_size // MIB} 2>/dev/null"
+        if self.compress:
+            command += " | gzip -1"
+        sha256 = hashlib.sha256()
+        received = 0
+        process = proxy.start_command(command, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+        decompressor = zlib.decompressobj(wbits=31) if self.compress else None
+        with open(local_file, 'r+b') as f:
+            f.seek(chunk.offset)
+            for block in iter(lambda: process.stdout.read(MIB), b''):
+                if decompressor:
+                    block = decompressor.decompress(block)
+                f.write(block)
+                sha256.update(block)
+                received += len(block)
+        process.stdout.close()
+        if process.wait() != 0 or received != chunk.length:
+            raise ValueError(f"Failed to pull {chunk.rel_path} at offset {chunk.offset}: "
+                             f"got {received} of {chunk.length} bytes, return code {process.returncode}")
+        return chunk, sha256.hexdigest()
+
+    def _pull_archive(self, proxy: SSMProxy, remote_root: str, chunks: List[TransferChunk],
+                      local_file: Callable[[str], str]) -> List[Tuple[TransferChunk, str]]:
+        command = f"tar -C {shlex.quote(remote_root)} -cf - -- " + \
+                  " ".join(shlex.quote(chunk.rel_path) for chunk in chunks)
+        if self.compress:
+            command += " | gzip -1"
+        chunks_by_path = {chunk.rel_path: chunk for chunk in chunks}
+        done = []
+        process = proxy.start_command(command, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+        with tarfile.open(fileobj=process.stdout, mode='r|gz' if self.compress else 'r|') as archive:
+            for member in archive:
+                chunk = chunks_by_path.get(member.name)
+                if chunk is None or not member.isfile():
+                    raise ValueError(f"Unexpected archive member: {member.name}")
+                path = local_file(chunk.rel_path)
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                sha256 = hashlib.sha256()
+                source = archive.extractfile(member)
+                with open(path, 'wb') as f:
+                    for block in iter(lambda: source.read(MIB), b''):
+                        f.write(block)
+                        sha256.update(block)
+                done.append((chunk, sha256.hexdigest()))
+        process.stdout.close()
+        if process.wait() != 0 or len(done) != len(chunks):
+            raise ValueError(f"Failed to pull {len(chunks)} files from {remote_root}: "
+                             f"got {len(done)} files, return code {process.returncode}")
+        return done
+
+    def _push_range(self, proxy: SSMProxy, remote_root: str, chunk: TransferChunk, local_file: str):
+        remote_file = shlex.quote(os.path.join(remote_root, chunk.rel_path))
+        command = f"dd of={remote_file} bs={MIB} seek={chunk.offset // MIB} conv=notrunc 2>/dev/null"
+        if self.compress:
+            command = "gunzip -c | " + command
+        compressor = zlib.compressobj(1, wbits=31) if self.compress else None
+        process = proxy.start_command(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        with open(local_file, 'rb') as f:
+            f.seek(chunk.offset)
+            remaining = chunk.length
+            while remaining > 0:
+                block = f.read(min(MIB, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                process.stdin.write(compressor.compress(block) if compressor else block)
+            if compressor:
+                process.stdin.write(compressor.flush())
+        process.stdin.close()
+        if process.wait() != 0:
+            raise ValueError(f"Failed to push {chunk.rel_path} at offset {chunk.offset}, "
+                             f"return code {process.returncode}")
+
+    def _push_archive(self, proxy: SSMProxy, remote_root: str, chunks: List[TransferChunk],
+                      local_files: Dict[str, str]):
+        command = f"tar -C {shlex.quote(remote_root)} -x{'z' if self.compress else ''}f -"
+        process = proxy.start_command(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        with tarfile.open(fileobj=process.stdin, mode='w|gz' if self.compress else 'w|') as archive:
+            for chunk in chunks:
+                archive.add(local_files[chunk.rel_path], arcname=chunk.rel_path, recursive=False)
+        process.stdin.close()
+        if process.wait() != 0:
+            raise ValueError(f"Failed to push {len(chunks)} files to {remote_root}, return code {process.returncode}")
+
+    def _use_s3(self, total_size: int) -> bool:
+        return self.s3_threshold is not None and total_size > self.s3_threshold
+
+    def _get_s3_staging_path(self) -> Tuple[str, str]:
+        s3_path = self.s3_path
+        if not s3_path:
+            from sagemaker_ssh_helper.proxy_command import SSMProxyCommand
+            s3_path = f"s3://{SSMProxyCommand.get_default_bucket(self.boto_session)}/ssh-transfers/"
+        bucket, _, prefix = s3_path[len('s3://'):].partition('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        return bucket, f"{prefix}{self.instance_id}-{uuid.uuid4()}/"
+
+    def _transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+        return TransferConfig(multipart_threshold=self.chunk_size, multipart_chunksize=self.chunk_size,
+                              max_concurrency=self.parallel_sessions * 2)
+
+    def _pull_through_s3(self, remote_path: str, files: List[Tuple[str, int, float]],
+                         local_file: Callable[[str], str], is_single_file: bool) -> int:
+        bucket, prefix = self._get_s3_staging_path()
+        s3_url = f"s3://{bucket}/{prefix}"
+        self.logger.info(f"Staging {remote_path} through {s3_url}")
+        if is_single_file:
+            self._check_output(self.proxies[0], f"aws s3 cp --only-show-errors {shlex.quote(remote_path)} "
+                                                f"{shlex.quote(s3_url + files[0][0])}")
+        else:
+            self._check_output(self.proxies[0], f"aws s3 cp --only-show-errors --recursive "
+                                                f"{shlex.quote(remote_path)} {shlex.quote(s3_url)}")
+        s3 = self.boto_session.client('s3')
+        config = self._transfer_config()
+
+        def download(rel_path: str):
+            path = local_file(rel_path)
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            s3.download_file(bucket, prefix + rel_path, path, Config=config)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallel_sessions) as executor:
+                list(executor.map(download, [rel_path for rel_path, _, _ in files]))
+        finally:
+            self._delete_s3_prefix(s3, bucket, prefix)
+        return sum(size for _, size, _ in files)
+
+    def _push_through_s3(self, remote_path: str, files: List[Tuple[str, int, float]],
+                         local_files: Dict[str, str], is_single_file: bool) -> int:
+        bucket, prefix = self._get_s3_staging_path()
+        s3_url = f"s3://{bucket}/{prefix}"
+        self.logger.info(f"Staging {remote_path} through {s3_url}")
+        s3 = self.boto_session.client('s3')
+        config = self._transfer_config()
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallel_sessions) as executor:
+                list(executor.map(lambda rel_path: s3.upload_file(local_files[rel_path], bucket, prefix + rel_path,
+                                                                  Config=config),
+                                  [rel_path for rel_path, _, _ in files]))
+            if is_single_file:
+                self._check_output(self.proxies[0], f"aws s3 cp --only-show-errors "
+                                                    f"{shlex.quote(s3_url + files[0][0])} {shlex.quote(remote_path)}")
+            else:
+                self._check_output(self.proxies[0], f"aws s3 cp --only-show-errors --recursive "
+                                                    f"{shlex.quote(s3_url)} {shlex.quote(remote_path)}")
+        finally:
+            self._delete_s3_prefix(s3, bucket, prefix)
+        return sum(size for _, size, _ in files)
+
+    def _delete_s3_prefix(self, s3, bucket: str, prefix: str):
+        try:
+            for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+                objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+                if objects:
+                    s3.delete_objects(Bucket=bucket, Delete={'Objects': objects})
+        except Exception as e:
+            self.logger.warning(f"Failed to clean up s3://{bucket}/{prefix}: {e}")
+
+    @staticmethod
+    def _check_output(proxy: SSMProxy, command: str) -> bytes:
+        process = proxy.start_command(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                      stdin=subprocess.DEVNULL)
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            raise ValueError(f"Remote command failed with code {process.returncode}: {command}\n"
+                             f"{stderr.decode('latin1')}")
+        return stdout
+
+
+def _sha256_of_range(path: str, offset: int, length: int) -> Optional[str]:
+    sha256 = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            remaining = length
+            while remaining > 0:
+                block = f.read(min(MIB, remaining))
+                if not block:
+                    return None
+                sha256.update(block)
+                remaining -= len(block)
+    except FileNotFoundError:
+        return None
+    return sha256.hexdigest()
@@ -4,7 +4,6 @@ import os
 from abc import ABC, abstractmethod
 from datetime import timedelta
 
-import boto3
 import sagemaker
 from sagemaker import Session
 # noinspection PyProtectedMember
@@ -18,6 +17,7 @@ from sagemaker.transformer import _TransformJob  # need access to sagemaker inte
 
 from sagemaker.sklearn import SKLearnProcessor
 from sagemaker.spark import PySparkProcessor
+from sagemaker_ssh_helper import clients
 from sagemaker_ssh_helper.sm_ssh import SageMakerSecureShellHelper
 
 from sagemaker_ssh_helper.aws import AWS
@@ -25,7 +25,7 @@ from sagemaker_ssh_helper.detached_sagemaker import DetachedEstimator, DetachedP
 from sagemaker_ssh_helper.ide import SSHIDE, NotebookInstance
 from sagemaker_ssh_helper.log import SSHLog
 from sagemaker_ssh_helper.manager import SSMManager
-from sagemaker_ssh_helper.proxy import SSMProxy
+from sagemaker_ssh_helper.proxy import SSMProxy, MultiNodeSSMProxy
 
 
 class SSHEnvironmentWrapper(ABC):
@@ -37,7 +37,9 @@ class SSHEnvironmentWrapper(ABC):
                  connection_wait_time_seconds: int = 600,
                  sagemaker_session: sagemaker.Session = None,
                  local_user_id: str = None,
-                 log_to_stdout: bool = False):
+                 log_to_stdout: bool = False,
+                 dependency_bundle: str = None,
+                 dependency_bundle_sha256: str = None):
         f"""
         :param ssm_iam_role: the SSM role without prefix, e.g. 'service-role/SageMakerRole'
             See https://docs.aws.amazon.com/systems-manager/latest/userguide/sysman-managed-instance-activation.html .
@@ -46,8 +48,15 @@ class SSHEnvironmentWrapper(ABC):
 
         :param connection_wait_time_seconds: How long to wait before a SageMaker entry point.
             Can be 0 (don't wait).
+
+        :param dependency_bundle: S3 URI or a local path in the container of the bundle built with
+            `sm-setup-ssh build-bundle`, to install SSH, AWS CLI and SSM Agent without Internet access.
+
+        :param dependency_bundle_sha256: SHA-256 checksum of the bundle, to reuse the bundle cached on the instance.
         """
         self.log_to_stdout = log_to_stdout
+        self.dependency_bundle = dependency_bundle
+        self.dependency_bundle_sha256 = dependency_bundle_sha256
         self.local_user_id = local_user_id
         self.sagemaker_session = sagemaker_session or sagemaker.Session()
         self.ssm_manager = SSMManager(region_name=self.sagemaker_session.boto_region_name)
@@ -75,7 +84,7 @@ class SSHEnvironmentWrapper(ABC):
             region = self.sagemaker_session.boto_region_name
             aws = AWS(region)
             endpoint_url = aws.get_sts_endpoint()
-            caller_id = boto3.client("sts", region_name=region, endpoint_url=endpoint_url).get_caller_identity()
+            caller_id = clients.get_caller_identity(region, endpoint_url)
             user_id = caller_id.get('UserId')
         else:
             user_id = self.local_user_id
@@ -92,6 +101,9 @@ class SSHEnvironmentWrapper(ABC):
                     'SSH_OWNER_TAG': user_id,
                     'SSH_LOG_TO_STDOUT': str(self.log_to_stdout).lower(),
                     'SSH_WAIT_TIME_SECONDS': f"{self.connection_wait_time_seconds}"})
+        if self.dependency_bundle:
+            env.update({'SSH_DEPENDENCY_BUNDLE': self.dependency_bundle,
+                        'SSH_DEPENDENCY_BUNDLE_SHA256': self.dependency_bundle_sha256 or ''})
 
     @classmethod
     def ssm_role_from_iam_arn(cls, iam_arn: str):
@@ -165,6 +177,35 @@ class SSHEnvironmentWrapper(ABC):
 
         return ssm_proxy
 
+    def start_multi_node_ssm_connection(self, timeout_in_sec: int = 900,
+                                        extra_args: str = "") -> MultiNodeSSMProxy:
+        """
+        Same as :meth:`start_ssm_connection`, but connects to all instances at once, e.g., all nodes
+        of a distributed training job, with local ports picked automatically.
+        """
+        self.logger.info(f"Starting SSM connection to all nodes")
+        instance_ids = self.get_instance_ids(timeout_in_sec=timeout_in_sec)
+        if not instance_ids:
+            raise ValueError(f"No SSM instances found. Has the SSM Agent been started? "
+                             f"Check the remote logs: {self.get_cloudwatch_url()} "
+                             f"AND the remote metadata: {self.get_metadata_url()}")
+        for instance_id in instance_ids:
+            if "mi-" not in instance_id:
+                raise ValueError(f"instance_id doesn't start with 'mi-': {instance_id}")
+
+        multi_node_proxy = MultiNodeSSMProxy(instance_ids, extra_args, self.sagemaker_session.boto_region_name,
+                                             self.get_cloudwatch_url())
+        try:
+            multi_node_proxy.connect()
+        except Exception as e:
+            self.logger.error(f"Failed to connect to SSM instances: {e}")
+            raise
+
+        if self.connection_wait_time_seconds > 0:
+            multi_node_proxy.terminate_waiting_loop()
+
+        return multi_node_proxy
+
     @staticmethod
     def _is_arn(arn):
         return AWS.is_arn(arn)
@@ -220,9 +261,11 @@ class SSHEstimatorWrapper(SSHEnvironmentWrapper):
     def __init__(self, estimator: sagemaker.estimator.EstimatorBase, ssm_iam_role: str = '',
                  bootstrap_on_start: bool = True, connection_wait_time_seconds: int = 600,
                  ssh_instance_count: int = 2, local_user_id: str = None,
-                 log_to_stdout: bool = False):
+                 log_to_stdout: bool = False,
+                 dependency_bundle: str = None, dependency_bundle_sha256: str = None):
         super().__init__(ssm_iam_role, bootstrap_on_start, connection_wait_time_seconds,
-                         estimator.sagemaker_session, local_user_id, log_to_stdout)
+                         estimator.sagemaker_session, local_user_id, log_to_stdout,
+                         dependency_bundle, dependency_bundle_sha256)
 
         if hasattr(estimator, 'instance_groups') and estimator.instance_groups is not None:
             # TODO: add support for heterogeneous clusters
@@ -287,7 +330,8 @@ class SSHEstimatorWrapper(SSHEnvironmentWrapper):
                connection_wait_time_seconds: int = 600,
                connection_wait_time: timedelta = timedelta(minutes=10),
                ssh_instance_count: int = 2, local_user_id: str = None,
-               log_to_stdout: bool = False) -> SSHEstimatorWrapper:
+               log_to_stdout: bool = False,
+               dependency_bundle: str = None, dependency_bundle_sha256: str = None) -> SSHEstimatorWrapper:
         if connection_wait_time_seconds != connection_wait_time.total_seconds():
             connection_wait_time_seconds = connection_wait_time.total_seconds()
         # noinspection PyProtectedMember
@@ -297,7 +341,8 @@ class SSHEstimatorWrapper(SSHEnvironmentWrapper):
             )
         result = SSHEstimatorWrapper(estimator, connection_wait_time_seconds=connection_wait_time_seconds,
                                      ssh_instance_count=ssh_instance_count, local_user_id=local_user_id,
-                                     log_to_stdout=log_to_stdout)
+                                     log_to_stdout=log_to_stdout, dependency_bundle=dependency_bundle,
+                                     dependency_bundle_sha256=dependency_bundle_sha256)
         result._augment()
         return result
 
@@ -339,9 +384,11 @@ class SSHEstimatorWrapper(SSHEnvironmentWrapper):
 class SSHModelWrapper(SSHEnvironmentWrapper):
     def __init__(self, model: sagemaker.model.Model,
                  ssm_iam_role: str = '',
-                 bootstrap_on_start: bool = True, connection_wait_time_seconds: int = 600):
+                 bootstrap_on_start: bool = True, connection_wait_time_seconds: int = 600,
+                 dependency_bundle: str = None, dependency_bundle_sha256: str = None):
         super().__init__(ssm_iam_role,
-                         bootstrap_on_start, connection_wait_time_seconds, model.sagemaker_session)
+                         bootstrap_on_start, connection_wait_time_seconds, model.sagemaker_session,
+                         dependency_bundle=dependency_bundle, dependency_bundle_sha256=dependency_bundle_sha256)
         if self.ssm_iam_role == '':
             self.ssm_iam_role = SSHEnvironmentWrapper.ssm_role_from_iam_arn(model.role)
         self.model = model
@@ -371,10 +418,13 @@ class SSHModelWrapper(SSHEnvironmentWrapper):
         self.logger.info("Endpoint is ready")
 
     @classmethod
-    def create(cls, model: sagemaker.model.Model, connection_wait_time_seconds: int = 600) -> SSHModelWrapper:
+    def create(cls, model: sagemaker.model.Model, connection_wait_time_seconds: int = 600,
+               dependency_bundle: str = None, dependency_bundle_sha256: str = None) -> SSHModelWrapper:
         if model.endpoint_name:
             raise AssertionError("You should call wrapper.create() before model.deploy().")
-        result: SSHModelWrapper = SSHModelWrapper(model, connection_wait_time_seconds=connection_wait_time_seconds)
+        result: SSHModelWrapper = SSHModelWrapper(model, connection_wait_time_seconds=connection_wait_time_seconds,
+                                                  dependency_bundle=dependency_bundle,
+                                                  dependency_bundle_sha256=dependency_bundle_sha256)
         result._augment()
         return result
 
@@ -391,7 +441,7 @@ class SSHModelWrapper(SSHEnvironmentWrapper):
         return self.ssh_log.get_model_metadata_url(self.model.name)
 
     def endpoint_is_online(self):
-        describe_result = boto3.client('sagemaker').describe_endpoint(EndpointName=self.model.endpoint_name)
+        describe_result = clients.get_client('sagemaker').describe_endpoint(EndpointName=self.model.endpoint_name)
         status = describe_result["EndpointStatus"]
         return status == 'InService'
 
@@ -497,9 +547,11 @@ class SSHProcessorWrapper(SSHEnvironmentWrapper):
     def __init__(self, processor: sagemaker.processing.Processor,
                  ssm_iam_role: str = '',
                  bootstrap_on_start: bool = True,
-                 connection_wait_time_seconds: int = 600):
+                 connection_wait_time_seconds: int = 600,
+                 dependency_bundle: str = None, dependency_bundle_sha256: str = None):
         super().__init__(ssm_iam_role, bootstrap_on_start, connection_wait_time_seconds,
-                         processor.sagemaker_session)
+                         processor.sagemaker_session,
+                         dependency_bundle=dependency_bundle, dependency_bundle_sha256=dependency_bundle_sha256)
         if self.ssm_iam_role == '':
             self.ssm_iam_role = SSHEnvironmentWrapper.ssm_role_from_iam_arn(processor.role)
         self.processor = processor
@@ -546,10 +598,13 @@ class SSHProcessorWrapper(SSHEnvironmentWrapper):
 
     @classmethod
     def create(cls, processor: sagemaker.processing.Processor,
-               connection_wait_time_seconds: int = 600) -> SSHProcessorWrapper:
+               connection_wait_time_seconds: int = 600,
+               dependency_bundle: str = None, dependency_bundle_sha256: str = None) -> SSHProcessorWrapper:
         if processor.latest_job:
             raise AssertionError("You should call wrapper.create() before processor.run()")
-        result = SSHProcessorWrapper(processor, connection_wait_time_seconds=connection_wait_time_seconds)
+        result = SSHProcessorWrapper(processor, connection_wait_time_seconds=connection_wait_time_seconds,
+                                     dependency_bundle=dependency_bundle,
+                                     dependency_bundle_sha256=dependency_bundle_sha256)
         result._augment()
         return result
 
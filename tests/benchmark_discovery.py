@@ -0,0 +1,208 @@
+"""
+Offline benchmark of the instance discovery and listing code paths, against the in-process AWS fakes
+from fake_aws.py, to catch O(N^2) regressions and API call explosions before they reach real accounts.
+
+Reports wall time, peak Python memory and the number of API calls for each operation and fleet size, e.g.:
+
+    python tests/benchmark_discovery.py --fleet-sizes 10,100,1000,10000,50000 --latency-ms 5 --throttling-rate 0.01
+
+The wall time is measured without tracemalloc, and the peak memory in a separate traced run.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+from unittest.mock import patch
+
+# Allow running from any directory without installing the package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_aws import FakeAWS  # noqa: E402
+from sagemaker_ssh_helper import clients  # noqa: E402
+from sagemaker_ssh_helper.interactive_sagemaker import InteractiveSageMaker, SageMaker  # noqa: E402
+from sagemaker_ssh_helper.log import SSHLog  # noqa: E402
+from sagemaker_ssh_helper.manager import SSMManager  # noqa: E402
+
+REGION = 'eu-west-1'
+
+
+class DiscoveryBenchmark:
+    def __init__(self, fake_aws: FakeAWS, tag_fetch_rate_per_second: float = 100000,
+                 measure_memory: bool = True) -> None:
+        """
+        :param tag_fetch_rate_per_second: the fake has no service-side quota, so the client-side limit
+            is raised by default to measure the code rather than the limiter
+        """
+        super().__init__()
+        self.fake_aws = fake_aws
+        self.tag_fetch_rate_per_second = tag_fetch_rate_per_second
+        self.measure_memory = measure_memory
+
+    def _manager(self, inventory_cache: bool = False) -> SSMManager:
+        return SSMManager(region_name=REGION, inventory_cache=inventory_cache,
+                          tag_fetch_rate_per_second=self.tag_fetch_rate_per_second)
+
+    def _interactive(self) -> InteractiveSageMaker:
+        return InteractiveSageMaker(SageMaker(REGION), self._manager(), SSHLog(region_name=REGION))
+
+    def operations(self) -> List[Tuple[str, Callable[[], Callable[[], object]]]]:
+        """
+        :return: pairs of the operation name and its setup, which isn't measured and returns the operation
+        """
+        training_job = self.fake_aws.resources['training-job'][-1]
+
+        def warm_cache_listing():
+            manager = self._manager(inventory_cache=True)
+            manager.list_all_instances_and_fetch_tags()
+            return manager.list_all_instances_and_fetch_tags
+
+        def with_managed_instances(method_name: str):
+            def setup():
+                managed_instances = self._manager().list_all_instances_and_fetch_tags()
+                method = getattr(self._interactive(), method_name)
+                return lambda: method(managed_instances=managed_instances)
+            return setup
+
+        def studio_apps():
+            managed_instances = self._manager().list_all_instances_and_fetch_tags()
+            interactive = self._interactive()
+            return lambda: interactive.list_studio_ide_apps_for_user_and_domain(None, None, managed_instances)
+
+        return [
+            ('list_all_instances_and_fetch_tags (cold)',
+             lambda: self._manager().list_all_instances_and_fetch_tags),
+            ('list_all_instances_and_fetch_tags (warm cache)', warm_cache_listing),
+            ('get_instance_ids_once',
+             lambda: lambda: self._manager().get_instance_ids_once('training-job', training_job)),
+            ('list_expired_ssh_instances',
+             lambda: lambda: self._manager().list_expired_ssh_instances(expiration_days=0)),
+            ('InteractiveSageMaker.list_training_jobs', with_managed_instances('list_training_jobs')),
+            ('InteractiveSageMaker.list_processing_jobs', with_managed_instances('list_processing_jobs')),
+            ('InteractiveSageMaker.list_endpoints', with_managed_instances('list_endpoints')),
+            ('InteractiveSageMaker.list_studio_ide_apps', studio_apps),
+            ('SSHLog._query_log_group',
+             lambda: lambda: SSHLog(region_name=REGION).get_ssm_instance_ids_once(
+                 '/aws/sagemaker/TrainingJobs', training_job)),
+        ]
+
+    def run(self) -> List[Dict]:
+        results = []
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch.dict(os.environ, {'XDG_CACHE_HOME': cache_dir}), \
+                patch('boto3.client', side_effect=self.fake_aws.client):
+            # The shared clients of the previous fleet size belong to another fake
+            clients.clear()
+            try:
+                for name, setup in self.operations():
+                    results.append(self._measure(name, setup))
+            finally:
+                clients.clear()
+        return results
+
+    def _measure(self, name: str, setup: Callable[[], Callable[[], object]]) -> Dict:
+        operation = setup()
+        self.fake_aws.reset_counters()
+        start = time.perf_counter()
+        result = operation()
+        wall_time = time.perf_counter() - start
+        api_calls = dict(self.fake_aws.calls)
+        throttled_calls = sum(self.fake_aws.throttled_calls.values())
+
+        peak_memory = None
+        if self.measure_memory:
+            operation = setup()
+            tracemalloc.start()
+            try:
+                operation()
+                peak_memory = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        return {'Operation': name, 'FleetSize': self.fake_aws.fleet_size, 'WallTimeInSec': wall_time,
+                'PeakMemoryInBytes': peak_memory, 'ApiCalls': sum(api_calls.values()),
+                'ApiCallsByOperation': api_calls, 'ThrottledCalls': throttled_calls,
+                'ResultSize': len(result), 'Result': result}
+
+
+def run_benchmark(fleet_sizes: List[int], latency_in_ms: float = 0, throttling_rate: float = 0,
+                  measure_memory: bool = True) -> List[Dict]:
+    results = []
+    for fleet_size in fleet_sizes:
+        fake_aws = FakeAWS(fleet_size, latency_in_ms=latency_in_ms, throttling_rate=throttling_rate,
+                           region_name=REGION)
+        results += DiscoveryBenchmark(fake_aws, measure_memory=measure_memory).run()
+    return results
+
+
+def check_scaling(results: List[Dict], max_growth: float = 3.0) -> List[str]:
+    """
+    Flag operations whose API calls or wall time per instance grow with the fleet size,
+    comparing each fleet size with the previous one. The time check ignores runs faster than 50 ms,
+    where the constant overhead dominates.
+
+    :return: a list of problems, empty if everything scales linearly or better
+    """
+    problems = []
+    by_operation: Dict[str, List[Dict]] = {}
+    for result in results:
+        by_operation.setdefault(result['Operation'], []).append(result)
+    for operation, runs in by_operation.items():
+        runs.sort(key=lambda run: run['FleetSize'])
+        for previous, current in zip(runs, runs[1:]):
+            size_ratio = current['FleetSize'] / previous['FleetSize']
+            if current['ApiCalls'] > max(previous['ApiCalls'], 1) * size_ratio * max_growth:
+                problems.append(f"{operation}: {previous['ApiCalls']} -> {current['ApiCalls']} API calls "
+                                f"for {previous['FleetSize']} -> {current['FleetSize']} instances")
+            if current['WallTimeInSec'] > 0.05 and \
+                    current['WallTimeInSec'] > max(previous['WallTimeInSec'], 0.05) * size_ratio * max_growth:
+                problems.append(f"{operation}: {previous['WallTimeInSec']:.3f} -> {current['WallTimeInSec']:.3f} s "
+                                f"for {previous['FleetSize']} -> {current['FleetSize']} instances")
+    return problems
+
+
+def format_results(results: List[Dict]) -> str:
+    lines = [f"{'Operation':<48} {'Instances':>9} {'Time, s':>9} {'Peak, MiB':>10} {'API calls':>10} "
+             f"{'Throttled':>10} {'Results':>8}"]
+    for result in results:
+        peak_memory = result['PeakMemoryInBytes']
+        peak_memory = f"{peak_memory / 1024 / 1024:>10.2f}" if peak_memory is not None else f"{'-':>10}"
+        lines.append(f"{result['Operation']:<48} {result['FleetSize']:>9} {result['WallTimeInSec']:>9.3f} "
+                     f"{peak_memory} {result['ApiCalls']:>10} {result['ThrottledCalls']:>10} "
+                     f"{result['ResultSize']:>8}")
+    return "\n".join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark SSH Helper instance discovery against fake AWS APIs.")
+    parser.add_argument('--fleet-sizes', default='10,100,1000,10000',
+                        help="comma-separated numbers of SSM managed instances")
+    parser.add_argument('--latency-ms', type=float, default=0, help="latency added to every API call")
+    parser.add_argument('--throttling-rate', type=float, default=0,
+                        help="share of ListTagsForResource calls that are throttled, from 0 to 1")
+    parser.add_argument('--no-memory', action='store_true', help="skip the peak memory measurement")
+    parser.add_argument('--check-scaling', action='store_true',
+                        help="exit with an error if any operation scales worse than linearly")
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.WARNING)
+    fleet_sizes = [int(size) for size in args.fleet_sizes.split(',')]
+    if any(size <= 0 for size in fleet_sizes):
+        parser.error("Fleet sizes must be positive")
+    results = run_benchmark(fleet_sizes, args.latency_ms, args.throttling_rate, not args.no_memory)
+    print(format_results(results))
+
+    if args.check_scaling:
+        problems = check_scaling(results)
+        for problem in problems:
+            print(f"Scales worse than linearly: {problem}", file=sys.stderr)
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
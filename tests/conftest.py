@@ -1,3 +1,7 @@
+import pytest
+
+from sagemaker_ssh_helper import clients
+
 
 def pytest_addoption(parser):
     parser.addini('sagemaker_studio_domain', '')
@@ -7,3 +11,17 @@ def pytest_addoption(parser):
     parser.addini('sagemaker_role', '')
     parser.addini('sns_notification_topic_arn', '')
     parser.addini('sagemaker_notebook_instance', '')
+
+
+@pytest.fixture(autouse=True)
+def clear_shared_clients():
+    # Tests patch boto3.client, so the clients shared across the process must not leak between them
+    clients.clear()
+    yield
+    clients.clear()
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache_dir(tmp_path_factory, monkeypatch):
+    # The local caches are on by default, keep them out of the real ~/.cache
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path_factory.mktemp('cache')))
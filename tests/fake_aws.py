@@ -0,0 +1,325 @@
+"""
+In-process stand-in for the SSM, SageMaker and CloudWatch Logs APIs used by the discovery and listing code,
+for offline tests and benchmarks, see benchmark_discovery.py.
+
+The fake generates a fleet of SSH Helper managed instances for training jobs, processing jobs,
+inference endpoints and Studio apps, counts every API call and can inject latency and throttling.
+Patch it into boto3 with `patch('boto3.client', side_effect=fake_aws.client)`.
+"""
+
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Set
+
+from botocore.exceptions import ClientError
+
+ACCOUNT_ID = '555555555555'
+DOMAIN_ID = 'd-0123456789ab'
+REGISTRATION_MESSAGE = "Successfully registered the instance with AWS SSM using Managed instance-id: "
+
+
+class FakeInstance:
+    def __init__(self, index: int, resource_type: str, resource_name: str, arn: str, ping_status: str,
+                 timestamp: int, space_name: str = None) -> None:
+        super().__init__()
+        self.instance_id = f"mi-{index:017x}"
+        self.resource_type = resource_type
+        self.resource_name = resource_name
+        self.space_name = space_name
+        self.ping_status = ping_status
+        self.tags = {
+            'SSHResourceName': resource_name,
+            'SSHResourceArn': arn,
+            'SSHOwner': 'AIDACKCEVSQ6C2EXAMPLE:janedoe@SSO',
+            'SSHCreator': '',
+            'SSHTimestamp': str(timestamp),
+        }
+
+
+class FakeAWS:
+    THROTTLED_OPERATIONS = ('ListTagsForResource',)
+
+    def __init__(self, fleet_size: int, latency_in_ms: float = 0, throttling_rate: float = 0,
+                 throttled_operations=THROTTLED_OPERATIONS, region_name: str = 'eu-west-1',
+                 log_events_per_instance: int = 3, seed: int = 42) -> None:
+        """
+        :param fleet_size: number of SSM managed instances
+        :param latency_in_ms: added to every API call
+        :param throttling_rate: the share of calls to the throttled operations that fail with ThrottlingException
+        :param log_events_per_instance: unrelated log events per instance, to make the log queries scan something
+        """
+        super().__init__()
+        self.fleet_size = fleet_size
+        self.latency_in_ms = latency_in_ms
+        self.throttling_rate = throttling_rate
+        self.throttled_operations: Set[str] = set(throttled_operations)
+        self.region_name = region_name
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls: Counter = Counter()
+        self.throttled_calls: Counter = Counter()
+        self.queries: Dict[str, List] = {}
+
+        self.instances: List[FakeInstance] = [self._new_instance(i) for i in range(fleet_size)]
+        self.instances_by_id = {instance.instance_id: instance for instance in self.instances}
+        self.instances_by_tag: Dict[tuple, List[FakeInstance]] = defaultdict(list)
+        for instance in self.instances:
+            for key, value in instance.tags.items():
+                self.instances_by_tag[(key, value)].append(instance)
+        self.resources: Dict[str, List[str]] = defaultdict(list)
+        for instance in self.instances:
+            names = self.resources[instance.resource_type]
+            if not names or names[-1] != instance.resource_name:
+                names.append(instance.resource_name)
+        self.log_events: Dict[str, List[Dict]] = self._generate_log_events(log_events_per_instance)
+
+    def _new_instance(self, i: int) -> FakeInstance:
+        group, kind = divmod(i, 10)
+        timestamp = 1700000000 + i
+        ping_status = 'ConnectionLost' if i % 7 == 0 else 'Online'
+        arn_prefix = f"arn:aws:sagemaker:{self.region_name}:{ACCOUNT_ID}"
+        if kind < 6:
+            # Two-node training jobs
+            name = f"ssh-training-{group * 3 + kind // 2}"
+            return FakeInstance(i, 'training-job', name, f"{arn_prefix}:training-job/{name}", ping_status, timestamp)
+        if kind < 8:
+            name = f"ssh-endpoint-{group}"
+            return FakeInstance(i, 'endpoint', name, f"{arn_prefix}:endpoint/{name}", ping_status, timestamp)
+        if kind == 8:
+            name = f"ssh-app-{group}"
+            space_name = f"space-{group % 100}"
+            return FakeInstance(i, 'app', name, f"{arn_prefix}:app/{DOMAIN_ID}/{space_name}/JupyterLab/{name}",
+                                ping_status, timestamp, space_name)
+        name = f"ssh-processing-{group}"
+        return FakeInstance(i, 'processing-job', name, f"{arn_prefix}:processing-job/{name}", ping_status, timestamp)
+
+    def _generate_log_events(self, log_events_per_instance: int) -> Dict[str, List[Dict]]:
+        log_events = defaultdict(list)
+        for instance in self.instances:
+            if instance.resource_type == 'endpoint':
+                log_group = f"/aws/sagemaker/Endpoints/{instance.resource_name}"
+                stream = f"AllTraffic/i-{instance.instance_id[3:]}"
+            elif instance.resource_type == 'training-job':
+                log_group = '/aws/sagemaker/TrainingJobs'
+                stream = f"{instance.resource_name}/algo-{instance.instance_id[-1]}-1700000000"
+            else:
+                continue
+            timestamp = int(instance.tags['SSHTimestamp']) * 1000
+            for k in range(log_events_per_instance):
+                log_events[log_group].append({'timestamp': timestamp + k, 'logStreamName': stream,
+                                              'message': f"Training step {k} of {instance.resource_name}"})
+            log_events[log_group].append({'timestamp': timestamp + log_events_per_instance, 'logStreamName': stream,
+                                          'message': REGISTRATION_MESSAGE + instance.instance_id})
+        return log_events
+
+    def client(self, service_name: str, region_name: Optional[str] = None, **kwargs) -> 'FakeClient':
+        services = {'ssm': FakeSSM, 'sagemaker': FakeSageMaker, 'logs': FakeLogs}
+        if service_name not in services:
+            raise ValueError(f"Service {service_name} is not faked")
+        return services[service_name](self, service_name)
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.throttled_calls.clear()
+
+    def total_calls(self) -> int:
+        with self.lock:
+            return sum(self.calls.values())
+
+    def _call(self, service_name: str, operation: str):
+        with self.lock:
+            self.calls[f"{service_name}.{operation}"] += 1
+            is_throttled = operation in self.throttled_operations and self.random.random() < self.throttling_rate
+            if is_throttled:
+                self.throttled_calls[f"{service_name}.{operation}"] += 1
+        if self.latency_in_ms:
+            time.sleep(self.latency_in_ms / 1000)
+        if is_throttled:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, operation)
+
+
+class FakePaginator:
+    def __init__(self, method, token_key: str) -> None:
+        super().__init__()
+        self.method = method
+        self.token_key = token_key
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            page = self.method(**kwargs, **({self.token_key: token} if token else {}))
+            yield page
+            token = page.get(self.token_key)
+            if not token:
+                return
+
+
+class FakeClient:
+    PAGINATORS: Dict[str, str] = {}
+
+    def __init__(self, fake_aws: FakeAWS, service_name: str) -> None:
+        super().__init__()
+        self.fake_aws = fake_aws
+        self.service_name = service_name
+        self.meta = SimpleNamespace(events=SimpleNamespace(register=lambda *args, **kwargs: None),
+                                    region_name=fake_aws.region_name,
+                                    endpoint_url=f"https://{service_name}.{fake_aws.region_name}.amazonaws.com")
+
+    def get_paginator(self, operation_name: str) -> FakePaginator:
+        return FakePaginator(getattr(self, operation_name), self.PAGINATORS[operation_name])
+
+    def _call(self, operation: str):
+        self.fake_aws._call(self.service_name, operation)
+
+    @staticmethod
+    def _page(items: list, token: Optional[str], page_size: int):
+        start = int(token) if token else 0
+        end = start + page_size
+        return items[start:end], (str(end) if end < len(items) else None)
+
+
+class FakeSSM(FakeClient):
+    def describe_instance_information(self, Filters=(), NextToken='', MaxResults=50, **kwargs):
+        self._call('DescribeInstanceInformation')
+        instances = self.fake_aws.instances
+        for instance_filter in Filters:
+            key, values = instance_filter['Key'], instance_filter['Values']
+            if key.startswith('tag:'):
+                instances = [instance for value in values
+                             for instance in self.fake_aws.instances_by_tag.get((key[len('tag:'):], value), [])]
+            elif key == 'InstanceIds':
+                instances = [self.fake_aws.instances_by_id[i] for i in values if i in self.fake_aws.instances_by_id]
+        page, next_token = self._page(instances, NextToken, min(MaxResults, 50))
+        response = {'InstanceInformationList': [{'InstanceId': instance.instance_id,
+                                                 'PingStatus': instance.ping_status,
+                                                 'ResourceType': 'ManagedInstance'} for instance in page]}
+        if next_token:
+            response['NextToken'] = next_token
+        return response
+
+    def list_tags_for_resource(self, ResourceType, ResourceId):
+        self._call('ListTagsForResource')
+        instance = self.fake_aws.instances_by_id[ResourceId]
+        return {'TagList': [{'Key': key, 'Value': value} for key, value in instance.tags.items()]}
+
+
+class FakeSageMaker(FakeClient):
+    PAGE_SIZE = 100
+
+    def _list(self, operation: str, list_key: str, items: List[Dict], NextToken=None):
+        self._call(operation)
+        page, next_token = self._page(items, NextToken, self.PAGE_SIZE)
+        response = {list_key: page}
+        if next_token:
+            response['NextToken'] = next_token
+        return response
+
+    def list_training_jobs(self, CreationTimeAfter=None, NextToken=None):
+        return self._list('ListTrainingJobs', 'TrainingJobSummaries', [
+            {'TrainingJobName': name, 'TrainingJobStatus': 'InProgress'}
+            for name in self.fake_aws.resources['training-job']], NextToken)
+
+    def list_processing_jobs(self, CreationTimeAfter=None, NextToken=None):
+        return self._list('ListProcessingJobs', 'ProcessingJobSummaries', [
+            {'ProcessingJobName': name, 'ProcessingJobStatus': 'InProgress'}
+            for name in self.fake_aws.resources['processing-job']], NextToken)
+
+    def list_transform_jobs(self, CreationTimeAfter=None, NextToken=None):
+        return self._list('ListTransformJobs', 'TransformJobSummaries', [], NextToken)
+
+    def list_notebook_instances(self, NextToken=None):
+        return self._list('ListNotebookInstances', 'NotebookInstances', [], NextToken)
+
+    def list_endpoints(self, NextToken=None):
+        return self._list('ListEndpoints', 'Endpoints', [
+            {'EndpointName': name, 'EndpointStatus': 'InService'}
+            for name in self.fake_aws.resources['endpoint']], NextToken)
+
+    def list_apps(self, NextToken=None, DomainIdEquals=None, SpaceNameEquals=None):
+        apps = [{'DomainId': DOMAIN_ID, 'SpaceName': instance.space_name, 'AppName': instance.resource_name,
+                 'AppType': 'JupyterLab', 'Status': 'InService'}
+                for instance in self.fake_aws.instances if instance.resource_type == 'app'
+                and (not SpaceNameEquals or instance.space_name == SpaceNameEquals)]
+        return self._list('ListApps', 'Apps', apps, NextToken)
+
+
+class FakeLogs(FakeClient):
+    PAGINATORS = {'describe_log_groups': 'nextToken', 'filter_log_events': 'nextToken'}
+    PAGE_SIZE = 50
+
+    def describe_log_groups(self, logGroupNamePrefix='', nextToken=None):
+        self._call('DescribeLogGroups')
+        names = sorted(name for name in self.fake_aws.log_events if name.startswith(logGroupNamePrefix))
+        page, next_token = self._page(names, nextToken, self.PAGE_SIZE)
+        response = {'logGroups': [{'logGroupName': name} for name in page]}
+        if next_token:
+            response['nextToken'] = next_token
+        return response
+
+    def filter_log_events(self, logGroupName, logStreamNamePrefix='', filterPattern='', startTime=0,
+                          nextToken=None):
+        self._call('FilterLogEvents')
+        pattern = filterPattern.strip('"')
+        events = [event for event in self.fake_aws.log_events.get(logGroupName, [])
+                  if event['logStreamName'].startswith(logStreamNamePrefix) and pattern in event['message']
+                  and event['timestamp'] >= startTime]
+        page, next_token = self._page(events, nextToken, self.PAGE_SIZE)
+        response = {'events': page}
+        if next_token:
+            response['nextToken'] = next_token
+        return response
+
+    def start_query(self, logGroupNames, startTime, endTime, queryString):
+        self._call('StartQuery')
+        missing = [name for name in logGroupNames if name not in self.fake_aws.log_events]
+        if missing:
+            raise ClientError({'Error': {'Code': 'ResourceNotFoundException',
+                                         'Message': f"Log group {missing[0]} does not exist"}}, 'StartQuery')
+        query_id = str(uuid.uuid4())
+        results = self._run_query(logGroupNames, queryString)
+        with self.fake_aws.lock:
+            self.fake_aws.queries[query_id] = results
+        return {'queryId': query_id}
+
+    def get_query_results(self, queryId):
+        self._call('GetQueryResults')
+        with self.fake_aws.lock:
+            results = self.fake_aws.queries.pop(queryId)
+        return {'status': 'Complete', 'results': results}
+
+    def stop_query(self, queryId):
+        self._call('StopQuery')
+        return {'success': True}
+
+    def _run_query(self, log_groups: List[str], query: str) -> List[List[Dict]]:
+        # Only the query shapes used by SSHLog are supported
+        stream_filter = re.search(r"@logStream like '([^']*)'", query).group(1)
+        message_filter = re.compile(re.search(r"@message like /(.*?)/", query).group(1))
+        limit = int(re.search(r"limit (\d+)", query).group(1))
+        matches = [(log_group, event) for log_group in log_groups for event in self.fake_aws.log_events[log_group]
+                   if stream_filter in event['logStreamName'] and message_filter.search(event['message'])]
+        matches.sort(key=lambda match: match[1]['timestamp'], reverse=True)
+        if "stats max(@timestamp) as latest by @log, instance_id" in query:
+            latest = {}
+            for log_group, event in matches:
+                key = (log_group, event['message'].split('instance-id: ', 1)[1])
+                latest.setdefault(key, event['timestamp'])
+            return [[{'field': '@log', 'value': f"{ACCOUNT_ID}:{log_group}"},
+                     {'field': 'instance_id', 'value': instance_id},
+                     {'field': 'latest', 'value': self._format_timestamp(timestamp)}]
+                    for (log_group, instance_id), timestamp in list(latest.items())[:limit]]
+        return [[{'field': '@timestamp', 'value': self._format_timestamp(event['timestamp'])},
+                 {'field': '@logStream', 'value': event['logStreamName']},
+                 {'field': '@message', 'value': event['message']}]
+                for _, event in matches[:limit]]
+
+    @staticmethod
+    def _format_timestamp(timestamp_in_ms: int) -> str:
+        return (datetime(1970, 1, 1) + timedelta(milliseconds=timestamp_in_ms)).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
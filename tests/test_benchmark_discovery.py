@@ -0,0 +1,57 @@
+import math
+
+from benchmark_discovery import run_benchmark, check_scaling, format_results
+
+
+def _by_operation(results, fleet_size):
+    return {result['Operation']: result for result in results if result['FleetSize'] == fleet_size}
+
+
+def test_discovery_benchmark_scales_linearly():
+    results = run_benchmark([10, 200])
+    print(format_results(results))
+
+    small, large = _by_operation(results, 10), _by_operation(results, 200)
+    pages = math.ceil(200 / 50)
+
+    cold = large['list_all_instances_and_fetch_tags (cold)']
+    assert cold['ResultSize'] == 200
+    assert cold['ApiCallsByOperation'] == {'ssm.DescribeInstanceInformation': pages,
+                                           'ssm.ListTagsForResource': 200}
+
+    warm = large['list_all_instances_and_fetch_tags (warm cache)']
+    assert warm['ResultSize'] == 200
+    assert warm['ApiCallsByOperation'] == {'ssm.DescribeInstanceInformation': pages}
+
+    # Tag filters narrow down the inventory on the SSM side, so the cost doesn't depend on the fleet size
+    assert large['get_instance_ids_once']['ApiCalls'] == small['get_instance_ids_once']['ApiCalls'] == 3
+    assert large['get_instance_ids_once']['ResultSize'] == 2
+    assert large['SSHLog._query_log_group']['ResultSize'] == 2
+
+    assert large['InteractiveSageMaker.list_training_jobs']['ResultSize'] == 60
+    assert all(job.ssm_instance_id for job in large['InteractiveSageMaker.list_training_jobs']['Result'])
+    assert all(endpoint.ssm_instance_id for endpoint in large['InteractiveSageMaker.list_endpoints']['Result'])
+    assert all(app.ssm_instance_id for app in large['InteractiveSageMaker.list_studio_ide_apps']['Result'])
+
+    assert check_scaling(results) == []
+
+
+def test_discovery_benchmark_with_throttling():
+    results = run_benchmark([100], throttling_rate=0.2, measure_memory=False)
+
+    cold = _by_operation(results, 100)['list_all_instances_and_fetch_tags (cold)']
+    assert cold['ResultSize'] == 100
+    assert cold['ThrottledCalls'] > 0
+    assert cold['ApiCallsByOperation']['ssm.ListTagsForResource'] == 100 + cold['ThrottledCalls']
+
+
+def test_check_scaling_detects_quadratic_api_calls():
+    results = [
+        {'Operation': 'quadratic', 'FleetSize': 10, 'WallTimeInSec': 0.001, 'ApiCalls': 100},
+        {'Operation': 'quadratic', 'FleetSize': 1000, 'WallTimeInSec': 0.001, 'ApiCalls': 1000000},
+        {'Operation': 'linear', 'FleetSize': 10, 'WallTimeInSec': 0.1, 'ApiCalls': 10},
+        {'Operation': 'linear', 'FleetSize': 1000, 'WallTimeInSec': 10.0, 'ApiCalls': 1000},
+    ]
+    problems = check_scaling(results)
+    assert len(problems) == 1
+    assert problems[0].startswith('quadratic: 100 -> 1000000 API calls')
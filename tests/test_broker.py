@@ -0,0 +1,112 @@
+import socket
+import threading
+import time
+
+import pytest
+from mock.mock import Mock, patch
+
+from sagemaker_ssh_helper.broker import SSMSessionBroker, BrokerClient, BrokerTarget
+
+
+def _start_echo_server():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('localhost', 0))
+    server.listen()
+
+    def serve():
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            with connection:
+                while True:
+                    data = connection.recv(1024)
+                    if not data:
+                        break
+                    connection.sendall(data)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server
+
+
+def _start_broker(tmp_path, **kwargs):
+    broker = SSMSessionBroker(str(tmp_path / 'broker.sock'), boto_session=Mock(), **kwargs)
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+    client = BrokerClient(broker.socket_path)
+    for _ in range(50):
+        if client.is_running():
+            break
+        time.sleep(0.1)
+    return broker, client
+
+
+def _fake_target(local_port):
+    process = Mock()
+    process.poll.return_value = None
+    return BrokerTarget(Mock(), 'mi-01234567890abcd01',
+                        'SHA256:fake', False, local_port, 'session-1', process)
+
+
+def test_broker_reuses_warm_session_and_evicts_idle_ones(tmp_path):
+    echo_server = _start_echo_server()
+    broker, client = _start_broker(tmp_path, idle_timeout_in_sec=3600)
+    try:
+        target = _fake_target(echo_server.getsockname()[1])
+        broker._start_target = Mock(return_value=target)
+
+        for message in [b'SSH-2.0-first\r\n', b'SSH-2.0-second\r\n']:
+            sock = client.connect('ssh-job.training.sagemaker')
+            sock.sendall(message)
+            assert sock.recv(1024) == message
+            sock.shutdown(socket.SHUT_WR)
+            assert sock.recv(1024) == b''
+            sock.close()
+
+        broker._start_target.assert_called_once_with('ssh-job.training.sagemaker', '', '')
+        for _ in range(50):
+            if target.active_connections == 0:
+                break
+            time.sleep(0.1)
+        assert target.connection_count == 2
+
+        broker.evict_idle_targets()
+        assert 'ssh-job.training.sagemaker' in broker.targets
+        broker.idle_timeout_in_sec = 0
+        broker.evict_idle_targets()
+        assert 'ssh-job.training.sagemaker' not in broker.targets
+        target.process.terminate.assert_called_once()
+        target.proxy_command.ssm.terminate_session.assert_called_once_with(SessionId='session-1')
+    finally:
+        broker.shutdown()
+        echo_server.close()
+
+
+def test_broker_reports_connection_errors_to_client(tmp_path):
+    broker, client = _start_broker(tmp_path)
+    try:
+        broker._start_target = Mock(side_effect=ValueError("No SSM instances found"))
+        with pytest.raises(ValueError, match="No SSM instances found"):
+            client.connect('ssh-job.training.sagemaker')
+    finally:
+        broker.shutdown()
+
+
+def test_broker_checks_remembered_key_in_background(tmp_path):
+    echo_server = _start_echo_server()
+    broker = SSMSessionBroker(socket_path=str(tmp_path / 'broker.sock'), boto_session=Mock())
+    key_checked = threading.Event()
+    proxy_command = Mock()
+    proxy_command.authorize.return_value = ('mi-01234567890abcd01', 'SHA256:fake', True)
+    proxy_command.start_port_forwarding_session.return_value = ('session-1', Mock(**{'poll.return_value': None}))
+    proxy_command.check_key.side_effect = lambda *args: key_checked.wait(5)
+    broker._new_proxy_command = Mock(return_value=proxy_command)
+    try:
+        with patch('sagemaker_ssh_helper.proxy.SSMProxy.find_free_port', return_value=echo_server.getsockname()[1]):
+            target = broker._start_target('ssh-job.training.sagemaker', '', '')
+        # The session is ready before the check has finished
+        assert target.local_port == echo_server.getsockname()[1]
+        proxy_command.check_key.assert_called_once_with('mi-01234567890abcd01', 'SHA256:fake')
+    finally:
+        key_checked.set()
+        echo_server.close()
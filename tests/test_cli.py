@@ -1,3 +1,18 @@
+import base64
+import os
+import signal
+import time
+
+import pytest
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError
+from mock.mock import Mock, patch
+
+from sagemaker_ssh_helper.inventory_cache import DefaultBucketCache
+from sagemaker_ssh_helper.interactive_sagemaker import SageMaker, SageMakerNotebookInstance, SageMakerTrainingJob
+from sagemaker_ssh_helper.manager import SSMManager
+from sagemaker_ssh_helper.proxy_command import SSMProxyCommand
+from sagemaker_ssh_helper import sm_ssh
 from sagemaker_ssh_helper.sm_ssh import SageMakerSecureShellHelper
 
 
@@ -13,6 +28,15 @@ def test_fqdn_to_type():
     assert sm_ssh.fqdn_to_type("ssh-helper-notebook.notebook.sagemaker") == "notebook"
 
 
+def test_start_proxy_options_go_before_fqdn():
+    for argv in [['start-proxy', '--native', 'ssh-training-job.training.sagemaker'],
+                 ['start-proxy', 'ssh-training-job.training.sagemaker', '--native']]:
+        with patch('sys.argv', ['sm-ssh'] + argv), patch.dict('os.environ'), \
+                patch.object(SageMakerSecureShellHelper, 'start_proxy') as start_proxy:
+            sm_ssh.main()
+        start_proxy.assert_called_once_with('ssh-training-job.training.sagemaker', True, False)
+
+
 def test_fqdn_to_name():
     sm_ssh = SageMakerSecureShellHelper()
     assert sm_ssh.fqdn_to_name("ssh-training-job.training.sagemaker") == "ssh-training-job"
@@ -45,3 +69,219 @@ def test_fqdn_to_studio_user_and_domain():
     assert sm_ssh.fqdn_to_studio_user_name(
         "test-data-science.d-egm0dexample.studio.sagemaker"
     ) == "test-data-science"
+
+
+def test_list_fetches_ssm_inventory_once_and_prints_in_stable_order(capsys):
+    with patch.object(SSMManager, 'list_all_instances_and_fetch_tags', return_value={}) as list_instances, \
+            patch.object(SageMaker, '__init__', return_value=None), \
+            patch.object(SageMaker, 'list_ide_apps', return_value=[]), \
+            patch.object(SageMaker, 'list_endpoints', return_value=[]), \
+            patch.object(SageMaker, 'list_processing_jobs', return_value=[]), \
+            patch.object(SageMaker, 'list_transform_jobs', return_value=[]), \
+            patch.object(SageMaker, 'list_notebook_instances',
+                         return_value=[SageMakerNotebookInstance("ssh-notebook", "InService")]), \
+            patch.object(SageMaker, 'list_training_jobs',
+                         return_value=[SageMakerTrainingJob("ssh-training-job", "InProgress")]):
+        SageMakerSecureShellHelper().list("sagemaker")
+
+    assert list_instances.call_count == 1
+    out = capsys.readouterr().out
+    assert out.index("ssh-training-job.training.sagemaker") < out.index("ssh-notebook.notebook.sagemaker")
+
+
+def _fake_ssh_keygen(args, **_):
+    with open(args[args.index('-f') + 1], 'w') as f:
+        f.write("fake private key\n")
+    with open(args[args.index('-f') + 1] + '.pub', 'w') as f:
+        f.write(f"ecdsa-sha2-nistp256 {base64.b64encode(b'fake-public-key').decode()} user@host\n")
+
+
+def test_native_proxy_runs_in_process_with_the_same_clients(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.delenv('XDG_CACHE_HOME', raising=False)
+    monkeypatch.setenv('SSH_AUTHORIZED_KEYS_PATH', 's3://ssh-keys-bucket/keys')
+    ssm = Mock()
+    ssm.describe_instance_information.return_value = {
+        'InstanceInformationList': [{'InstanceId': 'mi-01234567890abcd01', 'PingStatus': 'Online'}]
+    }
+    ssm.send_command.return_value = {'Command': {'CommandId': 'command-1'}}
+    ssm.get_command_invocation.side_effect = [
+        ClientError({'Error': {'Code': 'InvocationDoesNotExist'}}, 'GetCommandInvocation'),
+        {'Status': 'InProgress'},
+        {'Status': 'Success', 'StandardOutputContent': '', 'StandardErrorContent': ''},
+    ]
+    ssm.start_session.return_value = {'SessionId': 'session-1', 'TokenValue': 'token', 'StreamUrl': 'wss://'}
+    ssm.meta.endpoint_url = 'https://ssm.eu-west-1.amazonaws.com'
+    s3 = Mock()
+    boto_session = Mock(region_name='eu-west-1')
+    boto_session.client.side_effect = lambda service_name: {'ssm': ssm, 's3': s3}[service_name]
+
+    proxy = SSMProxyCommand('ssh-job.training.sagemaker', boto_session=boto_session)
+    proxy.resolve_instance_id = Mock(return_value='mi-01234567890abcd01')
+    with patch('subprocess.check_call', side_effect=_fake_ssh_keygen) as keygen, \
+            patch('subprocess.call', return_value=0) as plugin:
+        assert proxy.run() == 0
+
+    assert keygen.call_args[0][0][0] == 'ssh-keygen'
+    s3.upload_file.assert_called_once_with(str(tmp_path / '.ssh' / 'ssh-job.training.sagemaker.pub'),
+                                           'ssh-keys-bucket', 'keys/ssh-job.training.sagemaker.pub')
+    commands = ssm.send_command.call_args[1]['Parameters']['commands']
+    assert 'aws s3 cp "s3://ssh-keys-bucket/keys/ssh-job.training.sagemaker.pub" /etc/ssh/authorized_keys.d/' \
+           in commands
+    assert ssm.get_command_invocation.call_count == 3
+    plugin_args = plugin.call_args[0][0]
+    assert plugin_args[0] == 'session-manager-plugin'
+    assert plugin_args[2:4] == ['eu-west-1', 'StartSession']
+    assert ssm.start_session.call_args[1]['Target'] == 'mi-01234567890abcd01'
+    assert boto_session.client.call_count == 2
+
+
+def test_native_proxy_skips_publication_of_already_authorized_key(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    (tmp_path / '.ssh').mkdir()
+    _fake_ssh_keygen(['ssh-keygen', '-f', str(tmp_path / '.ssh' / 'ssh-job.training.sagemaker')])
+    ssm = Mock()
+    ssm.describe_instance_information.return_value = {
+        'InstanceInformationList': [{'InstanceId': 'mi-01234567890abcd01', 'PingStatus': 'Online'}]
+    }
+    ssm.start_session.return_value = {'SessionId': 'session-1', 'TokenValue': 'token', 'StreamUrl': 'wss://'}
+    ssm.send_command.return_value = {'Command': {'CommandId': 'command-1'}}
+    ssm.get_command_invocation.return_value = {'Status': 'Success', 'StandardOutputContent': 'Key found\n'}
+    boto_session = Mock(region_name='eu-west-1')
+    boto_session.client.return_value = ssm
+
+    proxy = SSMProxyCommand('ssh-job.training.sagemaker', boto_session=boto_session)
+    proxy.resolve_instance_id = Mock(return_value='mi-01234567890abcd01')
+    proxy.publish_key = Mock()
+    fingerprint = proxy.get_key_fingerprint(str(tmp_path / '.ssh' / 'ssh-job.training.sagemaker'))
+    assert fingerprint.startswith('SHA256:')
+
+    with patch('subprocess.call', return_value=0):
+        assert proxy.run() == 0
+        assert proxy.run() == 0
+        assert proxy.run() == 0
+    # Published only once, and the next connections don't even check the instance status
+    assert proxy.publish_key.call_count == 1
+    assert ssm.describe_instance_information.call_count == 1
+    assert ssm.start_session.call_count == 3
+    # Only checked that the remembered key is still on the instance
+    assert ssm.send_command.call_count == 2
+    commands = ssm.send_command.call_args[1]['Parameters']['commands']
+    assert commands == [f"grep -qF '{base64.b64encode(b'fake-public-key').decode()}' /etc/ssh/authorized_keys "
+                        f"&& echo 'Key found' || echo 'Key not found'"]
+    assert proxy.authorized_keys_cache.is_authorized('mi-01234567890abcd01', fingerprint)
+
+
+def test_native_proxy_publishes_again_remembered_key_missing_on_instance(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    (tmp_path / '.ssh').mkdir()
+    _fake_ssh_keygen(['ssh-keygen', '-f', str(tmp_path / '.ssh' / 'ssh-job.training.sagemaker')])
+    ssm = Mock()
+    ssm.start_session.return_value = {'SessionId': 'session-1', 'TokenValue': 'token', 'StreamUrl': 'wss://'}
+    ssm.send_command.return_value = {'Command': {'CommandId': 'command-1'}}
+    # E.g., replaced by the key with the same name from another machine
+    ssm.get_command_invocation.return_value = {'Status': 'Success', 'StandardOutputContent': 'Key not found\n'}
+    boto_session = Mock(region_name='eu-west-1')
+    boto_session.client.return_value = ssm
+
+    proxy = SSMProxyCommand('ssh-job.training.sagemaker', boto_session=boto_session)
+    proxy.resolve_instance_id = Mock(return_value='mi-01234567890abcd01')
+    fingerprint = proxy.get_key_fingerprint(str(tmp_path / '.ssh' / 'ssh-job.training.sagemaker'))
+    proxy.authorized_keys_cache.add('mi-01234567890abcd01', fingerprint)
+    authorized_when_published = []
+    proxy.publish_key = Mock(side_effect=lambda *args: authorized_when_published.append(
+        proxy.authorized_keys_cache.is_authorized('mi-01234567890abcd01', fingerprint)))
+
+    # The SSH client fails to authenticate and the session ends, but the key check completes before the exit
+    with patch('subprocess.call', return_value=0):
+        assert proxy.run() == 0
+    proxy.publish_key.assert_called_once_with('mi-01234567890abcd01',
+                                              str(tmp_path / '.ssh' / 'ssh-job.training.sagemaker'))
+    # Forgotten first, so that if publishing fails, the next connection tries again
+    assert authorized_when_published == [False]
+    assert proxy.authorized_keys_cache.is_authorized('mi-01234567890abcd01', fingerprint)
+
+
+def test_native_proxy_terminates_session_when_ssh_client_hangs_up(monkeypatch):
+    ssm = Mock()
+    ssm.start_session.return_value = {'SessionId': 'session-1', 'TokenValue': 'token', 'StreamUrl': 'wss://'}
+    boto_session = Mock(region_name='eu-west-1')
+    boto_session.client.return_value = ssm
+    proxy = SSMProxyCommand('ssh-job.training.sagemaker', boto_session=boto_session)
+    proxy.authorize = Mock(return_value=('mi-01234567890abcd01', 'SHA256:fake', False))
+
+    def hang_up(*args, **kwargs):
+        os.kill(os.getpid(), signal.SIGHUP)
+        time.sleep(5)
+
+    with patch('subprocess.call', side_effect=hang_up), pytest.raises(SystemExit):
+        proxy.run()
+    ssm.terminate_session.assert_called_once_with(SessionId='session-1')
+
+
+def test_native_proxy_fails_for_offline_instance():
+    ssm = Mock()
+    ssm.describe_instance_information.return_value = {
+        'InstanceInformationList': [{'InstanceId': 'mi-01234567890abcd01', 'PingStatus': 'ConnectionLost'}]
+    }
+    boto_session = Mock(region_name='eu-west-1')
+    boto_session.client.return_value = ssm
+    proxy = SSMProxyCommand('ssh-job.training.sagemaker', boto_session=boto_session)
+    with pytest.raises(ValueError, match='ConnectionLost'):
+        proxy.check_instance_is_online('mi-01234567890abcd01')
+
+
+def test_default_bucket_is_resolved_once_per_credentials_and_region(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    monkeypatch.delenv('AWS_ACCESS_KEY_ID', raising=False)
+    boto_session = Mock(region_name='eu-west-1', profile_name='default')
+    other_profile = Mock(region_name='eu-west-1', profile_name='other')
+    # E.g., DefaultS3Bucket in the SageMaker config file of the default profile
+    buckets = {boto_session: 'DOC-EXAMPLE-BUCKET', other_profile: 'sagemaker-eu-west-1-666666666666'}
+    sagemaker_session = Mock(side_effect=lambda boto_session: Mock(**{
+        'default_bucket.return_value': buckets[boto_session]}))
+
+    with patch('sagemaker.Session', sagemaker_session):
+        assert SSMProxyCommand.get_default_bucket(boto_session) == 'DOC-EXAMPLE-BUCKET'
+        assert SSMProxyCommand.get_default_bucket(boto_session) == 'DOC-EXAMPLE-BUCKET'
+        assert sagemaker_session.call_count == 1
+
+        assert SSMProxyCommand.get_default_bucket(other_profile) == 'sagemaker-eu-west-1-666666666666'
+        assert sagemaker_session.call_count == 2
+
+        assert SSMProxyCommand.get_default_bucket(boto_session, use_cache=False) == 'DOC-EXAMPLE-BUCKET'
+        assert sagemaker_session.call_count == 3
+
+
+def test_native_proxy_resolves_default_bucket_again_when_upload_fails(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.delenv('SSH_AUTHORIZED_KEYS_PATH', raising=False)
+    monkeypatch.delenv('AWS_ACCESS_KEY_ID', raising=False)
+    (tmp_path / '.ssh').mkdir()
+    _fake_ssh_keygen(['ssh-keygen', '-f', str(tmp_path / '.ssh' / 'ssh-job.training.sagemaker')])
+    ssm = Mock()
+    ssm.send_command.return_value = {'Command': {'CommandId': 'command-1'}}
+    ssm.get_command_invocation.return_value = {'Status': 'Success'}
+    s3 = Mock()
+    s3.upload_file.side_effect = [S3UploadFailedError('NoSuchBucket'), None]
+    boto_session = Mock(region_name='eu-west-1', profile_name='default')
+    boto_session.client.side_effect = lambda service_name: {'ssm': ssm, 's3': s3}[service_name]
+
+    proxy = SSMProxyCommand('ssh-job.training.sagemaker', boto_session=boto_session)
+    cache = DefaultBucketCache.default()
+    key = DefaultBucketCache.get_credentials_key('default', 'eu-west-1')
+    cache.put(key, 'sagemaker-eu-west-1-deleted')
+    sagemaker_session = Mock()
+    sagemaker_session.return_value.default_bucket.return_value = 'sagemaker-eu-west-1-555555555555'
+    with patch('sagemaker.Session', sagemaker_session):
+        proxy.publish_key('mi-01234567890abcd01', str(tmp_path / '.ssh' / 'ssh-job.training.sagemaker'))
+
+    assert [call[0][1] for call in s3.upload_file.call_args_list] == \
+           ['sagemaker-eu-west-1-deleted', 'sagemaker-eu-west-1-555555555555']
+    assert cache.get(key) == 'sagemaker-eu-west-1-555555555555'
+    commands = ssm.send_command.call_args[1]['Parameters']['commands']
+    assert 'aws s3 cp "s3://sagemaker-eu-west-1-555555555555/ssh-authorized-keys/' \
+           'ssh-job.training.sagemaker.pub" /etc/ssh/authorized_keys.d/' in commands
@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.stub import Stubber
+from mock.mock import MagicMock, Mock, patch
+
+from sagemaker_ssh_helper import clients, timings
+from sagemaker_ssh_helper.ide import SSHIDE
+from sagemaker_ssh_helper.log import SSHLog
+from sagemaker_ssh_helper.manager import SSMManager
+
+
+def test_clients_are_created_once_per_service_and_region():
+    with patch('boto3.client', side_effect=lambda service_name, **kwargs: Mock()) as create_client:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            ssm_clients = list(executor.map(lambda _: clients.get_client('ssm', 'eu-west-1'), range(32)))
+        assert all(client is ssm_clients[0] for client in ssm_clients)
+        assert clients.get_client('ssm', 'us-east-1') is not ssm_clients[0]
+        assert clients.get_client('logs', 'eu-west-1') is not ssm_clients[0]
+        assert create_client.call_count == 3
+
+        clients.clear()
+        assert clients.get_client('ssm', 'eu-west-1') is not ssm_clients[0]
+
+
+def test_manager_log_and_ide_share_the_clients():
+    with patch('boto3.client', side_effect=lambda service_name, **kwargs: MagicMock()) as create_client:
+        ide = SSHIDE('d-egm0dexample', 'test-user', region_name='eu-west-1')
+        SSMManager(region_name='eu-west-1', inventory_cache=False).get_ssh_instance_timestamp('mi-01234567890abcd01')
+        SSMManager(region_name='eu-west-1', inventory_cache=False).get_ssh_instance_timestamp('mi-01234567890abcd02')
+        SSHLog(region_name='eu-west-1')._list_log_group_names('/aws/sagemaker/TrainingJobs')
+        SSHLog(region_name='eu-west-1')._list_log_group_names('/aws/sagemaker/Endpoints')
+        assert ide.client is SSHIDE('d-egm0dexample', 'test-user', region_name='eu-west-1').client
+    assert sorted(call[0][0] for call in create_client.call_args_list) == ['logs', 'sagemaker', 'ssm']
+
+
+def test_configure_sets_pool_size_and_retry_mode():
+    registry = clients.configure(max_pool_connections=50, retry_mode='adaptive', max_attempts=4)
+    try:
+        ssm = clients.get_client('ssm', 'eu-west-1')
+        assert clients.get_registry() is registry
+        assert ssm.meta.config.max_pool_connections == 50
+        assert ssm.meta.config.retries == {'mode': 'adaptive', 'total_max_attempts': 4}
+    finally:
+        clients.configure()
+
+
+def test_api_calls_of_shared_client_are_counted_once():
+    ssm = boto3.client('ssm', region_name='eu-west-1')
+    timings.count_api_calls_of(ssm)
+    timings.count_api_calls_of(ssm)
+    with Stubber(ssm) as stubber:
+        stubber.add_response('describe_instance_information', {'InstanceInformationList': []})
+        with timings.span('check-instance-online') as timing_span:
+            ssm.describe_instance_information()
+    assert timing_span.api_calls == 1
+
+
+def test_caller_identity_is_cached_until_credentials_change():
+    sts = Mock()
+    sts.get_caller_identity.return_value = {
+        'UserId': 'AROAEXAMPLE:jane-doe', 'Account': '555555555555',
+        'Arn': 'arn:aws:sts::555555555555:assumed-role/SageMakerRole/jane-doe', 'ResponseMetadata': {},
+    }
+    boto_session = Mock(region_name='eu-west-1')
+    boto_session.client.return_value = sts
+    credentials = boto_session.get_credentials.return_value.get_frozen_credentials.return_value
+    credentials.access_key = 'ASIAEXAMPLE1'
+
+    for _ in range(100):
+        identity = clients.get_caller_identity(boto_session=boto_session)
+    assert identity == {'UserId': 'AROAEXAMPLE:jane-doe', 'Account': '555555555555',
+                        'Arn': 'arn:aws:sts::555555555555:assumed-role/SageMakerRole/jane-doe'}
+    assert sts.get_caller_identity.call_count == 1
+
+    clients.get_caller_identity('us-east-1', boto_session=boto_session)
+    assert sts.get_caller_identity.call_count == 2
+
+    # Refreshed temporary credentials
+    credentials.access_key = 'ASIAEXAMPLE2'
+    clients.get_caller_identity(boto_session=boto_session)
+    clients.get_caller_identity(boto_session=boto_session)
+    assert sts.get_caller_identity.call_count == 3
+
+
+def test_clients_are_created_again_for_new_default_session(monkeypatch):
+    monkeypatch.setattr(boto3, 'DEFAULT_SESSION', None)
+    with patch('boto3.client', side_effect=lambda service_name, **kwargs: Mock()) as create_client:
+        ssm = clients.get_client('ssm', 'eu-west-1')
+        assert clients.get_client('ssm', 'eu-west-1') is ssm
+        # E.g., after switching to another AWS profile
+        boto3.setup_default_session(region_name='eu-west-1')
+        assert clients.get_client('ssm', 'eu-west-1') is not ssm
+        assert create_client.call_count == 2
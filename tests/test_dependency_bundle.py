@@ -0,0 +1,54 @@
+import hashlib
+import os
+import subprocess
+import tarfile
+
+import pytest
+
+helper_functions = os.path.join(os.path.dirname(__file__), '..', 'sagemaker_ssh_helper', 'sm-helper-functions')
+
+
+def _fetch_dependency_bundle(cache_dir, bundle, sha256=''):
+    env = dict(os.environ, SSH_DEPENDENCY_BUNDLE_CACHE_DIR=str(cache_dir))
+    return subprocess.check_output(['bash', '-c', f'source {helper_functions}; _fetch_dependency_bundle "$0" "$1"',
+                                    str(bundle), sha256], env=env, text=True).strip()
+
+
+@pytest.fixture
+def bundle(tmp_path):
+    content_dir = tmp_path / 'content'
+    (content_dir / 'debs').mkdir(parents=True)
+    (content_dir / 'debs' / 'jq.deb').write_text('jq')
+    (content_dir / 'VERSION').write_text('ubuntu-22.04-20240101T000000Z')
+    bundle_path = tmp_path / 'bundle.tar.gz'
+    with tarfile.open(bundle_path, 'w:gz') as tar:
+        tar.add(content_dir, arcname='.')
+    return bundle_path
+
+
+def test_bundle_is_unpacked_into_cache_keyed_by_checksum(tmp_path, bundle):
+    sha256 = hashlib.sha256(bundle.read_bytes()).hexdigest()
+    cache_dir = tmp_path / 'cache'
+
+    bundle_dir = _fetch_dependency_bundle(cache_dir, bundle)
+
+    assert bundle_dir == str(cache_dir / sha256)
+    assert (cache_dir / sha256 / 'debs' / 'jq.deb').read_text() == 'jq'
+    assert not (cache_dir / f"{sha256}.partial").exists()
+
+    # With the checksum known, the cached bundle is used even if the source is gone
+    bundle.unlink()
+    assert _fetch_dependency_bundle(cache_dir, bundle, sha256) == bundle_dir
+
+
+def test_bundle_with_wrong_checksum_is_rejected(tmp_path, bundle):
+    cache_dir = tmp_path / 'cache'
+
+    with pytest.raises(subprocess.CalledProcessError):
+        _fetch_dependency_bundle(cache_dir, bundle, '0' * 64)
+
+    assert os.listdir(cache_dir) == []
+
+
+def test_unpacked_bundle_directory_is_used_as_is(tmp_path):
+    assert _fetch_dependency_bundle(tmp_path / 'cache', tmp_path) == str(tmp_path)
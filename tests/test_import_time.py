@@ -0,0 +1,84 @@
+import os
+import re
+import subprocess
+import sys
+
+# sm-ssh runs as SSH ProxyCommand on every connection, so it must not pay for heavy imports
+IMPORT_TIME_BUDGET_IN_SEC = 0.3
+HEAVY_MODULES = ['boto3', 'botocore', 'sagemaker', 'psutil']
+
+START_PROXY_WITHOUT_CONNECTING = """
+import sys
+from unittest import mock
+from sagemaker_ssh_helper import sm_ssh
+sys.argv = ['sm-ssh', 'start-proxy', 'ssh-training-job.training.sagemaker']
+with mock.patch.object(sm_ssh.SageMakerSecureShellHelper, 'start_proxy') as start_proxy:
+    sm_ssh.main()
+assert start_proxy.called
+"""
+
+START_BROKER_PROXY_WITHOUT_CONNECTING = """
+import sys
+from unittest import mock
+from sagemaker_ssh_helper import sm_ssh
+sys.argv = ['sm-ssh', 'start-proxy', '--broker', 'ssh-training-job.training.sagemaker']
+with mock.patch('sagemaker_ssh_helper.broker.BrokerClient.connect') as connect, \\
+        mock.patch('sagemaker_ssh_helper.broker.BrokerClient.relay_stdio'):
+    sm_ssh.main()
+assert connect.called
+"""
+
+START_NATIVE_PROXY_WITHOUT_CONNECTING = """
+import sys
+from unittest import mock
+from sagemaker_ssh_helper import sm_ssh
+sys.argv = ['sm-ssh', 'start-proxy', '--native', 'ssh-training-job.training.sagemaker']
+with mock.patch('sagemaker_ssh_helper.proxy_command.SSMProxyCommand') as proxy_command:
+    proxy_command.return_value.run.return_value = 0
+    sm_ssh.main()
+assert proxy_command.return_value.run.called
+"""
+
+
+def _import_times(*args):
+    env = dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(__file__), '..'))
+    result = subprocess.run([sys.executable, '-X', 'importtime', *args], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+    # import time: self [us] | cumulative | imported package
+    import_times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if match:
+            import_times[match.group(4)] = (int(match.group(2)) / 1e6, len(match.group(3)))
+    return import_times
+
+
+def _assert_light(import_times):
+    heavy = [module for module in import_times if module.split('.')[0] in HEAVY_MODULES]
+    assert heavy == []
+    # Only the top-level imports, the nested ones are already included into their cumulative time
+    total = sum(cumulative for module, (cumulative, level) in import_times.items()
+                if level == 1 and module.startswith('sagemaker_ssh_helper'))
+    assert total < IMPORT_TIME_BUDGET_IN_SEC
+
+
+def _assert_no_sagemaker_sdk(import_times):
+    # The native proxy needs boto3, but not SageMaker Python SDK or psutil
+    heavy = [module for module in import_times if module.split('.')[0] in ['sagemaker', 'psutil']]
+    assert heavy == []
+
+
+def test_sm_ssh_version_imports_are_light():
+    _assert_light(_import_times('-m', 'sagemaker_ssh_helper.sm_ssh', '--version'))
+
+
+def test_sm_ssh_start_proxy_argument_parsing_imports_are_light():
+    _assert_light(_import_times('-c', START_PROXY_WITHOUT_CONNECTING))
+
+
+def test_sm_ssh_start_proxy_broker_client_imports_are_light():
+    _assert_light(_import_times('-c', START_BROKER_PROXY_WITHOUT_CONNECTING))
+
+
+def test_sm_ssh_start_proxy_native_imports_no_sagemaker_sdk():
+    _assert_no_sagemaker_sdk(_import_times('-c', START_NATIVE_PROXY_WITHOUT_CONNECTING))
@@ -0,0 +1,111 @@
+import io
+import subprocess
+import threading
+import time
+
+from mock.mock import patch
+
+from sagemaker_ssh_helper.proxy import SSMProxy, MultiNodeSSMProxy
+
+
+def test_commands_go_through_control_master(tmp_path):
+    proxy = SSMProxy(17022)
+    with patch('subprocess.call', return_value=0) as call, patch('tempfile.mkdtemp', return_value=str(tmp_path)), \
+            patch('subprocess.Popen') as popen, patch('atexit.register') as atexit_register:
+        proxy._start_control_master()
+    master_args = call.call_args[0][0]
+    assert "ControlMaster=yes" in master_args
+    assert f"ControlPath={tmp_path / 'master'}" in master_args
+    assert "-f" in master_args and "-N" in master_args
+    # The master doesn't outlive this process for long, even if disconnect() is never called
+    assert "ControlPersist=10m" in master_args
+    assert popen.call_args[0][0][-1] == "cat"
+    assert f"ControlPath={tmp_path / 'master'}" in popen.call_args[0][0]
+    atexit_register.assert_called_once_with(proxy._stop_control_master)
+    keepalive = popen.return_value
+
+    with patch('os.system', return_value=0) as keyscan, \
+            patch('subprocess.check_output', return_value=b"Linux") as check_output, \
+            patch('subprocess.call', return_value=0) as call:
+        proxy.run_command_with_output("uname -a")
+        proxy.run_command_with_output("hostname")
+        proxy.run_command("sm-wait stop")
+        proxy.forward_port(8080, 80)
+    # The host key is fetched only once and no new handshakes are needed for the commands
+    assert keyscan.call_count == 1
+    for args in [check_output.call_args_list[0][0][0], check_output.call_args_list[1][0][0],
+                 call.call_args_list[0][0][0], call.call_args_list[1][0][0]]:
+        assert "ControlMaster=auto" in args
+        assert f"ControlPath={tmp_path / 'master'}" in args
+    assert call.call_args_list[1][0][0][-4:] == ["-O", "forward", "-L", "localhost:8080:localhost:80"]
+
+    with patch('subprocess.call', return_value=0) as call, patch('atexit.unregister') as atexit_unregister:
+        proxy._stop_control_master()
+    assert call.call_args[0][0][-2:] == ["-O", "exit"]
+    assert proxy.get_control_path() is None
+    keepalive.stdin.close.assert_called_once()
+    atexit_unregister.assert_called_once_with(proxy._stop_control_master)
+
+
+def test_commands_fall_back_to_separate_connections_without_master():
+    proxy = SSMProxy(17022)
+    with patch('subprocess.call', return_value=255), patch('tempfile.mkdtemp', return_value='/tmp/sm-ssh-test'), \
+            patch('shutil.rmtree'), patch('subprocess.Popen') as popen:
+        proxy._start_control_master()
+    assert proxy.get_control_path() is None
+    popen.assert_not_called()
+    with patch('subprocess.call', return_value=0) as call:
+        proxy.run_command("sm-wait stop")
+    assert not any(arg.startswith("ControlPath") for arg in call.call_args[0][0])
+
+
+def test_multi_node_command_runs_in_parallel_with_rank_prefixes():
+    instance_ids = [f"mi-01234567890abcd0{i}" for i in range(4)]
+    multi_node_proxy = MultiNodeSSMProxy(instance_ids)
+    assert len(set(proxy.ssh_listen_port for proxy in multi_node_proxy.proxies)) == 4
+
+    def start_command(proxy, command, **kwargs):
+        rank = [p.ssh_listen_port for p in multi_node_proxy.proxies].index(proxy.ssh_listen_port)
+        return subprocess.Popen(['sh', '-c', f'echo {command} {rank}; sleep 1; echo done; exit {rank}'], **kwargs)
+
+    output = io.StringIO()
+    with patch.object(SSMProxy, 'start_command', autospec=True, side_effect=start_command):
+        start_time = time.monotonic()
+        exit_codes = multi_node_proxy.run_command("nvidia-smi", output)
+        duration = time.monotonic() - start_time
+
+    assert exit_codes == [0, 1, 2, 3]
+    assert duration < 3
+    lines = output.getvalue().splitlines()
+    assert sorted(lines) == sorted([f"[{rank}] nvidia-smi {rank}" for rank in range(4)] +
+                                   [f"[{rank}] done" for rank in range(4)])
+
+
+def test_multi_node_connect_generates_key_once_and_connects_all_nodes_in_parallel(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    ssh_key = tmp_path / '.ssh' / 'sagemaker-ssh-gw'
+    instance_ids = [f"mi-01234567890abcd0{i}" for i in range(4)]
+    multi_node_proxy = MultiNodeSSMProxy(instance_ids)
+    keygen_calls = []
+    ssh_keys = {}
+    # Every node waits here until all nodes have started connecting
+    all_nodes_started = threading.Barrier(len(instance_ids), timeout=10)
+    real_popen = subprocess.Popen
+
+    def popen(args, env=None, **kwargs):
+        if args[0] == "ssh-keygen":
+            keygen_calls.append(args)
+            return real_popen(args, **kwargs)
+        ssh_keys[args[1]] = env.get('SSH_KEY')
+        assert ssh_key.exists()
+        all_nodes_started.wait()
+        return real_popen(['true'], stdout=subprocess.PIPE)
+
+    with patch('subprocess.Popen', side_effect=popen), \
+            patch.object(SSMProxy, '_run_command_with_output', return_value=b"Linux"), \
+            patch.object(SSMProxy, '_start_control_master'):
+        multi_node_proxy.connect()
+        multi_node_proxy.disconnect()
+
+    assert len(keygen_calls) == 1
+    assert ssh_keys == {instance_id: str(ssh_key) for instance_id in instance_ids}
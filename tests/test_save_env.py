@@ -0,0 +1,41 @@
+import os
+import random
+import string
+import subprocess
+
+sm_save_env = os.path.join(os.path.dirname(__file__), '..', 'sagemaker_ssh_helper', 'sm-save-env')
+
+
+def _generate_env(count=300, seed=42):
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits + " '\"=\n\t\\$`!*?;|&(){}[]<>#~%,.:/-_"
+    env = {
+        'PATH': os.environ['PATH'],
+        'EMPTY': '',
+        'SINGLE_QUOTES': "it's 'quoted'",
+        'DOUBLE_QUOTES': 'say "hello"',
+        'MULTI_LINE': 'first line\nsecond line\n',
+        'TRAILING_NEW_LINES': 'value\n\n\n',
+        'LEADING_NEW_LINE': '\nvalue',
+        'EQUALS': 'a=b=c',
+        'SM_TRAINING_ENV': '{"hyperparameters": {"epochs": 10, "name": "it\'s"}, "hosts": ["algo-1", "algo-2"]}' * 50,
+        'HOME': '/root',
+        'LANG': 'C.UTF-8',
+        'BASH_FUNC_my_function%%': '() {  echo "hi"\n}',
+    }
+    for i in range(count):
+        env[f"VAR_{i}"] = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 200)))
+    return env
+
+
+def test_print_env_is_byte_identical_to_print_vars():
+    env = _generate_env()
+
+    legacy = subprocess.check_output(['bash', '-c', f'env -0 | xargs -0 bash {sm_save_env} print-vars'], env=env)
+    single_pass = subprocess.check_output(['bash', sm_save_env, 'print-env'], env=env)
+
+    assert single_pass == legacy
+    assert b"SINGLE_QUOTES='it'\"'\"'s '\"'\"'quoted'\"'\"''\n" in single_pass
+    assert b"MULTI_LINE='first line\nsecond line'\n" in single_pass
+    assert b"HOME=" not in single_pass
+    assert b"BASH_FUNC_" not in single_pass
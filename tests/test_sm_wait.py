@@ -0,0 +1,50 @@
+import os
+import subprocess
+import time
+
+sm_wait = os.path.join(os.path.dirname(__file__), '..', 'sagemaker_ssh_helper', 'sm-wait')
+
+
+def _start_waiting(tmp_path, seconds):
+    env = dict(os.environ, SM_WAIT_STATE_DIR=str(tmp_path))
+    process = subprocess.Popen(['bash', sm_wait, str(seconds)], env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    fifo = tmp_path / 'sm-wait.d' / f"{process.pid}.fifo"
+    deadline = time.monotonic() + 10
+    while not fifo.exists() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert fifo.exists()
+    return process, env
+
+
+def test_stop_wakes_up_waiting_process(tmp_path):
+    process, env = _start_waiting(tmp_path, 600)
+
+    start = time.monotonic()
+    subprocess.check_call(['bash', sm_wait, 'stop'], env=env)
+    output, _ = process.communicate(timeout=30)
+
+    assert process.returncode == 0
+    assert "Successfully stopped" in output
+    # Only the grace period for `sm-wait stop` to return, no polling
+    assert time.monotonic() - start < 10
+    assert not os.listdir(tmp_path / 'sm-wait.d')
+
+
+def test_waiting_completes_without_stop(tmp_path):
+    process, _ = _start_waiting(tmp_path, 2)
+
+    output, _ = process.communicate(timeout=30)
+
+    assert process.returncode == 0
+    assert "Waiting complete. No 'stop' command received." in output
+    assert not os.listdir(tmp_path / 'sm-wait.d')
+
+
+def test_stopped_flag_is_checked_before_waiting(tmp_path):
+    (tmp_path / 'sm-wait-stopped').touch()
+    env = dict(os.environ, SM_WAIT_STATE_DIR=str(tmp_path))
+
+    output = subprocess.check_output(['bash', sm_wait, '600'], env=env, text=True, timeout=30)
+
+    assert "Successfully stopped" in output
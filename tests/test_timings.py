@@ -0,0 +1,59 @@
+import os
+import subprocess
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from sagemaker_ssh_helper import timings
+
+
+def test_python_and_shell_spans_are_summarized_together(monkeypatch, tmp_path):
+    timings_path = str(tmp_path / 'timings.jsonl')
+    monkeypatch.setenv('SM_SSH_TIMINGS_FILE', timings_path)
+    monkeypatch.setenv('SM_SSH_CONNECTION_ID', 'connection-1')
+
+    with timings.span('resolve-instance-ids', resource_name='ssh-job') as timing_span:
+        timing_span.add_attempt()
+        timing_span.add_attempt()
+    with pytest.raises(ValueError):
+        with timings.span('health-check'):
+            raise ValueError("Connection refused")
+
+    helper_functions = os.path.join(os.path.dirname(__file__), '..', 'sagemaker_ssh_helper', 'sm-helper-functions')
+    subprocess.check_call(['bash', '-c', f'source {helper_functions}; t=$(_timing_now); '
+                                         f'_timing_span wait-for-command "$t" 3 3'])
+    monkeypatch.setenv('SM_SSH_CONNECTION_ID', 'connection-2')
+    with timings.span('resolve-instance-ids'):
+        pass
+
+    spans = timings.read_spans(timings_path, 'connection-1')
+    assert [span['Phase'] for span in spans] == ['resolve-instance-ids', 'health-check', 'wait-for-command']
+    assert spans[0]['Attempts'] == 2 and spans[0]['resource_name'] == 'ssh-job'
+    assert spans[1]['Status'] == 'error'
+    assert spans[2]['Source'] == 'bash' and spans[2]['ApiCalls'] == 3 and spans[2]['DurationInSec'] >= 0
+    summary = timings.format_summary(spans)
+    assert "wait-for-command" in summary
+    assert summary.splitlines()[-1].startswith("Total: ") and summary.endswith("API calls: 3")
+
+
+def test_span_is_not_recorded_without_timings_file(monkeypatch, tmp_path):
+    monkeypatch.delenv('SM_SSH_TIMINGS_FILE', raising=False)
+    monkeypatch.chdir(tmp_path)
+    with timings.span('generate-key'):
+        pass
+    assert os.listdir(tmp_path) == []
+
+
+def test_api_calls_are_counted_for_innermost_span():
+    ssm = timings.count_api_calls_of(boto3.client('ssm', region_name='eu-west-1'))
+    with Stubber(ssm) as stubber:
+        for _ in range(3):
+            stubber.add_response('describe_instance_information', {'InstanceInformationList': []})
+        ssm.describe_instance_information()
+        with timings.span('resolve-instance-ids') as outer_span:
+            ssm.describe_instance_information()
+            with timings.span('check-instance-online') as inner_span:
+                ssm.describe_instance_information()
+    assert outer_span.api_calls == 1
+    assert inner_span.api_calls == 1
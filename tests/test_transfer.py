@@ -0,0 +1,99 @@
+import os
+import subprocess
+
+import pytest
+from mock.mock import patch, Mock
+
+from sagemaker_ssh_helper.proxy import SSMProxy
+from sagemaker_ssh_helper.transfer import SSMFileTransfer, MIB
+
+
+def _local_start_command(proxy, command, **kwargs):
+    # Run "remote" commands locally instead of over SSH
+    return subprocess.Popen(['sh', '-c', command], **kwargs)
+
+
+def _new_transfer(monkeypatch, tmp_path, **kwargs):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    file_transfer = SSMFileTransfer('mi-01234567890abcd01', boto_session=Mock(region_name='eu-west-1'),
+                                    chunk_size=MIB, **kwargs)
+    file_transfer.proxies = [SSMProxy(17022 + i) for i in range(3)]
+    return file_transfer
+
+
+def _make_tree(root):
+    os.makedirs(root / 'sub' / 'dir')
+    (root / 'small.txt').write_bytes(b"hello\n")
+    (root / 'sub' / 'dir' / 'log.txt').write_bytes(b"line\n" * 1000)
+    (root / 'sub' / 'empty').write_bytes(b"")
+    (root / 'large.bin').write_bytes(os.urandom(3 * MIB + 12345))
+
+
+def _assert_same_tree(first, second):
+    first_files = sorted(str(p.relative_to(first)) for p in first.rglob('*') if p.is_file())
+    second_files = sorted(str(p.relative_to(second)) for p in second.rglob('*') if p.is_file())
+    assert first_files == second_files
+    for rel_path in first_files:
+        assert (first / rel_path).read_bytes() == (second / rel_path).read_bytes()
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_pull_and_push_directory_in_chunks(monkeypatch, tmp_path, compress):
+    remote = tmp_path / 'remote'
+    _make_tree(remote)
+    file_transfer = _new_transfer(monkeypatch, tmp_path, compress=compress)
+
+    with patch.object(SSMProxy, 'start_command', autospec=True, side_effect=_local_start_command) as start_command:
+        assert file_transfer.pull(str(remote), str(tmp_path / 'local')) == 3 * MIB + 12345 + 5006
+        _assert_same_tree(remote, tmp_path / 'local')
+        assert sum('dd if=' in c[0][1] for c in start_command.call_args_list) == 4
+
+        assert file_transfer.push(str(tmp_path / 'local'), str(tmp_path / 'pushed')) == 3 * MIB + 12345 + 5006
+        _assert_same_tree(remote, tmp_path / 'pushed')
+
+
+def test_interrupted_pull_resumes_with_changed_chunks_only(monkeypatch, tmp_path):
+    remote = tmp_path / 'remote'
+    _make_tree(remote)
+    local = tmp_path / 'local'
+    file_transfer = _new_transfer(monkeypatch, tmp_path)
+
+    with patch.object(SSMProxy, 'start_command', autospec=True, side_effect=_local_start_command):
+        file_transfer.pull(str(remote), str(local))
+        # Damage the second chunk of the large file locally
+        with open(local / 'large.bin', 'r+b') as f:
+            f.seek(MIB + 10)
+            f.write(b"corrupted")
+        assert file_transfer.pull(str(remote), str(local)) == MIB
+        _assert_same_tree(remote, local)
+        assert file_transfer.pull(str(remote), str(local)) == 0
+
+
+def test_pull_single_file_into_directory(monkeypatch, tmp_path):
+    remote = tmp_path / 'remote'
+    _make_tree(remote)
+    os.makedirs(tmp_path / 'local')
+    file_transfer = _new_transfer(monkeypatch, tmp_path)
+
+    with patch.object(SSMProxy, 'start_command', autospec=True, side_effect=_local_start_command):
+        file_transfer.pull(str(remote / 'sub' / 'dir' / 'log.txt'), str(tmp_path / 'local'))
+    assert (tmp_path / 'local' / 'log.txt').read_bytes() == b"line\n" * 1000
+
+
+def test_large_push_is_staged_through_s3(monkeypatch, tmp_path):
+    local = tmp_path / 'local'
+    _make_tree(local)
+    file_transfer = _new_transfer(monkeypatch, tmp_path, s3_threshold=MIB, s3_path='s3://bucket/staging')
+    s3 = file_transfer.boto_session.client.return_value
+    s3.get_paginator.return_value.paginate.return_value = [{'Contents': [{'Key': 'staging/key'}]}]
+
+    with patch.object(SSMProxy, 'start_command', autospec=True, side_effect=_local_start_command) as start_command, \
+            patch('sagemaker_ssh_helper.transfer.SSMFileTransfer._check_output') as check_output:
+        file_transfer.push(str(local), '/opt/ml/input')
+    start_command.assert_not_called()
+
+    uploaded_keys = sorted(c[0][2] for c in s3.upload_file.call_args_list)
+    assert len(uploaded_keys) == 4
+    assert all(key.startswith('staging/mi-01234567890abcd01-') for key in uploaded_keys)
+    assert check_output.call_args[0][1].startswith("aws s3 cp --only-show-errors --recursive s3://bucket/staging/")
+    s3.delete_objects.assert_called_once_with(Bucket='bucket', Delete={'Objects': [{'Key': 'staging/key'}]})